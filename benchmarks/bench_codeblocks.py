@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Cost of finding code blocks for `/copy code` and `/extract` in a long chat.
+
+Builds a chat of `--replies` answers (each with a few fenced code blocks
+between paragraphs) through `ChatGPT.add_message`, feeding every reply to
+a `CodeBlockScanner` in `--delta` character pieces as `render_stream`
+does. It reports what that scanning adds per streamed delta, and compares
+the implementation gpt-term used before (a regex search of the reply on
+every `/copy code`, which would have to search every reply to reach an
+earlier one) with looking blocks up in the `CodeBlockIndex`:
+
+- last reply: the blocks of the last reply (`/copy code N`)
+- whole chat: every block of the chat with its code (`/copy code list`, `/extract`)
+- loaded: indexing a loaded history of the same chat, scanned once
+
+    python benchmarks/bench_codeblocks.py [--replies 2000] [--delta 4]
+'''
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+WORDS = ("the function returns a list of values when the request fails it is retried with backoff "
+         "and the result is cached so later calls are fast").split()
+LANGUAGES = ("python", "bash", "javascript", "", "json", "go")
+
+
+def make_reply(rng: random.Random) -> str:
+    parts = []
+    for _ in range(rng.randint(1, 4)):
+        parts.append(" ".join(rng.choices(WORDS, k=rng.randint(30, 120))))
+        code = "\n".join("    " * rng.randint(0, 2) + " ".join(rng.choices(WORDS, k=rng.randint(2, 8)))
+                         for _ in range(rng.randint(3, 40)))
+        parts.append(f"```{rng.choice(LANGUAGES)}\n{code}\n```")
+    parts.append(" ".join(rng.choices(WORDS, k=rng.randint(10, 60))))
+    return "\n\n".join(parts)
+
+
+def timed(func, repeat: int = 1) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--replies', type=int, default=2000, help="replies in the chat")
+    parser.add_argument('--delta', type=int, default=4, help="characters per streamed delta")
+    args = parser.parse_args()
+
+    home = tempfile.TemporaryDirectory()
+    # data_dir 在导入 gpt_term.main 时由 HOME 决定
+    os.environ["HOME"] = home.name
+    import gpt_term.main as gpt_term
+    from gpt_term.codeblocks import CodeBlockIndex, CodeBlockScanner
+
+    rng = random.Random(0)
+    chat_gpt = gpt_term.ChatGPT("sk-bench", 30)
+    scanning, deltas = 0.0, 0
+    for number in range(args.replies):
+        chat_gpt.add_message({"role": "user", "content": f"question {number}"}, 10)
+        reply = make_reply(rng)
+        scanner = CodeBlockScanner()
+        pieces = [reply[start:start + args.delta] for start in range(0, len(reply), args.delta)]
+        start = time.perf_counter()
+        for piece in pieces:
+            scanner.feed(piece)
+        blocks = scanner.finish()
+        scanning += time.perf_counter() - start
+        deltas += len(pieces)
+        chat_gpt.code_blocks.stream(reply, blocks)
+        chat_gpt.add_message({"role": "assistant", "content": reply}, 100)
+    messages = chat_gpt.messages
+    code_blocks = chat_gpt.code_blocks
+
+    def regex_last():
+        return re.findall(r'```[\s\S]*?```', messages[-1]["content"])
+
+    def regex_chat():
+        return [code for index in range(len(messages)) if messages.roles[index] == 'assistant'
+                for code in re.findall(r'```[\s\S]*?```', messages[index]["content"])]
+
+    def index_last():
+        code_blocks.sync(messages)
+        content = messages[-1]["content"]
+        return [content[block.start:block.end] for block in code_blocks.blocks_of(-1)]
+
+    def index_chat():
+        code_blocks.sync(messages)
+        return [code_blocks.code(messages, block) for block in code_blocks.blocks]
+
+    def index_loaded():
+        CodeBlockIndex().sync(messages)
+
+    assert len(regex_chat()) == len(index_chat())
+    print(f"{args.replies} replies, {len(code_blocks)} code blocks, "
+          f"{sum(messages.sizes) / 1024 / 1024:.1f} MB of messages")
+    print(f"scanning while streaming: {scanning / deltas * 1e6:.2f}us per {args.delta}-character delta")
+    print(f"{'':10} {'last reply':>12} {'whole chat':>12} {'loaded':>10}")
+    print(f"{'regex':10} {timed(regex_last, 200) * 1e6:10.1f}us {timed(regex_chat, 3) * 1e3:10.1f}ms {'-':>10}")
+    print(f"{'index':10} {timed(index_last, 200) * 1e6:10.1f}us {timed(index_chat, 3) * 1e3:10.1f}ms "
+          f"{timed(index_loaded, 3) * 1e3:8.1f}ms")
+    chat_gpt.transport.close()
+    home.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Cost of slash command completion and typo suggestions as commands are added.
+
+Registers the built-in commands plus `--extra` synthetic ones and times,
+for the implementation gpt-term used before (a substring scan of every
+command on each keystroke, and a full edit-distance matrix against every
+command for an unknown one) and for `CommandRegistry` (prefix index and
+BK-tree):
+
+- completion: every keystroke of typing each command name
+- typo: suggesting a command for mistyped names
+- paste: an unknown "command" that is a pasted `--paste` character line
+
+    python benchmarks/bench_commands.py [--extra 0 200 2000] [--paste 20000]
+'''
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+TYPOS = ("/modle", "/hlep", "/exti", "/sav", "/lst", "/copyy", "/temprature", "/sesion", "/tokes", "/dleete",
+         "/histroy", "/stat", "/usag", "/xyz")
+
+
+def matrix_distance(s1: str, s2: str) -> int:
+    '''之前的实现：分配完整的 (n+1)×(m+1) 矩阵'''
+    v = [[0 for _ in range(len(s2) + 1)] for _ in range(len(s1) + 1)]
+    for i in range(len(s1) + 1):
+        for j in range(len(s2) + 1):
+            if i == 0:
+                v[i][j] = j
+            elif j == 0:
+                v[i][j] = i
+            elif s1[i - 1] == s2[j - 1]:
+                v[i][j] = v[i - 1][j - 1]
+            else:
+                v[i][j] = min(v[i - 1][j - 1], min(v[i][j - 1], v[i - 1][j])) + 1
+    return v[len(s1)][len(s2)]
+
+
+def scan_complete(names, text):
+    return [name for name in names if text in name]
+
+
+def scan_suggest(names, command):
+    characters = set(command)
+    best, suggestion = len(command), None
+    for name in names:
+        distance = matrix_distance(command, name)
+        if distance < best and len(characters & set(name)) / len(characters | set(name)) >= 0.75:
+            best, suggestion = distance, name
+    return suggestion
+
+
+def timed(func, repeat: int = 1) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--extra', type=int, nargs='+', default=[0, 200, 2000], help="synthetic commands to add")
+    parser.add_argument('--paste', type=int, default=20000, help="characters of the pasted unknown command")
+    args = parser.parse_args()
+
+    home = tempfile.TemporaryDirectory()
+    # data_dir 在导入 gpt_term.main 时由 HOME 决定
+    os.environ["HOME"] = home.name
+    import gpt_term.main  # noqa: F401 注册内置命令
+    from gpt_term.commands import Command, CommandRegistry, commands
+
+    rng = random.Random(0)
+    paste = "/" + "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(args.paste))
+    print(f"{'commands':>8} {'':10} {'keystroke':>10} {'typo':>10} {'paste':>10}")
+    for extra in args.extra:
+        registry = CommandRegistry()
+        for command in commands:
+            registry.add(command)
+        for number in range(extra):
+            word = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 10)))
+            registry.add(Command(f"/{word}{number}", None))
+        names = list(registry.commands)
+        keystrokes = [name[:end] for name in names[:len(commands)] for end in range(1, len(name) + 1)]
+        rows = (("scan", lambda text: scan_complete(names, text), lambda command: scan_suggest(names, command)),
+                ("registry", registry.complete, registry.suggest))
+        for label, complete, suggest in rows:
+            keystroke = timed(lambda: [complete(text) for text in keystrokes], 5) / len(keystrokes)
+            typo = timed(lambda: [suggest(command) for command in TYPOS]) / len(TYPOS)
+            pasted = timed(lambda: suggest(paste)) if label == "registry" or len(names) * args.paste <= 1e6 else None
+            print(f"{len(names):8} {label:10} {keystroke * 1e6:8.1f}us {typo * 1e3:8.2f}ms "
+                  + (f"{pasted * 1e3:8.1f}ms" if pasted is not None else f"{'skipped':>10}"))
+    home.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Payload size and time to first token of the context policies on a long chat.
+
+Builds a history of `--turns` question/answer turns over many unrelated
+topics, then asks `--questions` follow-up questions that each refer back to
+one early topic. For every context policy (`off` sends the full history)
+it reports the request payload, the prompt tokens the server saw, the time
+spent choosing the messages, the time to first token against the bundled
+mock server (which reads the prompt at `--prefill-rate` tokens/s before the
+first token, like a real model) and in how many requests the turn the
+question refers to was sent.
+
+    python benchmarks/bench_context.py [--turns 400] [--questions 20] [--budget 4000] [--prefill-rate 20000]
+'''
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from gpt_term.mock_server import MockServer  # noqa: E402
+
+SUBJECTS = ("postgres vacuum", "kubernetes eviction", "asyncio cancellation", "rust lifetimes", "css grid",
+            "git rebase", "terraform state", "redis eviction", "nginx caching", "docker layers", "kafka partitions",
+            "react hooks", "django migrations", "linux cgroups", "tls handshake", "numpy broadcasting",
+            "pandas groupby", "bash traps", "systemd timers", "oauth scopes", "graphql batching", "grpc deadlines",
+            "sqlite wal", "vim macros", "tmux panes", "elasticsearch shards", "prometheus histograms",
+            "webassembly imports", "unicode normalization", "jwt rotation", "cron syntax", "ssh tunnels")
+FILLER = ("the", "then", "usually", "because", "so", "with", "without", "and", "when", "this", "that", "means",
+          "config", "value", "default", "check", "first", "case", "setting", "works", "example", "also")
+
+
+def topic_words(subject: str, number: int):
+    # 每个话题除了主题词外还有自己专有的词，例如 postgres_vacuum_7
+    return subject.split() + [f"{subject.replace(' ', '_')}_{number}", f"detail{number}"]
+
+
+def build_history(turns: int, rng: random.Random):
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    topics = []
+    for number in range(turns):
+        subject = SUBJECTS[number % len(SUBJECTS)]
+        words = topic_words(subject, number)
+        topics.append(words)
+        question = f"How does {' '.join(words)} work in my setup?"
+        answer = " ".join(rng.choice(words) if rng.random() < 0.2 else rng.choice(FILLER) for _ in range(150))
+        messages.append({"role": "user", "content": question})
+        messages.append({"role": "assistant", "content": answer})
+    return messages, topics
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--turns', type=int, default=400, help="question/answer turns in the history")
+    parser.add_argument('--questions', type=int, default=20, help="follow-up questions to time")
+    parser.add_argument('--budget', type=float, default=4000, help="CONTEXT_BUDGET in tokens")
+    parser.add_argument('--keep-turns', type=int, default=4, help="CONTEXT_KEEP_TURNS")
+    parser.add_argument('--relevant-turns', type=int, default=4, help="CONTEXT_RELEVANT_TURNS")
+    parser.add_argument('--prefill-rate', type=float, default=20000, help="mock prompt tokens read per second")
+    args = parser.parse_args()
+
+    home = tempfile.TemporaryDirectory()
+    # data_dir 在导入 gpt_term.main 时由 HOME 决定
+    os.environ["HOME"] = home.name
+    import gpt_term.main as gpt_term
+    from gpt_term.context import ContextPolicy
+    from gpt_term.locale import set_lang
+    from gpt_term.sse import iter_stream_content
+
+    gpt_term._ = set_lang("en")
+    rng = random.Random(0)
+    history, topics = build_history(args.turns, rng)
+    # 只问前一半的话题，它们一定不在最近几轮中
+    targets = [rng.randrange(args.turns // 2) for _ in range(args.questions)]
+
+    with MockServer(reply_tokens=20, prefill_rate=args.prefill_rate) as server:
+        print(f"{args.turns} turns ({len(json.dumps(history)) / 1024:.0f} KB), {args.questions} questions about early turns, "
+              f"budget {args.budget:g} tokens, mock prefill {args.prefill_rate:g} tokens/s")
+        print(f"{'policy':10} {'payload':>10} {'prompt tokens':>14} {'select':>9} {'TTFT p50':>9} {'TTFT max':>9} {'turn sent':>10}")
+        for mode in ('off', 'sliding', 'relevant'):
+            chat_gpt = gpt_term.ChatGPT("sk-bench", 60)
+            chat_gpt.set_host(server.url)
+            chat_gpt.load_messages([dict(message) for message in history])
+            chat_gpt.context_policy = ContextPolicy(mode, args.budget, args.keep_turns, args.relevant_turns)
+            payloads, prompt_tokens, selects, ttfts, hits = [], [], [], [], 0
+            for target in targets:
+                words = topics[target]
+                chat_gpt.add_message({"role": "user", "content": f"Going back to {' '.join(words[:-1])}: what was the catch?"})
+                start = time.perf_counter()
+                messages = chat_gpt.context_messages()
+                selects.append(time.perf_counter() - start)
+                hits += any(message["content"].startswith("How does") and words[-2] in message["content"]
+                            for message in messages)
+                data = chat_gpt.request_data(messages, stream=True)
+                payloads.append(len(json.dumps(data)))
+                response = chat_gpt.send_request_silent(data, stream=True, kind="pipe")
+                for _content in iter_stream_content(response):
+                    response.metrics.content_received()
+                chat_gpt.transport.release(response)
+                response.metrics.finish()
+                ttfts.append(response.metrics.ttft)
+                prompt_tokens.append(response.usage["prompt_tokens"])
+                chat_gpt.pop_message()
+            print(f"{mode:10} {statistics.median(payloads) / 1024:8.1f}KB {statistics.median(prompt_tokens):14.0f} "
+                  f"{statistics.median(selects) * 1000:7.2f}ms {statistics.median(ttfts) * 1000:7.0f}ms "
+                  f"{max(ttfts) * 1000:7.0f}ms {hits:>5}/{len(targets)}")
+            chat_gpt.transport.close()
+    home.cleanup()
+
+
+if __name__ == "__main__":
+    main()
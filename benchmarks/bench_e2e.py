@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''End-to-end timings of the hot paths against the bundled mock server.
+
+Starts `gpt_term.mock_server` in-process and points gpt-term at it through
+`set_host` / `--host`, then measures:
+
+- startup: a fresh `gpt-term "question"` process in pipe mode, time to the
+  first byte on stdout and to exit
+- pipe mode: `ChatGPT.handle_simple`, time to first byte and total
+- chat: `ChatGPT.handle` with streaming Markdown rendering into an
+  off-screen terminal, time to first token, time to first render, time
+  spent rendering and render throughput
+- title: the background title generation task
+- load: `--load` of a long saved chat history, in-process (showing the
+  last messages) and as a fresh process answering one question
+- memory: peak Python allocations over the chat turns and the process RSS
+
+Use `--json FILE` to keep the numbers for comparing runs.
+
+    python benchmarks/bench_e2e.py [--turns 10] [--reply-tokens 400] [--rate 0] [--history 5000]
+'''
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Dict, List, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from gpt_term.mock_server import MockServer  # noqa: E402
+
+
+class TimedOutput(io.StringIO):
+    '''记录第一次写入和第一次写出 marker 的时间，用来计算首字节和首次渲染的时间'''
+
+    def __init__(self, marker: str = None):
+        super().__init__()
+        self.marker = marker
+        self.first_write: Optional[float] = None
+        self.first_marker: Optional[float] = None
+
+    def write(self, text: str) -> int:
+        now = time.perf_counter()
+        if self.first_write is None and text:
+            self.first_write = now
+        if self.first_marker is None and self.marker and self.marker in text:
+            self.first_marker = now
+        return super().write(text)
+
+    def isatty(self) -> bool:
+        return True
+
+    def reset(self):
+        self.seek(0)
+        self.truncate()
+        self.first_write = self.first_marker = None
+
+
+def summarize(values: List[float], unit: str = "ms") -> str:
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return "-"
+    scale = 1000 if unit == "ms" else 1
+    return f"p50 {statistics.median(values) * scale:.1f} {unit}, max {values[-1] * scale:.1f} {unit}"
+
+
+def run_process(args: List[str], home: str) -> (float, float):
+    '''启动一个新的 gpt-term 进程，返回 (到 stdout 第一个字节的时间, 到退出的时间)'''
+    python_path = os.pathsep.join(filter(None, [str(ROOT), os.environ.get("PYTHONPATH")]))
+    env = dict(os.environ, HOME=home, PYTHONPATH=python_path, PYTHONWARNINGS="ignore")
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", "gpt_term.main"] + args, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, env=env, cwd=home)
+    process.stdout.read(1)
+    first_byte = time.perf_counter() - start
+    process.stdout.read()
+    total = time.perf_counter() - start
+    stderr = process.stderr.read().decode(errors="replace")
+    if process.wait() != 0:
+        sys.exit(f"gpt-term {' '.join(args)} failed:\n{stderr[-2000:]}")
+    return first_byte, total
+
+
+def write_history(path: Path, messages: int, server_reply: str):
+    history = [{"role": "system", "content": "You are a helpful assistant."}]
+    for number in range(messages // 2):
+        history.append({"role": "user", "content": f"Question {number}: how does the render loop handle long replies?"})
+        history.append({"role": "assistant", "content": server_reply})
+    path.write_text(json.dumps(history, ensure_ascii=False), encoding="utf-8")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--turns', type=int, default=10, help="chat and pipe turns to time")
+    parser.add_argument('--reply-tokens', type=int, default=400, help="tokens in every mock reply")
+    parser.add_argument('--rate', type=float, default=0, help="mock streaming rate in tokens/s (0: unlimited)")
+    parser.add_argument('--latency', type=float, default=0, help="mock latency before the response headers")
+    parser.add_argument('--history', type=int, default=5000, help="messages in the history used for --load")
+    parser.add_argument('--runs', type=int, default=5, help="fresh processes to start for startup and --load")
+    parser.add_argument('--width', type=int, default=100, help="width of the off-screen terminal")
+    parser.add_argument('--json', metavar="FILE", help="also write the results to FILE as JSON")
+    args = parser.parse_args()
+
+    home = tempfile.TemporaryDirectory()
+    # data_dir 在导入 gpt_term.main 时由 HOME 决定
+    os.environ["HOME"] = home.name
+    with MockServer(rate=args.rate, latency=args.latency, reply_tokens=args.reply_tokens) as server:
+        config_dir = Path(home.name) / ".gpt-term"
+        config_dir.mkdir()
+        (config_dir / "config.ini").write_text(
+            f"[DEFAULT]\nOPENAI_API_KEY=sk-bench\nOPENAI_HOST={server.url}\nJOURNAL=False\n", encoding="utf-8")
+        results: Dict[str, Dict] = {"config": vars(args)}
+
+        startup = [run_process(["startup"], home.name) for _ in range(args.runs)]
+        results["startup"] = {"first_byte": [first for first, _total in startup],
+                              "total": [total for _first, total in startup]}
+
+        from rich.console import Console
+
+        import gpt_term.main as gpt_term
+        from gpt_term.locale import set_lang
+
+        gpt_term._ = set_lang("en")
+        screen = TimedOutput(marker="Mock")
+        gpt_term.console.console = Console(file=screen, force_terminal=True, width=args.width, color_system="truecolor")
+        chat_gpt = gpt_term.ChatGPT("sk-bench", 30)
+        chat_gpt.set_host(server.url)
+        chat_gpt.auto_gen_title_background_enable = False
+
+        # 管道模式
+        pipe = {"first_byte": [], "total": []}
+        for turn in range(args.turns):
+            output = TimedOutput()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(output):
+                chat_gpt.handle_simple(f"pipe question {turn}")
+            pipe["total"].append(time.perf_counter() - start)
+            pipe["first_byte"].append(output.first_write - start if output.first_write else None)
+        results["pipe"] = pipe
+
+        # 交互模式：流式渲染 Markdown
+        gpt_term.ChatMode.stream_mode = True
+        chat = {"ttft": [], "first_render": [], "render": [], "latency": [], "render_chars_per_second": []}
+        del chat_gpt.messages[1:]
+        chat_gpt.token_ledger.truncate(1)
+        tracemalloc.start()
+        for turn in range(args.turns):
+            screen.reset()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(screen):
+                reply = chat_gpt.handle(f"chat question {turn}")
+            end = time.perf_counter()
+            metrics = chat_gpt.metrics.turns[-1]
+            chat["ttft"].append(metrics.ttft)
+            chat["first_render"].append(screen.first_marker - start if screen.first_marker else None)
+            chat["render"].append(metrics.render)
+            chat["latency"].append(end - start)
+            if metrics.render:
+                chat["render_chars_per_second"].append(len(reply["content"]) / metrics.render)
+        _current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results["chat"] = chat
+
+        # 标题生成
+        titles = []
+        for turn in range(args.turns):
+            with contextlib.redirect_stdout(screen):
+                chat_gpt.start_title_generation(f"title question {turn}")
+                chat_gpt.wait_title()
+            titles.append(chat_gpt.title_latency)
+        results["title"] = {"latency": titles}
+
+        # --load
+        history_path = Path(home.name) / "chat_history_bench.json"
+        write_history(history_path, args.history, "".join(server.reply_for([])))
+        loads = []
+        for _ in range(args.runs):
+            screen.reset()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(screen):
+                gpt_term.open_chat_history(chat_gpt, str(history_path))
+            loads.append(time.perf_counter() - start)
+        load_process = [run_process(["--load", str(history_path), "question"], home.name)[1] for _ in range(args.runs)]
+        results["load"] = {"in_process": loads, "process": load_process,
+                           "history_bytes": history_path.stat().st_size}
+
+        memory = {"chat_peak_bytes": peak}
+        try:
+            import resource
+            # Linux 上单位为 KB，macOS 上为字节
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            memory["max_rss_bytes"] = maxrss if sys.platform == "darwin" else maxrss * 1024
+        except ImportError:
+            pass
+        results["memory"] = memory
+        results["server"] = dict(server.stats)
+
+    home.cleanup()
+    reply_chars = len("".join(server.reply_for([])))
+    print(f"mock server: {args.reply_tokens} tokens ({reply_chars} chars) per reply, "
+          f"rate {args.rate or 'unlimited'} tok/s, latency {args.latency}s; served {results['server']}")
+    print(f"startup, pipe mode:   first byte {summarize(results['startup']['first_byte'])}; "
+          f"exit {summarize(results['startup']['total'])}")
+    print(f"handle_simple:        first byte {summarize(pipe['first_byte'])}; total {summarize(pipe['total'])}")
+    print(f"handle, TTFT:         {summarize(chat['ttft'])}")
+    print(f"handle, first render: {summarize(chat['first_render'])}")
+    print(f"handle, rendering:    {summarize(chat['render'])} per reply, "
+          f"{statistics.median(chat['render_chars_per_second'] or [0]) / 1000:.0f}k chars/s")
+    print(f"handle, total:        {summarize(chat['latency'])}")
+    print(f"title generation:     {summarize(titles)}")
+    print(f"--load {args.history} messages ({results['load']['history_bytes'] / 1024 / 1024:.1f} MB): "
+          f"in-process {summarize(loads)}; new process {summarize(load_process)}")
+    print(f"memory: chat turns peak {peak / 1024 / 1024:.1f} MB (tracemalloc)"
+          + (f", max RSS {memory['max_rss_bytes'] / 1024 / 1024:.0f} MB" if "max_rss_bytes" in memory else ""))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Memory of a very long chat with and without spilling message bodies to disk.
+
+Builds a chat of `--messages` messages (questions and answers averaging
+`--size` characters, like a session with pasted logs) through
+`ChatGPT.add_message`, once with every body kept in memory (what a plain
+list of dicts costs) and once with `MessageStore` spilling the oldest bodies
+beyond `--memory` MB to its mmap-backed file. For both it reports the
+Python heap after the chat is built (tracemalloc), the time to add all
+messages, to choose the context of a request (`sliding` policy), to read
+the last reply (`/last`), to read a spilled early message and to write the
+whole chat as `/save` does.
+
+    python benchmarks/bench_messages.py [--messages 10000] [--size 8000] [--memory 16]
+'''
+import argparse
+import gc
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+WORDS = ("error warning request timeout retry connection pool worker thread queue latency cache "
+         "2024-05-13T10:21:07Z GET /v1/chat/completions 200 429 503 traceback line file module").split()
+
+
+def iter_messages(count: int, size: int, rng: random.Random):
+    for number in range(count):
+        words = rng.choices(WORDS, k=max(rng.randint(size // 2, size * 3 // 2) // 7, 1))
+        yield {"role": "user" if number % 2 == 0 else "assistant", "content": f"[{number}] " + " ".join(words)}
+
+
+def measure(gpt_term, messages, resident_bytes: int, spill_dir: Path):
+    from gpt_term.store import MessageStore
+
+    chat_gpt = gpt_term.ChatGPT("sk-bench", 30)
+    chat_gpt.messages = MessageStore(chat_gpt.messages[:], spill_dir, resident_bytes)
+    chat_gpt.token_ledger.reset(chat_gpt.messages)
+    # 消息在统计期间逐条生成，之后只由对话引用，统计到的就是对话本身占用的内存
+    gc.collect()
+    tracemalloc.start()
+    added = 0.0
+    for message in messages:
+        start = time.perf_counter()
+        chat_gpt.add_message(message, 100)
+        added += time.perf_counter() - start
+    del message
+    gc.collect()
+    heap, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    context = chat_gpt.context_messages()
+    select = time.perf_counter() - start
+    start = time.perf_counter()
+    chat_gpt.messages[-1]
+    last = time.perf_counter() - start
+    start = time.perf_counter()
+    chat_gpt.messages[1]
+    early = time.perf_counter() - start
+    start = time.perf_counter()
+    json.dump(chat_gpt.messages[:], io.StringIO(), ensure_ascii=False, indent=4)
+    save = time.perf_counter() - start
+    store = chat_gpt.messages
+    result = (heap, added, select, len(context), last, early, save, store.spilled)
+    store.close()
+    chat_gpt.transport.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--messages', type=int, default=10000, help="messages in the chat")
+    parser.add_argument('--size', type=int, default=8000, help="average characters per message")
+    parser.add_argument('--memory', type=float, default=16, help="MESSAGE_MEMORY_SIZE in MB for the spilling run")
+    args = parser.parse_args()
+
+    home = tempfile.TemporaryDirectory()
+    # data_dir 在导入 gpt_term.main 时由 HOME 决定
+    os.environ["HOME"] = home.name
+    import gpt_term.main as gpt_term
+    from gpt_term.locale import set_lang
+
+    gpt_term._ = set_lang("en")
+    spill_dir = Path(home.name) / "spill"
+    body_bytes = sum(len(json.dumps(message, ensure_ascii=False).encode())
+                     for message in iter_messages(args.messages, args.size, random.Random(0)))
+    print(f"{args.messages} messages, {body_bytes / 1024 / 1024:.0f} MB of JSON bodies")
+    print(f"{'store':14} {'heap':>9} {'add all':>9} {'context':>9} {'sent':>5} {'/last':>8} {'early msg':>10} "
+          f"{'/save':>8} {'on disk':>8}")
+    for name, resident_bytes in (("in memory", sys.maxsize), (f"spill > {args.memory:g} MB", int(args.memory * 1024 * 1024))):
+        messages = iter_messages(args.messages, args.size, random.Random(0))
+        heap, added, select, sent, last, early, save, spilled = measure(gpt_term, messages, resident_bytes, spill_dir)
+        print(f"{name:14} {heap / 1024 / 1024:7.1f}MB {added:8.2f}s {select * 1000:7.2f}ms {sent:>5} "
+              f"{last * 1e6:6.0f}us {early * 1e6:8.0f}us {save:7.2f}s {spilled:>8}")
+    home.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Search index cost at tens of thousands of saved chat histories.
+
+Writes `--sessions` synthetic `chat_history_*.json` files into a temporary
+directory, then times the first full index build, a `sync` with nothing
+changed (what every `/search` does first), a `sync` after a few files
+changed, and ranked queries against the finished index.
+
+    python benchmarks/bench_search.py [--sessions 20000] [--turns 6] [--queries 50]
+'''
+import argparse
+import itertools
+import json
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from gpt_term.search import SearchIndex  # noqa: E402
+
+WORDS = ("docker compose volume network python asyncio generator decorator sqlite index query rust borrow "
+         "lifetime kubernetes pod deployment regex unicode tokenizer gradient tensor cache eviction latency "
+         "数据库 索引 事务 并发 线程 进程 内存 缓存 网络 协议").split()
+
+
+# 再加上按 Zipf 分布出现的长尾词汇，接近真实文本的词频
+VOCABULARY = WORDS + [f"term{number}" for number in range(20000)]
+CUM_WEIGHTS = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(VOCABULARY))))
+
+
+def sentence(rng: random.Random, length: int) -> str:
+    return " ".join(rng.choices(VOCABULARY, cum_weights=CUM_WEIGHTS, k=length))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sessions', type=int, default=20000, help="number of saved chat histories")
+    parser.add_argument('--turns', type=int, default=6, help="question/answer pairs per history")
+    parser.add_argument('--queries', type=int, default=50, help="number of timed queries")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        files = []
+        for number in range(args.sessions):
+            messages = [{"role": "system", "content": "You are a helpful assistant."}]
+            for _ in range(args.turns):
+                messages.append({"role": "user", "content": sentence(rng, 12)})
+                messages.append({"role": "assistant", "content": sentence(rng, 80)})
+            path = directory / f"chat_history_{number}.json"
+            path.write_text(json.dumps(messages, ensure_ascii=False), encoding="utf-8")
+            files.append(path)
+
+        index = SearchIndex(directory / "search.db")
+        start = time.perf_counter()
+        index.sync(files)
+        build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index.sync(files)
+        unchanged = time.perf_counter() - start
+
+        for path in files[:10]:
+            path.write_text(path.read_text(encoding="utf-8").replace("docker", "podman"), encoding="utf-8")
+        start = time.perf_counter()
+        updated = index.sync(files)
+        changed = time.perf_counter() - start
+
+        timings = []
+        for _ in range(args.queries):
+            query = sentence(rng, 2)
+            start = time.perf_counter()
+            index.search(query)
+            timings.append(time.perf_counter() - start)
+        index.close()
+        db_size = (directory / "search.db").stat().st_size
+
+    timings.sort()
+    print(f"{args.sessions} histories, {args.sessions * args.turns * 2} messages, index {db_size / 1024 / 1024:.1f} MB")
+    print(f"full index build:      {build:.2f}s")
+    print(f"sync, nothing changed: {unchanged * 1000:.1f} ms")
+    print(f"sync, {updated} files changed: {changed * 1000:.1f} ms")
+    print(f"query (2 words, top 10): p50 {statistics.median(timings) * 1000:.1f} ms, "
+          f"max {timings[-1] * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Throughput of concurrent background sessions against the bundled mock server.
+
+Starts `gpt_term.mock_server` streaming at `--rate` tokens/s per reply and,
+for 1, 2, 4, ... `--sessions` sessions, asks one question in every session
+with `/bg` (`SessionManager.send`) and waits for all replies. With every
+reply streaming on its own pooled connection, the aggregate tokens/s should
+grow with the number of sessions while the wall time stays close to the
+time of a single reply.
+
+    python benchmarks/bench_sessions.py [--sessions 8] [--rate 100] [--reply-tokens 200]
+'''
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from gpt_term.mock_server import MockServer  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sessions', type=int, default=8, help="largest number of concurrent sessions")
+    parser.add_argument('--rate', type=float, default=100, help="mock streaming rate of every reply in tokens/s")
+    parser.add_argument('--reply-tokens', type=int, default=200, help="tokens in every mock reply")
+    args = parser.parse_args()
+
+    home = tempfile.TemporaryDirectory()
+    # data_dir 在导入 gpt_term.main 时由 HOME 决定
+    os.environ["HOME"] = home.name
+    from rich.console import Console
+
+    import gpt_term.main as gpt_term
+    from gpt_term.locale import set_lang
+    from gpt_term.sessions import SessionManager
+
+    gpt_term._ = set_lang("en")
+    gpt_term.console.console = Console(file=io.StringIO(), width=100)
+    with MockServer(rate=args.rate, reply_tokens=args.reply_tokens) as server:
+        print(f"mock server: {args.reply_tokens} tokens per reply at {args.rate:g} tokens/s "
+              f"({args.reply_tokens / args.rate:.1f}s per reply)")
+        count = 1
+        while count <= args.sessions:
+            chat_gpt = gpt_term.ChatGPT("sk-bench", 30, pool_size=max(count, 10))
+            chat_gpt.set_host(server.url)
+            chat_gpt.auto_gen_title_background_enable = False
+            sessions = SessionManager(chat_gpt)
+            for _ in range(count - 1):
+                sessions.new()
+            start = time.perf_counter()
+            for session in sessions:
+                sessions.switch(session.name)
+                sessions.send("benchmark question")
+            for session in sessions:
+                session.task.wait()
+            elapsed = time.perf_counter() - start
+            tokens = sum(session.chat_gpt.completion_tokens_spent for session in sessions)
+            failed = sum(1 for session in sessions if session.buffer.error)
+            print(f"{count:3} sessions: {elapsed:6.2f}s wall, {tokens / elapsed:8.0f} tokens/s aggregate, "
+                  f"{count * args.reply_tokens / args.rate / elapsed:5.1f}x serialized" + (f", {failed} failed" if failed else ""))
+            chat_gpt.transport.close()
+            count *= 2
+    home.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Cost of turning a streamed chat completion into reply text.
+
+Builds a stream of `--tokens` chat completion chunks in the API's compact
+JSON, cuts it into network-sized pieces, and times:
+
+- sseclient: `sseclient.SSEClient` + `json.loads` on every event, the
+  implementation gpt-term used before (skipped when sseclient-py is not
+  installed)
+- split + json: the buffer-based event splitter with `json.loads` on every
+  event
+- split + fast path: the splitter with `DeltaDecoder`, what
+  `iter_stream_content` does now
+
+    python benchmarks/bench_sse.py [--tokens 20000] [--chunk 1] [--runs 5]
+'''
+import argparse
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Callable, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from gpt_term.sse import DeltaDecoder, iter_events  # noqa: E402
+
+WORDS = ("the request response stream token latency 缓存 渲染 socket \"quoted\" back\\slash emoji 😀 "
+         "markdown python\n code").split(" ")
+
+
+def build_stream(tokens: int) -> bytes:
+    base = {"id": "chatcmpl-9bench", "object": "chat.completion.chunk", "created": 1718000000,
+            "model": "gpt-4o-2024-05-13", "system_fingerprint": "fp_bench"}
+
+    def event(delta, finish_reason=None, **extra) -> bytes:
+        part = dict(base, choices=[{"index": 0, "delta": delta, "logprobs": None, "finish_reason": finish_reason}],
+                    **extra)
+        return b"data: " + json.dumps(part, separators=(",", ":"), ensure_ascii=False).encode() + b"\n\n"
+
+    events = [event({"role": "assistant", "content": ""})]
+    events += [event({"content": " " + WORDS[number % len(WORDS)]}) for number in range(tokens)]
+    events.append(event({}, "stop"))
+    usage = {"prompt_tokens": 100, "completion_tokens": tokens, "total_tokens": tokens + 100}
+    events.append(b"data: " + json.dumps(dict(base, choices=[], usage=usage)).encode() + b"\n\n")
+    events.append(b"data: [DONE]\n\n")
+    return b"".join(events)
+
+
+def split_chunks(stream: bytes, events_per_chunk: int) -> List[bytes]:
+    '''按事件分块：每个数据块带 events_per_chunk 个事件，模拟网络逐个或成批送达'''
+    events = stream.split(b"\n\n")[:-1]
+    return [b"\n\n".join(events[index:index + events_per_chunk]) + b"\n\n"
+            for index in range(0, len(events), events_per_chunk)]
+
+
+def with_sseclient(chunks: List[bytes]) -> str:
+    import sseclient
+    reply = []
+    for event in sseclient.SSEClient(iter(chunks)).events():
+        if event.data == '[DONE]':
+            break
+        part = json.loads(event.data)
+        if not part.get("choices"):
+            continue
+        content = part["choices"][0]["delta"].get("content")
+        if content:
+            reply.append(content)
+    return "".join(reply)
+
+
+def with_json(chunks: List[bytes]) -> str:
+    reply = []
+    for data in iter_events(chunks):
+        if data == b"[DONE]":
+            break
+        part = json.loads(data)
+        if not part.get("choices"):
+            continue
+        content = part["choices"][0]["delta"].get("content")
+        if content:
+            reply.append(content)
+    return "".join(reply)
+
+
+def with_decoder(chunks: List[bytes]) -> str:
+    reply = []
+    decoder = DeltaDecoder()
+    for data in iter_events(chunks):
+        if data == b"[DONE]":
+            break
+        content = decoder.decode(data)
+        if content:
+            reply.append(content)
+    return "".join(reply)
+
+
+def timed(func: Callable[[List[bytes]], str], chunks: List[bytes], runs: int) -> float:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func(chunks)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--tokens', type=int, default=20000, help="content events in the stream")
+    parser.add_argument('--chunk', type=int, default=1, help="events per network chunk")
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    stream = build_stream(args.tokens)
+    chunks = split_chunks(stream, args.chunk)
+    expected = with_json(chunks)
+    implementations = [("sseclient + json", with_sseclient), ("split + json", with_json),
+                       ("split + fast path", with_decoder)]
+    print(f"{args.tokens} content events, {len(stream) / 1024:.0f} KB in {len(chunks)} chunks, median of {args.runs} runs")
+    baseline = None
+    for name, func in implementations:
+        try:
+            if func(chunks) != expected:
+                print(f"{name:20} MISMATCH")
+                continue
+        except ImportError:
+            print(f"{name:20} skipped (sseclient-py is not installed)")
+            continue
+        elapsed = timed(func, chunks, args.runs)
+        baseline = baseline or elapsed
+        print(f"{name:20} {elapsed * 1000:8.1f} ms  {elapsed / args.tokens * 1e6:6.2f} us/event  "
+              f"{args.tokens / elapsed / 1000:7.0f}k events/s  {baseline / elapsed:5.1f}x")
+    decoder = DeltaDecoder()
+    for data in iter_events(chunks):
+        if data != b"[DONE]":
+            decoder.decode(data)
+    print(f"fast path: {decoder.fast} events, json.loads: {decoder.parsed} events (role, finish reason, usage)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Startup cost of `gpt_term.main`, measured the way `python -X importtime` does.
+
+Runs a fresh interpreter several times, reports the cumulative import time of
+`gpt_term.main` and of the modules it pulls in, and checks that the
+one-shot/pipe path (import + ChatGPT construction) does not load any of the
+heavy, interactive-only dependencies. Exits with 1 when over budget.
+
+    python benchmarks/bench_startup.py [--runs 5] [--budget-ms 200] [--top 10]
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# 管道模式不应加载的模块
+HEAVY_MODULES = ["rich", "prompt_toolkit", "tiktoken", "pyperclip", "packaging"]
+
+PIPE_PATH = f'''
+import json, sys
+import gpt_term.main as m
+chat_gpt = m.ChatGPT("sk-bench", 30)
+print(json.dumps([name for name in {HEAVY_MODULES!r} if name in sys.modules]))
+'''
+
+
+def run(code: str, home: str, importtime: bool = False):
+    command = [sys.executable]
+    if importtime:
+        command += ["-X", "importtime"]
+    env = dict(os.environ, HOME=home, PYTHONPATH=str(ROOT))
+    return subprocess.run(command + ["-c", code], capture_output=True, text=True, env=env, cwd=ROOT, check=True)
+
+
+def parse_importtime(stderr: str):
+    '''返回 {模块名: (嵌套深度, 累计导入耗时(微秒))}'''
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line.split(":", 1)[1].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        times[name.strip()] = (depth, int(cumulative_us))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=200, help="target cumulative import time of gpt_term.main")
+    parser.add_argument('--top', type=int, default=10, help="show the N slowest top-level imports")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+        run("import gpt_term.main", home)  # warm up: create ~/.gpt-term and fill the bytecode cache
+        samples = []
+        for _ in range(args.runs):
+            samples.append(parse_importtime(run("import gpt_term.main", home, importtime=True).stderr))
+        loaded = json.loads(run(PIPE_PATH, home).stdout)
+
+    total_ms = statistics.median(sample["gpt_term.main"][1] for sample in samples) / 1000
+    print(f"gpt_term.main cumulative import time (median of {args.runs}): {total_ms:.1f} ms, budget {args.budget_ms:.0f} ms")
+    direct = [(name, cumulative_us) for name, (depth, cumulative_us) in samples[-1].items() if depth == 1]
+    print("\nslowest imports pulled in by gpt_term:")
+    for name, cumulative_us in sorted(direct, key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+
+    print(f"\nheavy modules loaded on the pipe path: {', '.join(loaded) or 'none'}")
+    if loaded or total_ms > args.budget_ms:
+        print("FAIL")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
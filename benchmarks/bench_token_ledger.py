@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Per-turn token accounting cost: full re-count vs. TokenLedger.
+
+Grows a conversation turn by turn until it fills the 128k context of
+`gpt-4-1106-preview` and times the token bookkeeping done after every reply.
+The full re-count grows with the history, the ledger stays flat.
+
+    python benchmarks/bench_token_ledger.py [--limit 128000] [--every 10]
+'''
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from gpt_term.tokens import REPLY_PRIMING_TOKENS, TokenLedger, count_token, get_encoding  # noqa: E402
+
+QUESTION = "Can you explain how the garbage collector in CPython deals with reference cycles? " * 4
+ANSWER = ("CPython uses reference counting as its primary memory management strategy, "
+          "and a generational cycle collector to reclaim objects that reference each other. " * 12
+          + "\n```python\nimport gc\ngc.collect()\nprint(gc.get_stats())\n```\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--limit', type=int, default=128000, help="tokens limit of the model (default: gpt-4-1106-preview)")
+    parser.add_argument('--every', type=int, default=10, help="print one row every N turns")
+    args = parser.parse_args()
+
+    get_encoding()  # load the encoder outside of the timed region
+
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    ledger = TokenLedger(messages)
+
+    print(f"{'turn':>5} {'messages':>9} {'tokens':>8} {'recount ms':>11} {'ledger ms':>10}")
+    turn = 0
+    recount_total = ledger_total = 0.0
+    while ledger.total < args.limit:
+        turn += 1
+        ledger_cost = 0.0
+        for message in ({"role": "user", "content": f"[{turn}] {QUESTION}"},
+                        {"role": "assistant", "content": f"[{turn}] {ANSWER}"}):
+            messages.append(message)
+
+            start = time.perf_counter()
+            ledger.append(message)
+            ledger.total
+            ledger_cost += time.perf_counter() - start
+
+        start = time.perf_counter()
+        recounted = count_token(messages)
+        recount_cost = time.perf_counter() - start
+
+        # count_token 计算的是一次请求的 prompt，比对话本身多出回答前缀
+        assert recounted - REPLY_PRIMING_TOKENS == ledger.total
+        recount_total += recount_cost
+        ledger_total += ledger_cost
+        if turn % args.every == 0:
+            print(f"{turn:>5} {len(messages):>9} {ledger.total:>8} {recount_cost * 1000:>11.2f} {ledger_cost * 1000:>10.3f}")
+
+    print(f"\n{turn} turns, {ledger.total} tokens")
+    print(f"full re-count: {recount_total:.3f}s total, {recount_total / turn * 1000:.2f} ms/turn")
+    print(f"token ledger:  {ledger_total:.3f}s total, {ledger_total / turn * 1000:.3f} ms/turn")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Usage database cost after years of requests.
+
+Fills a temporary `usage.db` with `--years` of synthetic requests
+(`--per-day` a day, spread over sessions and models), then times appending
+a request the way every reply does, the queries behind `/usage` and the
+budget check made before each request. For comparison the same monthly
+total is also computed by scanning the append-only `requests` table.
+
+    python benchmarks/bench_usage.py [--years 3] [--per-day 200] [--runs 50]
+'''
+import argparse
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from gpt_term.usage import DAILY_ROLLUP, SESSION_ROLLUP, Budget, UsageLedger, period_start  # noqa: E402
+
+MODELS = ["gpt-3.5-turbo", "gpt-4o-mini", "gpt-4o", "gpt-4-turbo", "my-local-model"]
+
+
+def timed(func, runs: int) -> str:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return f"p50 {statistics.median(timings) * 1000:.2f} ms, max {timings[-1] * 1000:.2f} ms"
+
+
+def fill(ledger: UsageLedger, years: int, per_day: int, rng: random.Random) -> int:
+    '''直接写入过去的记录，和 record 使用同样的汇总语句'''
+    db = ledger.connect()
+    now = time.time()
+    total = 0
+    with db:
+        for days_ago in range(years * 365, 0, -1):
+            day_start = now - days_ago * 86400
+            day = time.strftime("%Y-%m-%d", time.localtime(day_start))
+            for number in range(per_day):
+                at = day_start + number * 86400 / per_day
+                session = f"{day}_{number // 20:02d}"   # 每个会话约 20 次请求
+                model = rng.choice(MODELS)
+                prompt_tokens, completion_tokens = rng.randint(50, 4000), rng.randint(10, 1500)
+                cached = int(rng.random() < 0.05)
+                db.execute("INSERT INTO requests (time, session, kind, model, prompt_tokens, completion_tokens, latency, cached) "
+                           "VALUES (?, ?, 'chat', ?, ?, ?, ?, ?)",
+                           (at, session, model, prompt_tokens, completion_tokens, rng.uniform(0.5, 20), cached))
+                db.execute(DAILY_ROLLUP, (day, model, cached, prompt_tokens, completion_tokens))
+                db.execute(SESSION_ROLLUP, (session, model, at, cached, prompt_tokens, completion_tokens))
+                total += 1
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--years', type=int, default=3, help="years of history")
+    parser.add_argument('--per-day', type=int, default=200, help="requests per day")
+    parser.add_argument('--runs', type=int, default=50, help="timed runs of each query")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "usage.db"
+        ledger = UsageLedger(path, "bench")
+        start = time.perf_counter()
+        total = fill(ledger, args.years, args.per_day, rng)
+        build = time.perf_counter() - start
+        db_size = path.stat().st_size
+
+        record = timed(lambda: ledger.record(rng.choice(MODELS), 1200, 300, 2.5), args.runs)
+        month = period_start('month')
+        summary = timed(lambda: (ledger.total(period_start('day')), ledger.total(month),
+                                 ledger.total(session=ledger.session)), args.runs)
+        by_day = timed(lambda: ledger.by_day(14), args.runs)
+        by_model = timed(lambda: ledger.by_model(), args.runs)
+        by_session = timed(lambda: ledger.by_session(10), args.runs)
+        budget = Budget('month', soft=1, hard=1e9)
+        check = timed(lambda: budget.check(ledger), args.runs)
+        month_start = time.mktime(time.strptime(month, "%Y-%m-%d"))
+        scan = timed(lambda: ledger.rows(ledger.query(
+            "SELECT '', model, COUNT(*), SUM(cached), SUM(prompt_tokens), SUM(completion_tokens) FROM requests "
+            "WHERE time >= ? GROUP BY model", (month_start,))), args.runs)
+        scan_all = timed(lambda: ledger.rows(ledger.query(
+            "SELECT model, model, COUNT(*), SUM(cached), SUM(prompt_tokens), SUM(completion_tokens) FROM requests "
+            "GROUP BY model")), max(args.runs // 10, 1))
+        ledger.close()
+
+    print(f"{total} requests over {args.years} years, usage.db {db_size / 1024 / 1024:.1f} MB (filled in {build:.1f}s)")
+    print(f"record one request:            {record}")
+    print(f"/usage summary (3 totals):     {summary}")
+    print(f"/usage day (14 days):          {by_day}")
+    print(f"/usage model (all time):       {by_model}")
+    print(f"/usage session (10 sessions):  {by_session}")
+    print(f"budget check (this month):     {check}")
+    print(f"  vs. scanning requests, month:    {scan}")
+    print(f"  vs. scanning requests, all time: {scan_all}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import threading
+from typing import AsyncIterator, Callable, Iterable, Iterator, Optional
+
+log = logging.getLogger("chat")
+
+_DONE = object()
+
+
+class Interrupted(Exception):
+    '''Carries a KeyboardInterrupt / SystemExit out of a task.
+
+    asyncio re-raises these two from `run_forever`, which would stop the
+    shared loop; inside a task they are wrapped and unwrapped again by
+    `Task.result()` in the waiting thread.'''
+
+    def __init__(self, exception: BaseException):
+        super().__init__(exception)
+        self.exception = exception
+
+
+async def _guard(coro):
+    try:
+        return await coro
+    except (KeyboardInterrupt, SystemExit) as e:
+        raise Interrupted(e)
+
+
+class Task:
+    '''Handle of a coroutine running on the shared loop, usable from any thread'''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, coro):
+        self.loop = loop
+        self.future = concurrent.futures.Future()
+        self.task: Optional[asyncio.Task] = None
+        # call_soon_threadsafe 按顺序执行，cancel() 时任务一定已经创建
+        loop.call_soon_threadsafe(self._start, coro)
+
+    def _start(self, coro):
+        self.task = self.loop.create_task(_guard(coro))
+        self.task.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Task):
+        if task.cancelled():
+            self.future.cancel()
+            self.future.set_running_or_notify_cancel()
+        elif task.exception() is not None:
+            self.future.set_exception(task.exception())
+        else:
+            self.future.set_result(task.result())
+
+    def cancel(self):
+        '''请求取消任务，协程在下一个 await 处收到 CancelledError'''
+        self.loop.call_soon_threadsafe(lambda: self.task.cancel())
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def wait(self):
+        '''等待任务结束并返回结果；定时醒来，等待期间 Ctrl+C 在所有平台上都能打断'''
+        while not self.future.done():
+            concurrent.futures.wait([self.future], timeout=0.1)
+        try:
+            return self.future.result()
+        except Interrupted as e:
+            raise e.exception from None
+
+
+class EventLoop:
+    '''One asyncio event loop in a daemon thread, shared by the whole program.
+
+    Requests and streamed replies, background title generation, the version
+    check and the interactive prompt (`prompt_async`) all run as tasks on
+    this loop, the calling thread only waits for them. Ctrl+C while waiting
+    in `run` cancels the task, and the task closes its HTTP response on the
+    way out, instead of a KeyboardInterrupt being raised at a random point
+    inside requests or the SSE decoder. Blocking calls (the pooled `Transport`,
+    reading a streamed body) run in the loop's thread pool through
+    `to_thread` and `iter_in_thread`. The loop is started on first use.'''
+
+    def __init__(self):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.lock = threading.Lock()
+
+    def start(self) -> asyncio.AbstractEventLoop:
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name="event-loop", daemon=True).start()
+                log.debug("Event loop started")
+        return self.loop
+
+    def submit(self, coro) -> Task:
+        '''在后台运行 coro，不等待结果'''
+        return Task(self.start(), coro)
+
+    def run(self, coro):
+        '''运行 coro 并等待结果。等待时按 Ctrl+C 会取消任务：任务自己处理了取消
+        （例如保留已收到的部分回答）时返回它的结果，否则抛出 KeyboardInterrupt'''
+        task = self.submit(coro)
+        try:
+            return task.wait()
+        except KeyboardInterrupt:
+            if task.done():
+                raise
+            task.cancel()
+            try:
+                return task.wait()
+            except concurrent.futures.CancelledError:
+                raise KeyboardInterrupt from None
+
+
+async def to_thread(func: Callable, *args, cleanup: Callable = None, **kwargs):
+    '''在线程池中运行阻塞的 func（`asyncio.to_thread` 需要 Python 3.9）。
+    等待时被取消的话，func 迟到的返回值交给 cleanup 处理，例如关闭响应'''
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        def cleanup_late_result(done: asyncio.Future):
+            if done.exception() is None and done.result() is not None:
+                cleanup(done.result())
+
+        if cleanup is not None:
+            future.add_done_callback(cleanup_late_result)
+        raise
+
+
+async def iter_in_thread(iterator: Iterator, close: Callable = None) -> AsyncIterator:
+    '''在线程池中读取阻塞的迭代器（例如流式响应），每个元素一到达就交给协程。
+    提前结束或被取消时调用 close 中断还在进行的读取'''
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    def pump():
+        try:
+            for item in iterator:
+                loop.call_soon_threadsafe(queue.put_nowait, (item, None))
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, (_DONE, e))
+        else:
+            loop.call_soon_threadsafe(queue.put_nowait, (_DONE, None))
+
+    reader = loop.run_in_executor(None, pump)
+    exhausted = False
+    try:
+        while True:
+            item, error = await queue.get()
+            if item is _DONE:
+                # 读取已经结束，此时 reader 可能还没有标记为完成，不能再 close
+                exhausted = True
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        if not exhausted and not reader.done() and close is not None:
+            close()
+
+
+async def iter_async(iterable: Iterable) -> AsyncIterator:
+    '''把内存中的可迭代对象变成异步迭代器，每个元素之间都可以被取消'''
+    for item in iterable:
+        yield item
+        await asyncio.sleep(0)
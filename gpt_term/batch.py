@@ -0,0 +1,242 @@
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO
+
+import i18n
+import requests
+
+log = logging.getLogger("chat")
+
+_ = i18n.t
+
+
+class BatchReport:
+    '''批量模式的汇总统计'''
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.elapsed = 0.0
+        self.succeeded = 0
+        self.failed = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latencies: List[float] = []
+
+    def add(self, result: Dict):
+        if result["error"]:
+            self.failed += 1
+            return
+        self.succeeded += 1
+        self.latencies.append(result["latency"])
+        usage = result.get("usage") or {}
+        self.prompt_tokens += usage.get("prompt_tokens", 0)
+        self.completion_tokens += usage.get("completion_tokens", 0)
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.start
+
+    def format(self) -> str:
+        elapsed = max(self.elapsed, 1e-9)
+        total_tokens = self.prompt_tokens + self.completion_tokens
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            p50 = statistics.median(latencies)
+            p95 = latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+        else:
+            p50 = p95 = 0.0
+        return _("gpt_term.batch_report",
+                 requests=self.succeeded + self.failed, succeeded=self.succeeded, failed=self.failed,
+                 elapsed=f"{self.elapsed:.2f}", rps=f"{(self.succeeded + self.failed) / elapsed:.2f}",
+                 prompt_tokens=self.prompt_tokens, completion_tokens=self.completion_tokens,
+                 total_tokens=total_tokens, tps=f"{total_tokens / elapsed:.1f}",
+                 p50=f"{p50 * 1000:.0f}", p95=f"{p95 * 1000:.0f}")
+
+
+class BatchRunner:
+    '''Run many independent prompts through one `ChatGPT` instance.
+
+    Every input line is its own conversation: it starts from a copy of the
+    current messages (system prompt and `--load`ed history) and never touches
+    `chat_gpt.messages`. Requests share the pooled transport, at most
+    `workers` run at the same time, and only a bounded window of input is
+    read ahead, so arbitrarily long inputs stream through in constant memory.'''
+
+    def __init__(self, chat_gpt, workers: int = 4, ordered: bool = True):
+        self.chat_gpt = chat_gpt
+        self.workers = max(workers, 1)
+        self.ordered = ordered
+        self.window = self.workers * 4  # 已提交但尚未输出的请求上限
+        self.base_messages = [dict(message) for message in chat_gpt.messages]
+        self.report = BatchReport()
+
+    @staticmethod
+    def parse_line(index: int, line: str) -> Dict:
+        '''每行一个 JSON：字符串即提问内容，对象可以包含 id / prompt / messages / system / model / temperature'''
+        item = json.loads(line)
+        if isinstance(item, str):
+            item = {"prompt": item}
+        if not isinstance(item, dict) or not ("prompt" in item or "messages" in item):
+            raise ValueError("expected a string or an object with `prompt` or `messages`")
+        item.setdefault("id", index)
+        return item
+
+    def build_request(self, item: Dict) -> Dict:
+        if "messages" in item:
+            messages = list(item["messages"])
+        else:
+            messages = [dict(message) for message in self.base_messages]
+            messages.append({"role": "user", "content": item["prompt"]})
+        if "system" in item:
+            messages = [message for message in messages if message["role"] != "system"]
+            messages.insert(0, {"role": "system", "content": item["system"]})
+        return {
+            "model": item.get("model", self.chat_gpt.model),
+            "messages": messages,
+            "temperature": item.get("temperature", self.chat_gpt.temperature)
+        }
+
+    def run_one(self, index: int, item: Dict) -> Dict:
+        result = {"index": index, "id": item["id"], "content": None, "finish_reason": None,
+                  "usage": None, "latency": 0.0, "cached": False, "error": None}
+        chat_gpt = self.chat_gpt
+        start = time.perf_counter()
+        data = None
+        try:
+            data = self.build_request(item)
+            cached_message = chat_gpt.response_cache.get(data)
+            if cached_message:
+                result["content"] = cached_message["content"]
+                result["cached"] = True
+            elif not chat_gpt.check_budget(quiet=True):
+                result["error"] = "Hard budget reached"
+            else:
+                self.request(data, result)
+        except (requests.exceptions.RequestException, ValueError, KeyError, IndexError, TypeError) as e:
+            result["error"] = str(e) or type(e).__name__
+        result["latency"] = round(time.perf_counter() - start, 4)
+        if result["cached"]:
+            chat_gpt.add_usage(0, 0, data["model"], kind="batch", cached=True)
+        elif result["usage"]:
+            chat_gpt.add_usage(result["usage"].get("prompt_tokens", 0), result["usage"].get("completion_tokens", 0),
+                               data["model"], result["latency"], "batch")
+        if result["error"]:
+            log.error(f"Batch request {item['id']} failed: {result['error']}")
+        return result
+
+    def request(self, data: Dict, result: Dict):
+        chat_gpt = self.chat_gpt
+        # 和其他后台请求一样经过 send_request_silent，/stats 和 --metrics-file 中记为 batch
+        response = chat_gpt.send_request_silent(data, kind="batch", on_error=lambda error: result.update(error=error))
+        if response is None:
+            return
+        chat_gpt.metrics.record(response.metrics)
+        response_json = response.json()
+        choice = response_json["choices"][0]
+        result["content"] = choice["message"]["content"]
+        result["finish_reason"] = choice.get("finish_reason")
+        result["usage"] = response_json.get("usage")
+        chat_gpt.response_cache.put(data, choice["message"], result["finish_reason"])
+
+    def results(self, lines: Iterable[str]) -> Iterator[Dict]:
+        '''按输入顺序（ordered）或完成顺序逐个返回结果'''
+        pending = set()
+        finished: Dict[int, Dict] = {}
+        next_index = 0      # ordered 模式下下一个要输出的序号
+        submitted = emitted = 0
+
+        def collect():
+            nonlocal pending
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                finished[result["index"]] = result
+
+        def ready() -> Iterator[Dict]:
+            nonlocal next_index, emitted
+            if self.ordered:
+                while next_index in finished:
+                    emitted += 1
+                    next_index += 1
+                    yield finished.pop(next_index - 1)
+            else:
+                for index in list(finished):
+                    emitted += 1
+                    yield finished.pop(index)
+
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="batch") as executor:
+            try:
+                for line in lines:
+                    if not line.strip():
+                        continue
+                    index = submitted
+                    submitted += 1
+                    try:
+                        item = self.parse_line(index, line)
+                    except ValueError as e:
+                        finished[index] = {"index": index, "id": index, "content": None, "finish_reason": None,
+                                           "usage": None, "latency": 0.0, "cached": False,
+                                           "error": f"Invalid input: {e}"}
+                    else:
+                        pending.add(executor.submit(self.run_one, index, item))
+                    yield from ready()
+                    while submitted - emitted >= self.window:
+                        collect()
+                        yield from ready()
+                while pending or finished:
+                    if pending:
+                        collect()
+                    yield from ready()
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+
+    def run(self, lines: Iterable[str], output: TextIO) -> BatchReport:
+        try:
+            for result in self.results(lines):
+                self.report.add(result)
+                del result["index"]
+                output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                output.flush()
+        finally:
+            self.report.finish()
+        return self.report
+
+
+def run_batch(chat_gpt, source: str, workers: int, ordered: bool = True, output: Optional[TextIO] = None) -> int:
+    '''`--batch FILE|-`：结果以 JSONL 写到 stdout，汇总报告写到 stderr，有失败的请求时返回 1，读不到输入文件时返回 2'''
+    output = output or sys.stdout
+    if not chat_gpt.check_budget():
+        return 1
+    runner = BatchRunner(chat_gpt, workers, ordered)
+    log.info(f"Batch mode: {source}, {runner.workers} workers, {'input' if ordered else 'completion'} order")
+    try:
+        input_file = sys.stdin if source == "-" else open(source, encoding="utf-8")
+    except OSError as e:
+        # 和 --load 一样给出提示，不打印 traceback
+        log.error(f"Batch input {source}: {e}")
+        print(_("gpt_term.batch_open_error", file_path=source, error=e.strerror or str(e)), file=sys.stderr)
+        return 2
+    try:
+        report = runner.run(input_file, output)
+    except KeyboardInterrupt:
+        report = runner.report
+        print(_("gpt_term.batch_aborted"), file=sys.stderr)
+    except BrokenPipeError:
+        # 下游关闭了管道，剩余结果无处可写
+        report = runner.report
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        print(report.format(), file=sys.stderr)
+        return 1
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+    print(report.format(), file=sys.stderr)
+    log.info(f"Batch finished: {report.succeeded} succeeded, {report.failed} failed in {report.elapsed:.2f}s")
+    return 1 if report.failed else 0
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+log = logging.getLogger("chat")
+
+
+def request_key(data: Dict) -> str:
+    '''请求体的内容哈希；是否流式（以及流式选项）不影响回答，不参与计算'''
+    body = {key: value for key, value in data.items() if key not in ("stream", "stream_options")}
+    return hashlib.sha256(json.dumps(body, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+def iter_cached_content(content: str, size: int = 64) -> Iterator[str]:
+    '''把缓存的回答切成小段，像流式回复一样交给渲染器'''
+    for start in range(0, len(content), size):
+        yield content[start:start + size]
+
+
+class ResponseCache:
+    '''Opt-in on-disk cache of complete replies, content-addressed by request body.
+
+    Every entry is one JSON file named after `request_key(data)`. Entries
+    older than `ttl` seconds are treated as misses and removed; when the
+    directory grows beyond `max_bytes` the least recently used entries (by
+    file mtime, refreshed on every hit) are evicted. The directory is only
+    scanned on first use, so a disabled cache costs nothing.'''
+
+    def __init__(self, directory: Path, enabled: bool = False, max_bytes: int = 50 * 1024 * 1024,
+                 ttl: float = 7 * 86400):
+        self.directory = Path(directory)
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.index: Optional[Dict[str, list]] = None    # key -> [size, last_used]
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def load_index(self):
+        if self.index is not None:
+            return
+        self.index = {}
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                self.index[entry.name[:-5]] = [stat.st_size, stat.st_mtime]
+                self.size += stat.st_size
+
+    def get(self, data: Dict) -> Optional[Dict[str, str]]:
+        '''返回缓存的回答 message，未命中时返回 None'''
+        if not self.enabled:
+            return None
+        key = request_key(data)
+        with self.lock:
+            self.load_index()
+            entry = None
+            if key in self.index:
+                try:
+                    with open(self.path(key), encoding="utf-8") as f:
+                        entry = json.load(f)
+                except (OSError, ValueError):
+                    self.remove(key)
+            if entry and time.time() - entry["created"] > self.ttl:
+                self.remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            now = time.time()
+            self.index[key][1] = now
+            os.utime(self.path(key), (now, now))
+        log.debug(f"Response cache hit: {key}")
+        return entry["message"]
+
+    def put(self, data: Dict, message: Dict[str, str], finish_reason: Optional[str]):
+        '''缓存回答；只缓存正常结束（finish_reason 为 stop）的回答，被中断、出错或因长度截断的回答不缓存'''
+        if not self.enabled or not message.get("content"):
+            return
+        if finish_reason != "stop":
+            log.debug(f"Response cache: not caching a reply that ended with {finish_reason}")
+            return
+        key = request_key(data)
+        content = json.dumps({"created": time.time(), "model": data.get("model"), "message": message},
+                             ensure_ascii=False).encode()
+        with self.lock:
+            self.load_index()
+            self.remove(key)
+            path = self.path(key)
+            tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(content)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                log.error(f"Failed to write response cache: {e}")
+                return
+            self.index[key] = [len(content), time.time()]
+            self.size += len(content)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def remove(self, key: str):
+        self.size -= self.index.pop(key, (0, 0))[0]
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        '''按最近使用时间淘汰，直到总大小降到上限的 90%'''
+        for key in sorted(self.index, key=lambda key: self.index[key][1]):
+            if self.size <= self.max_bytes * 0.9:
+                break
+            self.remove(key)
+        log.debug(f"Response cache evicted to {self.size} bytes")
@@ -0,0 +1,188 @@
+import re
+import threading
+from array import array
+from typing import List, Optional, Tuple
+
+from .store import MessageStore
+
+# 和渲染器不同，缩进的代码块（例如列表项中的代码）也算在内，复制时和之前的实现一样保留原来的缩进
+FENCE_RE = re.compile(r'^[ \t]*(`{3,}|~{3,})')
+
+# 写入文件时代码块语言对应的扩展名，不在这里的语言直接用语言名
+EXTENSIONS = {
+    "python": "py", "python3": "py", "py": "py", "javascript": "js", "js": "js", "jsx": "jsx",
+    "typescript": "ts", "ts": "ts", "tsx": "tsx", "bash": "sh", "sh": "sh", "shell": "sh", "zsh": "sh",
+    "console": "sh", "powershell": "ps1", "ps1": "ps1", "batch": "bat", "bat": "bat", "cmd": "bat",
+    "c": "c", "cpp": "cpp", "c++": "cpp", "csharp": "cs", "c#": "cs", "cs": "cs", "java": "java",
+    "kotlin": "kt", "go": "go", "golang": "go", "rust": "rs", "ruby": "rb", "perl": "pl", "lua": "lua",
+    "markdown": "md", "md": "md", "yaml": "yml", "yml": "yml", "text": "txt", "plaintext": "txt",
+    "dockerfile": "dockerfile", "makefile": "mk",
+}
+
+
+def extension(language: str) -> str:
+    '''代码块语言对应的文件扩展名，没有语言或语言名不能用作扩展名时为 txt'''
+    language = language.lower()
+    if language in EXTENSIONS:
+        return EXTENSIONS[language]
+    return language if language.isalnum() and len(language) <= 10 else "txt"
+
+
+class CodeBlock:
+    '''一个代码块：所在的消息、语言，以及代码在消息内容中的位置（不含围栏）'''
+    __slots__ = ("message", "language", "start", "end")
+
+    def __init__(self, language: str, start: int, end: int, message: int = None):
+        self.message = message      # 消息在对话中的位置，由 CodeBlockIndex 填入
+        self.language = language
+        self.start = start
+        self.end = end
+
+
+class CodeBlockScanner:
+    '''Finds the fenced code blocks of a message while it is streamed.
+
+    Fed the same deltas as the renderer, it only looks at each completed
+    line once and keeps nothing but the unfinished last line, so the blocks
+    of a reply (their language and where their code starts and ends in the
+    reply) are known the moment it has been received. A fence is closed by
+    a line of the same character at least as long as the opening one, as
+    in the renderer; a block still open at the end runs to the end of the
+    message.'''
+
+    def __init__(self):
+        self.blocks: List[CodeBlock] = []
+        self.scanned = 0        # 已经扫描过的完整行之后的位置
+        self.partial = ""       # 还没有收到换行的最后一行
+        self.fence = None       # 代码块中时为开始的围栏
+        self.language = ""
+        self.start = 0
+
+    def feed(self, content: str):
+        text = self.partial + content
+        newline = text.rfind('\n')
+        if newline == -1:
+            self.partial = text
+            return
+        position = self.scanned
+        for line in text[:newline].split('\n'):
+            self.scan_line(line, position)
+            position += len(line) + 1
+        self.scanned = position
+        self.partial = text[newline + 1:]
+
+    def scan_line(self, line: str, position: int):
+        if self.fence:
+            marker = line.strip()
+            if marker.startswith(self.fence) and not marker.strip(self.fence[0]):
+                # 代码不包括结束围栏前的换行
+                self.blocks.append(CodeBlock(self.language, self.start, max(position - 1, self.start)))
+                self.fence = None
+            return
+        fence = FENCE_RE.match(line)
+        if fence is None:
+            return
+        info = line[fence.end():].strip()
+        if fence.group(1)[0] == '`' and '`' in info:
+            # ```code``` 这样的行内代码不是代码块
+            return
+        self.fence = fence.group(1)
+        self.language = info.split(maxsplit=1)[0] if info else ""
+        self.start = position + len(line) + 1
+
+    def finish(self) -> List[CodeBlock]:
+        '''消息结束：扫描最后一行，没有结束的代码块到消息末尾为止'''
+        if self.partial:
+            self.scan_line(self.partial, self.scanned)
+            self.scanned += len(self.partial)
+            self.partial = ""
+        if self.fence:
+            self.blocks.append(CodeBlock(self.language, min(self.start, self.scanned), self.scanned))
+            self.fence = None
+        return self.blocks
+
+
+def scan(content: str) -> List[CodeBlock]:
+    scanner = CodeBlockScanner()
+    scanner.feed(content)
+    return scanner.finish()
+
+
+class CodeBlockIndex:
+    '''The code blocks of every reply in one conversation, numbered in order.
+
+    Replies streamed by `render_stream` arrive with their blocks already
+    found by a `CodeBlockScanner` and are indexed without being read again;
+    any other reply (loaded history, cached or background replies, non
+    stream mode) is scanned once, when it is added or first looked up. Like the relevance
+    index it follows the `MessageStore` by message id, so undoing or
+    deleting messages only drops their blocks, and `/copy code` and
+    `/extract` look blocks up instead of searching every reply. Only the
+    positions of the code are kept; the code itself is sliced out of the
+    message when it is copied or written.'''
+
+    def __init__(self):
+        self.ids = array('q')               # 已经索引的消息（MessageStore 的 ids）
+        self.starts = array('q')            # 每条消息第一个代码块在 blocks 中的位置
+        self.blocks: List[CodeBlock] = []
+        self.streamed: Optional[Tuple[str, List[CodeBlock]]] = None    # 最后一次流式接收的回答和它的代码块
+        self.lock = threading.Lock()        # 后台会话在线程池中加入回答
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def stream(self, reply: str, blocks: List[CodeBlock]):
+        '''记录流式接收时已经找到的代码块，回答加入对话时直接使用'''
+        self.streamed = (reply, blocks)
+
+    def sync(self, messages: MessageStore):
+        '''让索引和 messages 一致，只扫描新加入的回答'''
+        with self.lock:
+            count = len(self.ids)
+            if messages.ids[:count] != self.ids:
+                common = 0
+                limit = min(count, len(messages))
+                while common < limit and self.ids[common] == messages.ids[common]:
+                    common += 1
+                self.truncate(common)
+            for index in range(len(self.ids), len(messages)):
+                self.add(index, messages)
+
+    def append(self, messages: MessageStore):
+        '''messages 刚加入了一条消息：索引和之前的消息一致时直接加入它，否则留给下一次 sync'''
+        with self.lock:
+            count = len(self.ids)
+            if count == len(messages) - 1 and messages.ids[:count] == self.ids:
+                self.add(count, messages)
+
+    def add(self, index: int, messages: MessageStore):
+        self.ids.append(messages.ids[index])
+        self.starts.append(len(self.blocks))
+        if messages.roles[index] != 'assistant':
+            return
+        content = messages[index]['content']
+        if self.streamed is not None and self.streamed[0] is content:
+            blocks = self.streamed[1]
+            self.streamed = None
+        else:
+            blocks = scan(content)
+        for block in blocks:
+            block.message = index
+        self.blocks.extend(blocks)
+
+    def truncate(self, length: int):
+        if length < len(self.ids):
+            del self.blocks[self.starts[length]:]
+            del self.ids[length:], self.starts[length:]
+
+    def blocks_of(self, index: int) -> List[CodeBlock]:
+        '''messages[index] 中的代码块'''
+        if index < 0:
+            index += len(self.ids)
+        if not 0 <= index < len(self.ids):
+            return []
+        end = self.starts[index + 1] if index + 1 < len(self.ids) else len(self.blocks)
+        return self.blocks[self.starts[index]:end]
+
+    def code(self, messages: MessageStore, block: CodeBlock) -> str:
+        return messages[block.message]['content'][block.start:block.end]
@@ -0,0 +1,151 @@
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# 子命令补全为文件路径（只补全 .json 文件和文件夹），补全器在交互模式下才创建
+PATH_OPTIONS = "path"
+
+
+def edit_distance(s1: str, s2: str, limit: int = None) -> int:
+    '''Levenshtein 距离，只保留两行，不分配完整的矩阵。
+    给出 limit 时只计算对角线两侧 limit 宽的带，距离超过 limit 时返回 limit + 1'''
+    if len(s1) < len(s2):
+        s1, s2 = s2, s1
+    if limit is None:
+        limit = len(s1)
+    if len(s1) - len(s2) > limit:
+        return limit + 1
+    outside = limit + 1     # 带外的格子，距离一定超过 limit
+    previous = [j if j <= limit else outside for j in range(len(s2) + 1)]
+    for i in range(1, len(s1) + 1):
+        low = max(1, i - limit)
+        high = min(len(s2), i + limit)
+        current = [outside] * (len(s2) + 1)
+        current[0] = i if i <= limit else outside
+        c1 = s1[i - 1]
+        best = current[0]
+        for j in range(low, high + 1):
+            value = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (c1 != s2[j - 1]))
+            current[j] = value if value <= limit else outside
+            best = min(best, current[j])
+        if best > limit:
+            return outside
+        previous = current
+    return min(previous[-1], outside)
+
+
+class BKTree:
+    '''Burkhard-Keller tree of words under the edit distance.
+
+    Every child hangs off its parent by its distance to the parent's word,
+    so by the triangle inequality a search for words within `tolerance` of
+    a query only descends into children whose edge is within `tolerance` of
+    the query's distance to the node, instead of comparing the query with
+    every word.'''
+
+    def __init__(self, words: Iterable[str] = ()):
+        self.root: Optional[Tuple[str, Dict[int, tuple]]] = None
+        for word in words:
+            self.add(word)
+
+    def add(self, word: str):
+        if self.root is None:
+            self.root = (word, {})
+            return
+        node = self.root
+        while True:
+            distance = edit_distance(word, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (word, {})
+                return
+            node = child
+
+    def search(self, word: str, tolerance: int) -> List[Tuple[int, str]]:
+        '''和 word 的距离不超过 tolerance 的所有词，返回 (距离, 词)'''
+        found = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node_word, children = nodes.pop()
+            # 距离超过 tolerance 加最长的边时，这个词和所有子节点都不可能符合，不需要算出准确的距离
+            distance = edit_distance(word, node_word, tolerance + max(children, default=0))
+            if distance <= tolerance:
+                found.append((distance, node_word))
+            for edge, child in children.items():
+                if distance - tolerance <= edge <= distance + tolerance:
+                    nodes.append(child)
+        return found
+
+
+class Command:
+    '''一个斜杠命令：处理函数和补全用的子命令'''
+
+    def __init__(self, name: str, handler: Callable, options=None):
+        self.name = name
+        self.handler = handler
+        self.options = options      # 子命令的集合（或子命令到下一级子命令的 dict），PATH_OPTIONS，或 None
+
+
+class CommandRegistry:
+    '''Slash commands by name, registered by their handlers.
+
+    A handler registers itself with `@commands.register('/name', ...)` and
+    is dispatched with one dict lookup on the first word of the input. The
+    same registry serves the prompt: every prefix of every name is indexed,
+    so completing what is being typed is a single lookup no matter how many
+    commands there are, and a mistyped command is matched against a
+    BK-tree of the names instead of computing the edit distance to all of
+    them.'''
+
+    def __init__(self):
+        self.commands: Dict[str, Command] = {}
+        self.prefixes: Dict[str, List[str]] = {}    # 前缀 -> 以它开头的命令，按注册顺序
+        self.order: Dict[str, int] = {}
+        self.tree = BKTree()
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __iter__(self):
+        return iter(self.commands.values())
+
+    def register(self, *names: str, options=None):
+        '''注册处理函数的装饰器，names 为命令名和它的别名'''
+        def decorator(handler: Callable) -> Callable:
+            for name in names:
+                self.add(Command(name, handler, options))
+            return handler
+        return decorator
+
+    def add(self, command: Command):
+        if command.name not in self.commands:
+            self.order[command.name] = len(self.order)
+            for end in range(1, len(command.name) + 1):
+                self.prefixes.setdefault(command.name[:end], []).append(command.name)
+            self.tree.add(command.name)
+        self.commands[command.name] = command
+
+    def get(self, command: str) -> Optional[Command]:
+        '''按输入的第一个词找到命令'''
+        words = command.split(maxsplit=1)
+        return self.commands.get(words[0]) if words else None
+
+    def complete(self, prefix: str) -> List[str]:
+        return self.prefixes.get(prefix, [])
+
+    def suggest(self, command: str) -> Optional[str]:
+        '''和输入的命令最接近的命令名：编辑距离不超过命令名长度的一半（最多 3），且两者的字符集合足够相似'''
+        words = command.split(maxsplit=1)
+        if not words:
+            return None
+        name = words[0]
+        characters = set(name)
+        candidates = sorted(self.tree.search(name, min(max(len(name) // 2, 1), 3)),
+                            key=lambda item: (item[0], self.order[item[1]]))
+        for _distance, candidate in candidates:
+            if len(characters & set(candidate)) / len(characters | set(candidate)) >= 0.75:
+                return candidate
+        return None
+
+
+commands = CommandRegistry()
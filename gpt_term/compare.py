@@ -0,0 +1,250 @@
+import json
+import logging
+import time
+from typing import Callable, Dict, List, Optional, TextIO
+
+import i18n
+import requests
+
+from .sse import StreamError, iter_stream_content
+from .tokens import count_usage
+
+log = logging.getLogger("chat")
+
+_ = i18n.t
+
+COMPARE_LAYOUTS = ['columns', 'sequential']
+# 每个模型一列时每列至少需要的宽度，终端更窄时改为逐个显示
+MIN_COLUMN_WIDTH = 32
+
+
+def parse_models(value: str) -> List[str]:
+    '''"gpt-4,gpt-3.5-turbo" -> ["gpt-4", "gpt-3.5-turbo"]，去掉空项和重复项'''
+    models = []
+    for model in value.split(","):
+        model = model.strip()
+        if model and model not in models:
+            models.append(model)
+    return models
+
+
+class ModelRun:
+    '''一个模型的回答和耗时统计'''
+
+    def __init__(self, model: str):
+        self.model = model
+        self.reply = ""
+        self.error: Optional[str] = None
+        self.start = 0.0
+        self.first_token_at: Optional[float] = None
+        self.end: Optional[float] = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.aborted = False
+
+    @property
+    def done(self) -> bool:
+        return self.end is not None
+
+    @property
+    def ttft(self) -> Optional[float]:
+        '''time to first token'''
+        return self.first_token_at - self.start if self.first_token_at is not None else None
+
+    @property
+    def latency(self) -> Optional[float]:
+        return self.end - self.start if self.end is not None else None
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        '''首个 token 之后的生成速度'''
+        if self.end is None or self.first_token_at is None or self.end <= self.first_token_at:
+            return None
+        return self.completion_tokens / (self.end - self.first_token_at)
+
+    def summary(self) -> Dict:
+        return {
+            "model": self.model,
+            "ttft": round(self.ttft, 4) if self.ttft is not None else None,
+            "tokens_per_second": round(self.tokens_per_second, 2) if self.tokens_per_second is not None else None,
+            "latency": round(self.latency, 4) if self.latency is not None else None,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "error": self.error,
+        }
+
+
+class ModelComparison:
+    '''Send the same messages to several models at once and time every reply.
+
+    Each model is a task on the shared event loop, all of them stream
+    concurrently through the pooled transport. For every model the time to
+    the first content token, the generation speed after it, the total
+    latency and the prompt/completion token counts are recorded. The
+    response cache is bypassed, the point is to measure the models. Nothing
+    is added to `chat_gpt.messages` here.'''
+
+    def __init__(self, chat_gpt, models: List[str], messages: List[Dict[str, str]]):
+        self.chat_gpt = chat_gpt
+        self.messages = messages
+        self.runs = [ModelRun(model) for model in models]
+        self.aborted = False
+
+    async def run(self, on_update: Callable[[List[ModelRun]], None] = None, interval: float = 0.1):
+        '''并发运行所有模型，运行期间每隔 interval 秒和每个模型完成时调用 on_update。
+        被取消时中断所有请求，保留已经收到的部分'''
+        import asyncio
+
+        tasks = [asyncio.ensure_future(self.run_model(run)) for run in self.runs]
+        try:
+            pending = set(tasks)
+            while pending:
+                _done, pending = await asyncio.wait(pending, timeout=interval, return_when=asyncio.FIRST_COMPLETED)
+                if on_update:
+                    on_update(self.runs)
+        except asyncio.CancelledError:
+            self.aborted = True
+            for task in tasks:
+                task.cancel()
+            await asyncio.wait(tasks)
+            if on_update:
+                on_update(self.runs)
+        return self.runs
+
+    async def run_model(self, run: ModelRun):
+        import asyncio
+
+        from .aio import iter_in_thread, to_thread
+
+        chat_gpt = self.chat_gpt
+        data = chat_gpt.request_data(self.messages, stream=True, model=run.model)
+        turn = chat_gpt.metrics.start("compare", run.model, True)
+        run.start = time.perf_counter()
+        response = None
+        finished = False
+        try:
+            response = await to_thread(
+                chat_gpt.transport.post, chat_gpt.endpoint, headers=chat_gpt.headers, data=json.dumps(data),
+                timeout=chat_gpt.timeout, stream=True, cleanup=lambda late_response: late_response.close())
+            turn.response_received(response)
+            if response.status_code // 100 == 4:
+                run.error = response.json()['error']['message']
+                return
+            response.raise_for_status()
+            async for content in iter_in_thread(iter_stream_content(response), response.close):
+                if run.first_token_at is None:
+                    run.first_token_at = time.perf_counter()
+                turn.content_received()
+                run.reply += content
+            finished = True
+        except asyncio.CancelledError:
+            run.aborted = True
+        except requests.exceptions.ReadTimeout:
+            run.error = f"Request timed out after {chat_gpt.timeout}s"
+        except (requests.exceptions.RequestException, StreamError, ValueError, KeyError, IndexError) as e:
+            run.error = str(e) or type(e).__name__
+        finally:
+            run.end = time.perf_counter()
+            turn.finish("aborted" if run.aborted else "error" if run.error else None)
+            if response is not None:
+                if finished:
+                    await to_thread(chat_gpt.transport.release, response)
+                else:
+                    chat_gpt.transport.release(response, drain=False)
+        if run.reply:
+            tokenize_start = time.perf_counter()
+            run.prompt_tokens, run.completion_tokens = count_usage(
+                getattr(response, "usage", None), self.messages, run.reply, run.model)
+            turn.tokenize = time.perf_counter() - tokenize_start
+            turn.completion_tokens = run.completion_tokens
+            chat_gpt.add_usage(run.prompt_tokens, run.completion_tokens, run.model, run.latency, "compare")
+        chat_gpt.metrics.record(turn)
+        if run.error:
+            log.error(f"Compare {run.model} failed: {run.error}")
+        else:
+            log.info(f"Compare {run.model}: {run.summary()}")
+
+
+def format_seconds(value: Optional[float]) -> str:
+    return f"{value:.2f}s" if value is not None else "-"
+
+
+def format_rate(value: Optional[float]) -> str:
+    return f"{value:.1f}" if value is not None else "-"
+
+
+def stats_table(runs: List[ModelRun]):
+    '''每个模型的 TTFT、生成速度、总耗时和 token 数'''
+    from rich.markup import escape
+    from rich.table import Table
+
+    table = Table(title=_("gpt_term.compare_title"), title_justify="left")
+    table.add_column("#", justify="right", style="dim")
+    table.add_column(_("gpt_term.compare_model"), style="bold cyan")
+    table.add_column("TTFT", justify="right")
+    table.add_column(_("gpt_term.compare_tps"), justify="right")
+    table.add_column(_("gpt_term.compare_latency"), justify="right")
+    table.add_column(_("gpt_term.compare_tokens"), justify="right")
+    for index, run in enumerate(runs, 1):
+        if run.error:
+            table.add_row(str(index), run.model, f"[red]{escape(run.error)}", "", "", "")
+            continue
+        table.add_row(str(index), run.model, format_seconds(run.ttft), format_rate(run.tokens_per_second),
+                      format_seconds(run.latency), f"{run.prompt_tokens} + {run.completion_tokens}")
+    return table
+
+
+def reply_panel(run: ModelRun, markdown: bool):
+    from rich.markdown import Markdown
+    from rich.panel import Panel
+    from rich.text import Text
+
+    if run.error:
+        body = Text(run.error, style="red")
+    elif markdown:
+        body = Markdown(run.reply)
+    else:
+        body = Text(run.reply)
+    subtitle = None
+    if run.done and not run.error:
+        subtitle = f"TTFT {format_seconds(run.ttft)} · {format_rate(run.tokens_per_second)} tok/s · {format_seconds(run.latency)}"
+    return Panel(body, title=f"[bold cyan]{run.model}", title_align="left", subtitle=subtitle, subtitle_align="right")
+
+
+def columns_view(runs: List[ModelRun], raw: bool = False):
+    '''每个模型一列，回答完成后按 Markdown 显示'''
+    from rich.table import Table
+
+    grid = Table.grid(expand=True, padding=(0, 1))
+    for _run in runs:
+        grid.add_column(ratio=1)
+    grid.add_row(*[reply_panel(run, markdown=run.done and not raw) for run in runs])
+    return grid
+
+
+def progress_view(runs: List[ModelRun]):
+    '''逐个显示时，还没有完成的模型各占一行进度'''
+    from rich.spinner import Spinner
+    from rich.table import Table
+
+    grid = Table.grid(padding=(0, 1))
+    for run in runs:
+        if not run.done:
+            grid.add_row(Spinner("dots"), f"[bold cyan]{run.model}[/]", f"[dim]{len(run.reply)} chars")
+    return grid
+
+
+def write_comparison(runs: List[ModelRun], output: TextIO, report: TextIO):
+    '''管道模式：各模型的回答依次以 Markdown 小节写到 output，统计写到 report'''
+    for run in runs:
+        if run.error and not run.reply:
+            continue
+        output.write(f"## {run.model}\n\n{run.reply}\n\n")
+    output.flush()
+    for run in runs:
+        if run.error:
+            print(_("gpt_term.compare_failed", model=run.model, error=run.error), file=report)
+        else:
+            print(_("gpt_term.compare_report", model=run.model, ttft=format_seconds(run.ttft),
+                    tps=format_rate(run.tokens_per_second), latency=format_seconds(run.latency),
+                    prompt_tokens=run.prompt_tokens, completion_tokens=run.completion_tokens), file=report)
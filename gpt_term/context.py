@@ -0,0 +1,220 @@
+import logging
+import math
+import threading
+from typing import Dict, List, Optional
+
+from .relevance import RelevanceIndex
+from .store import MessageStore
+from .tokens import count_message_tokens
+
+log = logging.getLogger("chat")
+
+CONTEXT_POLICIES = ['off', 'sliding', 'last', 'summarize', 'relevant']
+
+SUMMARY_PROMPT = ("Summarize the following earlier part of a conversation between a user and an assistant "
+                  "in the conversation's language. Keep facts, decisions, names, numbers and code identifiers "
+                  "that later messages may refer to. Reply with the summary only.")
+
+
+class ContextPolicy:
+    '''Choose which messages of the history are sent with each request.
+
+    The history itself (`ChatGPT.messages`, what `/save` writes) is never
+    changed; only the request payload is trimmed so that it stays within
+    `budget` tokens, using the per-message counts of the token ledger:
+
+    - `sliding`: system prompt plus as many of the latest turns as fit
+    - `last`: system prompt plus at most `keep_turns` latest turns, and within budget
+    - `summarize`: like `sliding`, but turns that no longer fit are summarized
+      in a background task and the summary is sent in their place
+    - `relevant`: like `last`, plus the `relevant_turns` earlier turns that
+      score best for the new question in a local BM25 index, as far as they fit
+    - `off`: always send everything
+
+    `budget` is a fraction of the model's tokens limit when <= 1, otherwise
+    an absolute number of tokens.'''
+
+    def __init__(self, mode: str = 'sliding', budget: float = 0.8, keep_turns: int = 10, relevant_turns: int = 4):
+        self.mode = mode if mode in CONTEXT_POLICIES else 'sliding'
+        self.budget = budget
+        self.keep_turns = max(keep_turns, 1)
+        self.relevant_turns = max(relevant_turns, 0)
+        self.dropped = 0            # 上一次请求没有发送的消息数
+        self.dropped_tokens = 0
+        self.recalled = 0           # 上一次请求按相关性发送的较早消息数
+        self.index = RelevanceIndex()
+        self.summary: Optional[Dict[str, str]] = None
+        self.summary_tokens = 0
+        self.summarized: List[int] = []   # summary 概括了哪些消息（MessageStore 的 ids）
+        self.summary_task = None          # 在共享事件循环中生成 summary 的任务
+        self.lock = threading.Lock()
+
+    def budget_tokens(self, tokens_limit: float) -> Optional[int]:
+        if self.budget > 1:
+            return int(self.budget)
+        if math.isnan(tokens_limit):
+            return None
+        return int(tokens_limit * self.budget)
+
+    def apply(self, chat_gpt) -> List[Dict[str, str]]:
+        '''返回本次请求要发送的 messages'''
+        messages = chat_gpt.messages
+        self.dropped = self.dropped_tokens = self.recalled = 0
+        budget = self.budget_tokens(chat_gpt.tokens_limit)
+        if self.mode == 'off' or budget is None or len(messages) <= 2:
+            return messages[:]
+
+        # 只用消息记录里的角色和大小做选择，写入磁盘的正文只在要发送时才读回
+        roles = messages.roles
+        head = 1 if roles[0] == 'system' else 0
+        start = head
+        if self.mode in ('last', 'relevant'):
+            turns = 0
+            for index in range(len(messages) - 1, head - 1, -1):
+                if roles[index] == 'user':
+                    turns += 1
+                    if turns == self.keep_turns:
+                        start = index
+                        break
+
+        # 每个 token 至少占一个字节，字节数没有超出预算时不需要加载分词器
+        if start == head and messages.size <= budget:
+            return messages[:]
+
+        counts = chat_gpt.token_ledger.message_counts()
+        start = self.slide(roles, counts, start, sum(counts[:head]) + sum(counts[start:]), budget)
+        summary = None
+        if self.mode == 'summarize' and start > head:
+            summary = self.valid_summary(messages, head, start)
+            if summary:
+                start = self.slide(roles, counts, start, sum(counts[:head]) + sum(counts[start:]) + self.summary_tokens, budget)
+        if start == head:
+            return messages[:]
+
+        recalled: List[int] = []
+        if self.mode == 'relevant':
+            recalled = self.recall(messages, counts, head, start, budget - sum(counts[:head]) - sum(counts[start:]))
+        self.recalled = len(recalled)
+        self.dropped = start - head - len(recalled)
+        self.dropped_tokens = sum(counts[head:start]) - sum(counts[index] for index in recalled)
+        if self.mode == 'summarize' and len(self.summarized) < self.dropped:
+            self.summarize_background(chat_gpt, head, counts[head:start])
+        log.debug(f"Context policy '{self.mode}': {self.dropped} earlier messages ({self.dropped_tokens} tokens) not sent"
+                  f"{', summary included' if summary else ''}"
+                  f"{f', {self.recalled} relevant earlier messages included' if recalled else ''}")
+        return messages[:head] + ([summary] if summary else []) + [messages[index] for index in recalled] + messages[start:]
+
+    @staticmethod
+    def slide(roles: List[str], counts: List[int], start: int, used: int, budget: int) -> int:
+        '''向后移动起点直到 messages[start:] 不超出预算，最后一条消息总是保留'''
+        while used > budget and start < len(roles) - 1:
+            used -= counts[start]
+            start += 1
+        # 从完整的一轮对话开始，不以孤立的回答开头
+        while start < len(roles) - 1 and roles[start] != 'user':
+            start += 1
+        return start
+
+    def recall(self, messages: MessageStore, counts: List[int], head: int, start: int, room: int) -> List[int]:
+        '''messages[head:start] 中和最后一条消息（新的问题）最相关的 relevant_turns 轮对话，
+        一轮对话整体选择，总共不超过 room 个 token；返回按原来顺序排列的消息序号'''
+        if not self.relevant_turns or room <= 0:
+            return []
+        self.index.sync(messages)
+        scores = self.index.scores(str(messages[-1].get('content') or ''), start)
+        if not scores:
+            return []
+        # 每一轮从用户的问题开始，到下一个问题之前为止
+        turns: List[List[int]] = []
+        for index in range(head, start):
+            if not turns or messages.roles[index] == 'user':
+                turns.append([])
+            turns[-1].append(index)
+        ranked = sorted(((sum(scores.get(index, 0.0) for index in turn), turn) for turn in turns),
+                        key=lambda item: item[0], reverse=True)
+        selected: List[int] = []
+        chosen = 0
+        for score, turn in ranked:
+            if score <= 0 or chosen == self.relevant_turns:
+                break
+            tokens = sum(counts[index] for index in turn)
+            if tokens <= room:
+                selected += turn
+                room -= tokens
+                chosen += 1
+        return sorted(selected)
+
+    def valid_summary(self, messages: MessageStore, head: int, start: int) -> Optional[Dict[str, str]]:
+        '''summary 概括的消息仍是历史记录的开头（没有被撤销或删除），且都不在本次发送范围内'''
+        with self.lock:
+            if not self.summary or len(self.summarized) > start - head:
+                return None
+            if messages.ids[head:head + len(self.summarized)].tolist() != self.summarized:
+                self.summary, self.summarized, self.summary_tokens = None, [], 0
+                return None
+            return self.summary
+
+    def summarize_background(self, chat_gpt, head: int, counts: List[int]):
+        '''在共享的事件循环中概括从 head 开始、没有发送的消息，counts 是它们的 token 数'''
+        with self.lock:
+            if self.summary_task and not self.summary_task.done():
+                return
+            previous = self.summary['content'] if self.summary else None
+            done = len(self.summarized)
+            # 一次只概括不超过模型上限一半的内容，剩余部分在后续请求中继续
+            limit = chat_gpt.tokens_limit / 2
+            end, size = done, 0
+            while end < len(counts):
+                size += counts[end]
+                if size > limit and end > done:
+                    break
+                end += 1
+            messages = chat_gpt.messages
+            self.summary_task = chat_gpt.aio.submit(self.summarize(chat_gpt, messages.ids[head:head + end].tolist(),
+                                                                   messages[head + done:head + end], previous))
+
+    def cancel_summary(self):
+        '''丢弃 summary 并取消正在进行的概括，概括请求的连接会被断开'''
+        with self.lock:
+            if self.summary_task and not self.summary_task.done():
+                self.summary_task.cancel()
+            self.summary_task = None
+            self.summary, self.summarized, self.summary_tokens = None, [], 0
+
+    async def summarize(self, chat_gpt, covered: List[int], new: List[Dict[str, str]], previous: Optional[str]):
+        import asyncio
+
+        from .aio import to_thread
+        transcript = "\n\n".join(f"{message['role']}: {message['content']}" for message in new)
+        if previous:
+            transcript = f"Summary so far:\n{previous}\n\nConversation:\n{transcript}"
+        data = {
+            "model": chat_gpt.model,
+            "messages": [{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": transcript}],
+            "temperature": 0.3
+        }
+        try:
+            if not chat_gpt.check_budget(quiet=True):
+                return
+            response = await to_thread(chat_gpt.send_request_silent, data, kind="summary",
+                                       cleanup=lambda late_response: late_response.close())
+            if response is None:
+                return
+            response_json = response.json()
+            chat_gpt.metrics.record(response.metrics)
+            content = response_json["choices"][0]["message"]["content"]
+            summary = {"role": "system", "content": f"Summary of the earlier conversation:\n{content}"}
+            tokens = count_message_tokens(summary, chat_gpt.model)
+            if response_json.get("usage"):
+                chat_gpt.add_usage(response_json["usage"].get("prompt_tokens", 0),
+                                   response_json["usage"].get("completion_tokens", 0), data["model"],
+                                   response.metrics.latency, "summary")
+            with self.lock:
+                self.summary, self.summarized, self.summary_tokens = summary, covered, tokens
+            log.debug(f"Context summary updated, covers {len(covered)} messages in {tokens} tokens")
+        except asyncio.CancelledError:
+            # Python 3.7 中 CancelledError 还是 Exception 的子类
+            log.debug("Context summary cancelled")
+            raise
+        except Exception as e:
+            log.exception(e)
@@ -0,0 +1,90 @@
+import os
+
+import i18n
+from prompt_toolkit.completion import (Completer, Completion, NestedCompleter,
+                                       PathCompleter)
+from prompt_toolkit.styles import Style
+from prompt_toolkit.validation import ValidationError, Validator
+
+from .commands import PATH_OPTIONS, CommandRegistry, commands
+
+# 交互模式才需要的 prompt_toolkit 组件，管道模式下不会导入本模块
+_ = i18n.t
+
+style = Style.from_dict({
+    "prompt": "ansigreen",  # 将提示符设置为绿色
+})
+
+
+class CommandCompleter(Completer):
+    '''Completes slash commands from the command registry.
+
+    The command name is looked up in the registry's prefix index, so a
+    keystroke costs one dict lookup however many commands are registered;
+    input that does not start with `/` (e.g. a large paste) is not looked
+    at. Subcommands are completed by a `NestedCompleter` built from the
+    registered options, rebuilt only when commands were added.'''
+
+    def __init__(self, registry: CommandRegistry = commands):
+        self.registry = registry
+        self._nested_completer = None
+        self._nested_size = 0
+
+    @property
+    def nested_completer(self) -> NestedCompleter:
+        if self._nested_completer is None or self._nested_size != len(self.registry):
+            options = {}
+            for command in self.registry:
+                if command.options == PATH_OPTIONS:
+                    options[command.name] = PathCompleter(file_filter=self.path_filter)
+                elif isinstance(command.options, dict):
+                    options[command.name] = command.options
+                else:
+                    options[command.name] = set(command.options) if command.options else None
+            self._nested_completer = NestedCompleter.from_nested_dict(options)
+            self._nested_size = len(self.registry)
+        return self._nested_completer
+
+    def path_filter(self, filename):
+        # 路径自动补全，只补全json文件和文件夹
+        return filename.endswith(".json") or os.path.isdir(filename)
+
+    def get_completions(self, document, complete_event):
+        text = document.text_before_cursor
+        if not text.startswith('/'):
+            return
+        if ' ' in text:
+            # 补全子命令
+            yield from self.nested_completer.get_completions(document, complete_event)
+            return
+        for name in self.registry.complete(text):
+            yield Completion(name, start_position=-len(text))
+
+
+# 自定义命令补全，保证输入‘/’后继续显示补全
+command_completer = CommandCompleter()
+
+class NumberValidator(Validator):
+    def validate(self, document):
+        text = document.text
+        if not text.isdigit():
+            raise ValidationError(message=_("gpt_term.Error_input_int"),
+                                  cursor_position=len(text))
+
+class FloatRangeValidator(Validator):
+    def __init__(self, min_value=None, max_value=None):
+        self.min_value = min_value
+        self.max_value = max_value
+
+    def validate(self, document):
+        try:
+            value = float(document.text)
+        except ValueError:
+            raise ValidationError(message=_('gpt_term.Error_input_number'))
+
+        if self.min_value is not None and value < self.min_value:
+            raise ValidationError(message=_("gpt_term.Error_input_least",min_value=self.min_value))
+        if self.max_value is not None and value > self.max_value:
+            raise ValidationError(message=_("gpt_term.Error_input_most",max_value=self.max_value))
+        
+temperature_validator = FloatRangeValidator(min_value=0.0, max_value=2.0)
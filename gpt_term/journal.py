@@ -0,0 +1,235 @@
+import json
+import logging
+import os
+import re
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+log = logging.getLogger("chat")
+
+FSYNC_MODES = ['always', 'interval', 'never']
+
+
+def is_journal(file_path) -> bool:
+    return str(file_path).endswith(".jsonl")
+
+
+def iter_json_array(f, chunk_size: int = 65536) -> Iterator[Dict[str, str]]:
+    '''逐个解析 JSON 数组中的元素，不需要先把整个文件读进来'''
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    started = False
+    eof = False
+    read_size = chunk_size  # 元素被截断时每次加倍，解析很大的元素时不会从头重复解析太多次
+    while True:
+        # 跳过空白和分隔符
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if position >= len(buffer) and not eof:
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+        if not started:
+            if buffer[position:position + 1] != "[":
+                raise json.JSONDecodeError("Expecting '['", buffer, position)
+            started = True
+            position += 1
+            continue
+        if buffer[position:position + 1] == "]":
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # 元素被截断在块的边界上，读入更多内容
+            chunk = f.read(read_size)
+            read_size *= 2
+            eof = not chunk
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+        read_size = chunk_size
+        yield item
+        position = end
+
+
+def replay_journal(file_path, missing_base: Callable[[str, Exception], None] = None) -> List[Dict[str, str]]:
+    '''按记录重放日志，得到崩溃前的 messages；末尾写了一半的记录会被忽略。
+    作为起点的 JSON 文件读不到时调用 missing_base(文件, 异常)，只重放它之后的记录'''
+    messages: List[Dict[str, str]] = []
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                log.warning(f"Journal {file_path}: skipped incomplete record")
+                continue
+            op = record.get("op")
+            try:
+                if op == "append":
+                    messages.append(record["message"])
+                elif op == "pop":
+                    messages.pop(record["index"])
+                elif op == "update":
+                    messages[record["index"]] = record["message"]
+                elif op == "truncate":
+                    del messages[record["length"]:]
+                elif op == "reset":
+                    messages = record["messages"]
+                elif op == "base":
+                    messages = read_base(record, file_path, missing_base)
+            except IndexError:
+                # 起点文件读不到时，之后的记录可能指向不存在的消息
+                log.warning(f"Journal {file_path}: skipped {op} record of a message that is not there")
+    return messages
+
+
+def read_base(record: Dict, file_path, missing_base: Callable[[str, Exception], None] = None) -> List[Dict[str, str]]:
+    '''/save 之后的新日志以保存的 JSON 文件为起点，文件被移走或损坏时从空的历史开始'''
+    try:
+        with open(record["file"], 'r', encoding='utf-8') as base:
+            return json.load(base)[:record["length"]]
+    except (OSError, ValueError) as e:
+        log.error(f"Journal {file_path}: cannot read the saved chat history {record['file']}: {e}")
+        if missing_base is not None:
+            missing_base(record["file"], e)
+        return []
+
+
+def lock_file(f) -> bool:
+    '''给打开的文件加排他锁，不等待；已经被其他进程（或本进程另一次打开）锁住时返回 False'''
+    try:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+
+def journal_in_use(path: Path) -> bool:
+    '''日志是否正被某个会话写入，写入的会话一直持有它的锁，进程退出后锁自动释放'''
+    try:
+        with open(path, 'rb') as f:
+            return not lock_file(f)
+    except OSError:
+        return False
+
+
+def find_leftover_journal(directory: Path) -> Optional[Path]:
+    '''上次没有正常退出的会话留下的最新日志；同时运行的其他 gpt-term（和本进程）正在写入的日志不算'''
+    if not directory.is_dir():
+        return None
+    journals = sorted(directory.glob("session_*.jsonl"), key=lambda path: path.stat().st_mtime, reverse=True)
+    for journal in journals:
+        if not journal_in_use(journal):
+            return journal
+    return None
+
+
+class SessionJournal:
+    '''Append-only JSONL journal of every change made to `ChatGPT.messages`.
+
+    Each message is written once, when it is appended; undo, delete, reset
+    and system prompt edits are small records of their own. `--load` on a
+    journal replays it, so a crashed session can be resumed as it was. On
+    `/save` the history is compacted into the usual JSON export and the
+    journal restarts from a `base` record pointing at that file.
+
+    `fsync` controls durability: `always` syncs every record, `interval`
+    at most once a second, `never` leaves it to the OS. A journal without
+    a path is disabled and all writes are no-ops.'''
+
+    def __init__(self, path: Optional[Path] = None, fsync: str = 'interval'):
+        self.path = Path(path) if path else None
+        self.fsync = fsync if fsync in FSYNC_MODES else 'interval'
+        self.file = None
+        self.last_sync = 0.0
+        self.keep = False       # 出错退出时保留日志用于恢复
+
+    @classmethod
+    def new(cls, directory: Path, fsync: str = 'interval', name: str = None) -> "SessionJournal":
+        '''name 区分同一进程中的多个对话（/session new）'''
+        directory.mkdir(parents=True, exist_ok=True)
+        suffix = f"_{re.sub(r'[^A-Za-z0-9_-]', '', name)}" if name else ""
+        return cls(directory / f'session_{datetime.now().strftime("%Y-%m-%d_%H,%M,%S")}{suffix}.jsonl', fsync)
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def open(self):
+        if self.file is None:
+            self.file = open(self.path, 'a', encoding='utf-8')
+            # 写入期间一直持有锁，其他 gpt-term 启动时不会把它当作没有正常退出的会话留下的日志
+            if not lock_file(self.file):
+                log.warning(f"Journal {self.path} is in use by another session")
+
+    def write(self, record: Dict):
+        if not self.enabled:
+            return
+        self.open()
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+        now = time.monotonic()
+        if self.fsync == 'always' or (self.fsync == 'interval' and now - self.last_sync >= 1):
+            os.fsync(self.file.fileno())
+            self.last_sync = now
+
+    def append(self, message: Dict[str, str]):
+        self.write({"op": "append", "message": message})
+
+    def pop(self, index: int):
+        self.write({"op": "pop", "index": index})
+
+    def update(self, index: int, message: Dict[str, str]):
+        self.write({"op": "update", "index": index, "message": message})
+
+    def truncate(self, length: int):
+        self.write({"op": "truncate", "length": length})
+
+    def reset(self, messages: Sequence[Dict[str, str]]):
+        if self.enabled:
+            self.write({"op": "reset", "messages": list(messages)})
+
+    def sync(self):
+        '''把已写入的记录落盘，出错退出前调用'''
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.last_sync = time.monotonic()
+
+    def start_from(self, saved_file, length: int):
+        '''以 JSON 格式的聊天记录文件的前 length 条消息为起点'''
+        self.write({"op": "base", "file": str(Path(saved_file).resolve()), "length": length})
+
+    def compact(self, saved_file, length: int):
+        '''历史已完整保存到 saved_file，旧日志不再需要，新日志从该文件开始'''
+        if not self.enabled:
+            return
+        self.close()
+        self.remove()
+        self.start_from(saved_file, length)
+
+    def close(self, remove: bool = False):
+        '''正常退出时删除日志（remove），除非之前出错需要保留'''
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if remove and self.enabled and not self.keep:
+            self.remove()
+
+    def remove(self):
+        # Path.unlink(missing_ok=True) 需要 Python 3.8
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
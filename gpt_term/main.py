@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import argparse
-import concurrent.futures
+import copy
 import json
 import logging
 import os
@@ -14,30 +14,27 @@ from configparser import ConfigParser
 from datetime import date, datetime, timedelta
 from importlib.resources import read_text
 from pathlib import Path
-from queue import Queue
-from typing import Dict, List
+from typing import AsyncIterable, Callable, Dict, Iterable, List, Tuple
 
-import pyperclip
 import requests
-import sseclient
-import tiktoken
-from packaging.version import parse as parse_version
-from prompt_toolkit import PromptSession, prompt
-from prompt_toolkit.completion import (Completer, Completion, NestedCompleter,
-                                       PathCompleter)
-from prompt_toolkit.key_binding import KeyBindings
-from prompt_toolkit.keys import Keys
-from prompt_toolkit.shortcuts import confirm
-from prompt_toolkit.styles import Style
-from prompt_toolkit.validation import ValidationError, Validator
-from rich import print as rprint
-from rich.console import Console, Group
-from rich.live import Live
-from rich.markdown import Markdown
-from rich.panel import Panel
 
+# pyperclip, tiktoken, packaging, prompt_toolkit, rich 和 asyncio 都在第一次用到时才导入,
+# 让 `gpt-term "query"` 这类一次性调用尽快启动，管道模式下完全不会加载 prompt_toolkit 和 rich
 from . import __version__
+from .cache import ResponseCache, iter_cached_content
+from .codeblocks import CodeBlockIndex, CodeBlockScanner, extension
+from .commands import PATH_OPTIONS, commands
+from .compare import COMPARE_LAYOUTS, parse_models
+from .context import ContextPolicy
+from .journal import SessionJournal, find_leftover_journal, is_journal, iter_json_array, replay_journal
+from .metrics import Metrics, TurnMetrics
 from .locale import set_lang, get_lang
+from .search import MATCH_END, MATCH_START, SearchIndex, iter_history_files
+from .sse import StreamError, iter_stream_content
+from .store import MessageStore
+from .tokens import TokenCountStore, TokenLedger, count_usage, get_tokenizer
+from .usage import Budget, PriceTable, UsageLedger, format_cost, period_start
+from .transport import Transport
 import locale
 
 data_dir = Path.home() / '.gpt-term'
@@ -53,14 +50,27 @@ logging.basicConfig(filename=f'{data_dir}/chat.log', format='%(asctime)s %(name)
 
 log = logging.getLogger("chat")
 
-console = Console()
 
-style = Style.from_dict({
-    "prompt": "ansigreen",  # 将提示符设置为绿色
-})
+class LazyConsole:
+    '''在第一次使用时才创建 rich Console'''
+
+    def __init__(self):
+        self.console = None
+
+    def get(self):
+        if self.console is None:
+            from rich.console import Console
+            self.console = Console()
+        return self.console
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+console = LazyConsole()
 
 remote_version = None
-local_version = parse_version(__version__)
+local_version = __version__
 threadlock_remote_version = threading.Lock()
 
 
@@ -98,7 +108,7 @@ class ChatMode:
 
 
 class ChatGPT:
-    def __init__(self, api_key: str, timeout: float):
+    def __init__(self, api_key: str, timeout: float, pool_size: int = 10, http2: bool = False):
         self.api_key = api_key
         self.host = "https://api.openai.com"
         self.endpoint = self.host + "/v1/chat/completions"
@@ -106,127 +116,357 @@ class ChatGPT:
             "Content-Type": "application/json",
             "Authorization": f"Bearer {api_key}"
         }
-        self.messages = [
-            {"role": "system", "content": f"You are a helpful assistant.\nCurrent date: {datetime.now().strftime('%Y-%m-%d')}"}]
+        # 较早消息的正文超出内存上限后写入 ~/.gpt-term/spill，需要时再读回
+        self.messages = MessageStore([
+            {"role": "system", "content": f"You are a helpful assistant.\nCurrent date: {datetime.now().strftime('%Y-%m-%d')}"}],
+            data_dir / 'spill')
         self.model = 'gpt-3.5-turbo'
         self.tokens_limit = 4096
         # as default: gpt-3.5-turbo has a tokens limit as 4096
         # when model changes, tokens will also be changed
         self.temperature = 1
         self.total_tokens_spent = 0
-        self.current_tokens = count_token(self.messages)
+        self.prompt_tokens_spent = 0
+        self.completion_tokens_spent = 0
+        self.stream_usage = True    # 流式请求时让 API 在最后一个数据块中返回 usage
+        self.token_ledger = TokenLedger(self.messages)
+        self.token_store = TokenCountStore(data_dir / 'token_counts')
+        self.first_shown = len(self.messages)    # messages[first_shown:] 已经显示在屏幕上
+        self.code_blocks = CodeBlockIndex()     # 回答中的代码块，供 /copy code 和 /extract 使用
+        self.code_blocks.sync(self.messages)
+        self.context_policy = ContextPolicy()
+        self.response_cache = ResponseCache(data_dir / 'cache')
+        self.journal = SessionJournal()
+        self.search_index = SearchIndex(data_dir / 'search.db')
+        self.metrics = Metrics()
+        # 每次请求的 token 数跨会话记录在 usage.db，/usage 和预算检查从这里读取
+        self.usage = UsageLedger(data_dir / 'usage.db', datetime.now().strftime("%Y-%m-%d_%H,%M,%S"))
+        self.budget = Budget()
+        self.load_show_last = 10
+        self.compare_models: List[str] = []     # /compare 没有指定模型时使用，来自 --models
+        self.compare_layout = 'columns'
         self.timeout = timeout
+        self.transport = Transport(pool_size, http2)
+        # 所有请求（包括后台生成标题和检查更新）共用同一个连接池
         self.title: str = None
-        self.gen_title_messages = Queue()
+        self.title_task = None          # 在共享事件循环中生成标题的任务
+        self.title_tokens_spent = 0
+        self.title_latency: float = None
         self.auto_gen_title_background_enable = True
         self.threadlock_total_tokens_spent = threading.Lock()
         self.stream_overflow = 'ellipsis'
-
-        self.credit_total_granted = 0
-        self.credit_total_used = 0
-        self.credit_used_this_month = 0
-        self.credit_plan = ""
+        self.stream_refresh_rate = 15
+        self.pipe_flush = 'delta'
+        self.sessions = None    # 同一进程中所有对话共用的 SessionManager，见 /session
+        self._aio = None
+
+    @property
+    def aio(self):
+        '''共享的事件循环，交互模式下第一次用到时才启动，管道模式不会导入 asyncio'''
+        if self._aio is None:
+            from .aio import EventLoop
+            self._aio = EventLoop()
+        return self._aio
+
+    def new_session(self) -> "ChatGPT":
+        '''同一进程中的另一个对话：从当前的系统提示和设置开始，消息、模型、token 统计和标题各自独立，
+        连接池、事件循环、响应缓存、用量记录和指标与当前对话共用'''
+        chat_gpt = copy.copy(self)
+        chat_gpt.messages = MessageStore([dict(self.messages[0])] if self.messages and self.messages.roles[0] == 'system' else [],
+                                         self.messages.directory, self.messages.resident_bytes)
+        chat_gpt.token_ledger = TokenLedger(chat_gpt.messages, self.token_ledger.tokenizer)
+        # set_model 会修改 token_store 的计数方式，不能和其他对话共用
+        chat_gpt.token_store = TokenCountStore(data_dir / 'token_counts', self.token_ledger.tokenizer)
+        chat_gpt.first_shown = len(chat_gpt.messages)
+        chat_gpt.code_blocks = CodeBlockIndex()
+        chat_gpt.code_blocks.sync(chat_gpt.messages)
+        chat_gpt.context_policy = ContextPolicy(self.context_policy.mode, self.context_policy.budget,
+                                                self.context_policy.keep_turns, self.context_policy.relevant_turns)
+        chat_gpt.journal = SessionJournal()
+        chat_gpt.compare_models = list(self.compare_models)
+        chat_gpt.total_tokens_spent = chat_gpt.prompt_tokens_spent = chat_gpt.completion_tokens_spent = 0
+        chat_gpt.title = None
+        chat_gpt.title_task = None
+        chat_gpt.title_tokens_spent = 0
+        chat_gpt.title_latency = None
+        chat_gpt.threadlock_total_tokens_spent = threading.Lock()
+        return chat_gpt
+
+    @property
+    def current_tokens(self) -> int:
+        return self.token_ledger.total
+
+    def add_message(self, message: Dict[str, str], tokens: int = None):
+        self.messages.append(message)
+        self.token_ledger.append(message, tokens)
+        self.code_blocks.append(self.messages)
+        self.journal.append(message)
+
+    def pop_message(self, index: int = -1) -> Dict[str, str]:
+        self.token_ledger.pop(index)
+        self.journal.pop(index)
+        if (index if index >= 0 else len(self.messages) + index) < self.first_shown:
+            self.first_shown -= 1
+        return self.messages.pop(index)
+
+    def load_messages(self, messages: List[Dict[str, str]]):
+        '''载入历史记录，已保存过的 token 数直接使用，不重新计算'''
+        counts = self.token_store.get_counts(messages)
+        self.messages.reset(messages)
+        self.token_ledger.reset(self.messages, counts)
+        self.first_shown = len(self.messages)
+        self.cancel_title()
+        self.context_policy.cancel_summary()
+
+    def show_earlier_messages(self, count: int):
+        '''向前翻页，显示 count 条还没有显示过的较早消息'''
+        first = 1 if self.messages and self.messages.roles[0] == 'system' else 0
+        if self.first_shown <= first:
+            console.print(_("gpt_term.history_nothing"))
+            return
+        start = max(self.first_shown - count, first)
+        if self.first_shown < len(self.messages):
+            console.print(_("gpt_term.history_page", start=start - first + 1, end=self.first_shown - first,
+                            total=len(self.messages) - first), highlight=False)
+        for message in self.messages[start:self.first_shown]:
+            print_message(message)
+        self.first_shown = start
+        if start > first:
+            console.print(_("gpt_term.history_hidden", hidden=start - first), highlight=False)
+
+    def context_messages(self, notify: bool = False) -> List[Dict[str, str]]:
+        '''按上下文策略选出本次请求发送的 messages，历史记录本身不变'''
+        dropped_before = self.context_policy.dropped
+        messages = self.context_policy.apply(self)
+        if notify and self.context_policy.dropped > dropped_before:
+            if self.context_policy.recalled:
+                console.print(_("gpt_term.context_recalled", dropped=self.context_policy.dropped,
+                                recalled=self.context_policy.recalled), highlight=False)
+            else:
+                console.print(_("gpt_term.context_trimmed", dropped=self.context_policy.dropped,
+                                policy=self.context_policy.mode), highlight=False)
+        return messages
 
     def add_total_tokens(self, tokens: int):
         self.threadlock_total_tokens_spent.acquire()
         self.total_tokens_spent += tokens
         self.threadlock_total_tokens_spent.release()
 
+    def add_usage(self, prompt_tokens: int, completion_tokens: int, model: str = None, latency: float = None,
+                  kind: str = "chat", cached: bool = False):
+        '''记录一次请求实际花费的 token，同时追加到 usage.db；缓存命中时 token 数为 0'''
+        with self.threadlock_total_tokens_spent:
+            self.prompt_tokens_spent += prompt_tokens
+            self.completion_tokens_spent += completion_tokens
+            self.total_tokens_spent += prompt_tokens + completion_tokens
+        self.usage.record(model or self.model, prompt_tokens, completion_tokens, latency, cached, kind)
+
+    def check_budget(self, quiet: bool = False) -> bool:
+        '''发出请求前检查预算：超过软限制时提醒一次，超过硬限制时返回 False，不发出请求。
+        quiet 用于标题生成等后台请求，只检查不提示'''
+        level, spent, limit = self.budget.check(self.usage)
+        if level is None or quiet or (level == 'soft' and self.budget.warned):
+            return level != 'hard'
+        message = _(f"gpt_term.budget_{level}", spent=format_cost(spent), limit=format_cost(limit),
+                    period=_(f"gpt_term.budget_period_{self.budget.period}"))
+        if sys.stdout.isatty():
+            console.print(message, style="bold red" if level == 'hard' else "yellow", highlight=False)
+        else:
+            # 管道模式下提示写到 stderr，不混入回答
+            print(message, file=sys.stderr)
+        self.budget.warned = True
+        return level != 'hard'
+
+    def request_data(self, messages: List[Dict[str, str]], stream: bool, model: str = None, temperature: float = None) -> Dict:
+        '''请求体；流式请求时通过 stream_options 要求 API 在结束前返回 usage'''
+        data = {
+            "model": model or self.model,
+            "messages": messages,
+            "stream": stream,
+            "temperature": self.temperature if temperature is None else temperature
+        }
+        if stream and self.stream_usage:
+            data["stream_options"] = {"include_usage": True}
+        return data
+
     def send_request(self, data):
+        return self.aio.run(self.send_request_async(data))
+
+    async def send_request_async(self, data):
+        import asyncio
+
+        from .aio import to_thread
+        turn = self.metrics.start("chat", data["model"], data["stream"])
         try:
             with console.status(_("gpt_term.ChatGPT_thinking")):
-                response = requests.post(
-                    self.endpoint, headers=self.headers, data=json.dumps(data), timeout=self.timeout, stream=ChatMode.stream_mode)
+                # 被取消时请求仍在线程池中进行，迟到的响应直接关闭
+                response = await to_thread(
+                    self.transport.post, self.endpoint, headers=self.headers, data=json.dumps(data), timeout=self.timeout,
+                    stream=ChatMode.stream_mode, cleanup=lambda late_response: late_response.close())
+            turn.response_received(response)
             # 匹配4xx错误，显示服务器返回的具体原因
             if response.status_code // 100 == 4:
                 error_msg = response.json()['error']['message']
                 console.print(_("gpt_term.Error_message",error_msg=error_msg))
                 log.error(error_msg)
+                self.metrics.record(turn, "error")
                 return None
 
             response.raise_for_status()
+            # 回答显示完之后由 handle 记录
+            response.metrics = turn
             return response
-        except KeyboardInterrupt:
+        except asyncio.CancelledError:
             console.print(_("gpt_term.Aborted"))
+            self.metrics.record(turn, "aborted")
             raise
         except requests.exceptions.ReadTimeout as e:
             console.print(
                 _("gpt_term.Error_timeout",timeout=self.timeout), highlight=False)
+            self.metrics.record(turn, "error")
             return None
         except requests.exceptions.RequestException as e:
             console.print(_("gpt_term.Error_message",error_msg=str(e)))
             log.exception(e)
+            self.metrics.record(turn, "error")
             return None
 
-    def send_request_silent(self, data):
+    def send_request_silent(self, data, stream: bool = False, kind: str = "title",
+                            on_error: Callable[[str], None] = None):
         # this is a silent sub function, for sending request without outputs (silently)
+        # kind: which caller the request is recorded under in /stats
+        # on_error: 失败返回 None 时用错误信息调用，例如批量模式写入结果
+        turn = self.metrics.start(kind, data["model"], stream)
         try:
-            response = requests.post(
-                self.endpoint, headers=self.headers, data=json.dumps(data), timeout=self.timeout)
+            response = self.transport.post(
+                self.endpoint, headers=self.headers, data=json.dumps(data), timeout=self.timeout, stream=stream)
+            turn.response_received(response)
             # match 4xx error codes
             if response.status_code // 100 == 4:
                 error_msg = response.json()['error']['message']
                 log.error(error_msg)
+                self.metrics.record(turn, "error")
+                if on_error:
+                    on_error(error_msg)
                 return None
 
             response.raise_for_status()
+            response.metrics = turn
             return response
         except requests.exceptions.ReadTimeout as e:
-            log.error("Automatic generating title failed as timeout")
+            log.error(f"Automatic generating {kind} failed as timeout")
+            self.metrics.record(turn, "error")
+            if on_error:
+                on_error(f"Request timed out after {self.timeout}s")
             return None
         except requests.exceptions.RequestException as e:
             log.exception(e)
+            self.metrics.record(turn, "error")
+            if on_error:
+                on_error(str(e) or type(e).__name__)
             return None
 
-    def process_stream_response(self, response: requests.Response):
+    async def render_stream(self, chunks: AsyncIterable[str], metrics: TurnMetrics = None,
+                            cancel_message: str = None) -> Tuple[str, bool]:
+        '''边接收边渲染回答，返回 (回答内容, 是否被中断)；metrics 记录每个片段的到达时间和渲染耗时，
+        cancel_message 是按 Ctrl+C 时显示的提示，默认为 Aborted'''
+        import asyncio
+
+        from rich import print as rprint
+        from rich.live import Live
+
+        from .render import StreamRenderer
+
         reply: str = ""
-        client = sseclient.SSEClient(response)
-        with Live(console=console, auto_refresh=False, vertical_overflow=self.stream_overflow) as live:
+        aborted = False
+        # 代码块在接收的同时找出，/copy code 和 /extract 不需要再扫描这条回答
+        scanner = CodeBlockScanner()
+        with Live(console=console.get(), auto_refresh=False, vertical_overflow=self.stream_overflow) as live:
+            renderer = StreamRenderer(live, self.stream_refresh_rate)
             try:
                 rprint("[bold cyan]ChatGPT: ")
-                for event in client.events():
-                    if event.data == '[DONE]':
-                        # finish_reason = part["choices"][0]['finish_reason']
-                        break
-                    part = json.loads(event.data)
-                    if "content" in part["choices"][0]["delta"]:
-                        content = part["choices"][0]["delta"]["content"]
-                        reply += content
-                        if ChatMode.raw_mode:
-                            rprint(content, end="", flush=True),
-                        else:
-                            live.update(Markdown(reply), refresh=True)
-            except KeyboardInterrupt:
+                async for content in chunks:
+                    if metrics is not None:
+                        metrics.content_received()
+                    reply += content
+                    scanner.feed(content)
+                    if ChatMode.raw_mode:
+                        rprint(content, end="", flush=True),
+                    else:
+                        renderer.feed(content)
+                renderer.finish()
+            except asyncio.CancelledError:
+                # 按 Ctrl+C 取消，保留已经收到的部分
+                aborted = True
+                renderer.finish()
+                live.stop()
+                console.print(cancel_message or _('gpt_term.Aborted'))
+            except (StreamError, requests.exceptions.RequestException) as e:
+                # API 中途发来 error 事件或连接中断：和中断一样保留已经收到的部分，并说明原因
+                aborted = True
+                renderer.finish()
                 live.stop()
-                console.print(_('gpt_term.Aborted'))
-            finally:
-                return {'role': 'assistant', 'content': reply}
+                console.print(_("gpt_term.Error_message", error_msg=str(e)))
+                if not isinstance(e, StreamError):
+                    log.error(f"Stream interrupted: {e}")
+        if metrics is not None and not ChatMode.raw_mode:
+            metrics.render = renderer.render_time
+        self.code_blocks.stream(reply, scanner.finish())
+        return reply, aborted
+
+    def process_stream_response(self, response: requests.Response, data: Dict = None):
+        return self.aio.run(self.process_stream_response_async(response, data))
+
+    async def process_stream_response_async(self, response: requests.Response, data: Dict = None):
+        from .aio import iter_in_thread, to_thread
+        aborted = True
+        metrics = getattr(response, "metrics", None)
+        try:
+            reply, aborted = await self.render_stream(iter_in_thread(iter_stream_content(response), response.close), metrics)
+        finally:
+            if metrics is not None:
+                metrics.finish("error" if getattr(response, "finish_reason", None) == "error" else
+                               "aborted" if aborted else None)
+            await to_thread(self.transport.release, response, drain=not aborted)
+        reply_message = {'role': 'assistant', 'content': reply}
+        if data and not aborted:
+            self.response_cache.put(data, reply_message, response.finish_reason)
+        return reply_message
 
-    def process_response(self, response: requests.Response):
+    def process_response(self, response: requests.Response, data: Dict = None):
         if ChatMode.stream_mode:
-            return self.process_stream_response(response)
+            return self.process_stream_response(response, data)
         else:
             response_json = response.json()
             log.debug(f"Response: {response_json}")
+            response.usage = response_json.get("usage")
             reply_message: Dict[str, str] = response_json["choices"][0]["message"]
             print_message(reply_message)
+            if data:
+                self.response_cache.put(data, reply_message, response_json["choices"][0].get("finish_reason"))
             return reply_message
 
+    def replay_reply(self, reply_message: Dict[str, str]) -> Dict[str, str]:
+        '''按当前模式显示已经完整收到的回答（缓存命中、后台会话的回答），流式模式下同样经过流式渲染器'''
+        if ChatMode.stream_mode:
+            from .aio import iter_async
+            reply, _aborted = self.aio.run(self.render_stream(iter_async(iter_cached_content(reply_message['content']))))
+            return {'role': 'assistant', 'content': reply}
+        print_message(reply_message)
+        return reply_message
+
     def delete_first_conversation(self):
         if len(self.messages) >= 3:
-            question = self.messages[1]
-            del self.messages[1]
-            if self.messages[1]['role'] == "assistant":
+            tokens_before = self.current_tokens
+            question = self.pop_message(1)
+            if self.messages.roles[1] == "assistant":
                 # 如果第二个信息是回答才删除
-                del self.messages[1]
+                self.pop_message(1)
             truncated_question = question['content'].split('\n')[0]
             if len(question['content']) > len(truncated_question):
                 truncated_question += "..."
 
-            # recount current tokens
-            new_tokens = count_token(self.messages)
-            tokens_saved = self.current_tokens - new_tokens
-            self.current_tokens = new_tokens
+            tokens_saved = tokens_before - self.current_tokens
 
             console.print(
                 _('gpt_term.delete_first_conversation_yes',truncated_question=truncated_question,tokens_saved=tokens_saved))
@@ -235,52 +475,109 @@ class ChatGPT:
     
     def delete_all_conversation(self):
         del self.messages[1:]
-        self.title = None
-        # recount current tokens
-        self.current_tokens = count_token(self.messages)
+        self.token_ledger.truncate(1)
+        self.first_shown = min(self.first_shown, 1)
+        self.journal.truncate(1)
+        self.cancel_title()
+        self.context_policy.cancel_summary()
         os.system('cls' if os.name == 'nt' else 'clear')
         console.print(_('gpt_term.delete_all'))
 
+    def write_stream(self, chunks: Iterable[str], metrics: TurnMetrics = None) -> str:
+        '''管道模式下把收到的文本片段原样写到 stdout，下游程序在第一个 token 到达时就能开始处理'''
+        reply: str = ""
+        try:
+            for content in chunks:
+                if metrics is not None:
+                    metrics.content_received()
+                reply += content
+                sys.stdout.write(content)
+                if self.pipe_flush == 'delta' or (self.pipe_flush == 'line' and '\n' in content):
+                    sys.stdout.flush()
+            sys.stdout.write('\n')
+            sys.stdout.flush()
+        except (StreamError, requests.exceptions.RequestException) as e:
+            # API 中途发来 error 事件或连接中断：已经写出的部分保留，原因写到 stderr，不混入回答
+            sys.stdout.write('\n')
+            sys.stdout.flush()
+            print(_("gpt_term.stream_error", error_msg=str(e)), file=sys.stderr)
+            if not isinstance(e, StreamError):
+                log.error(f"Stream interrupted: {e}")
+        except BrokenPipeError:
+            # 下游已经关闭管道（例如 `| head`），停止接收并安静退出
+            # 把 stdout 指向 devnull，避免解释器退出时 flush 再次触发 EPIPE
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+            sys.exit(1)
+        log.info(f"ChatGPT: {reply}")
+        return reply
+
+    def write_stream_response(self, response: requests.Response, data: Dict = None):
+        aborted = True
+        try:
+            reply_message = {'role': 'assistant', 'content': self.write_stream(iter_stream_content(response), response.metrics)}
+            # 出错时连接直接关闭，不再读取剩余内容
+            aborted = response.finish_reason == "error"
+        finally:
+            self.transport.release(response, drain=not aborted)
+            # 管道模式不计算 token 数，避免加载 tokenizer，只使用 API 返回的 usage
+            usage = getattr(response, "usage", None)
+            if usage:
+                response.metrics.completion_tokens = usage.get("completion_tokens")
+            self.metrics.record(response.metrics, "error" if getattr(response, "finish_reason", None) == "error" else
+                                "aborted" if aborted else None)
+            if usage:
+                self.add_usage(usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), data and data["model"],
+                               response.metrics.latency, "pipe")
+        if data:
+            self.response_cache.put(data, reply_message, response.finish_reason)
+        return reply_message
+
     def handle_simple(self, message: str):
-        self.messages.append({"role": "user", "content": message})
-        data = {
-            "model": self.model,
-            "messages": self.messages,
-            "temperature": self.temperature
-        }
-        response = self.send_request_silent(data)
+        self.add_message({"role": "user", "content": message})
+        data = self.request_data(self.context_messages(), stream=True)
+        cached_message = self.response_cache.get(data)
+        if cached_message:
+            self.write_stream([cached_message['content']])
+            self.add_usage(0, 0, data["model"], kind="pipe", cached=True)
+            return cached_message
+        if not self.check_budget():
+            return None
+        response = self.send_request_silent(data, stream=True, kind="pipe")
         if response:
-            response_json = response.json()
-            log.debug(f"Response: {response_json}")
-            print(response_json["choices"][0]["message"]["content"])
+            return self.write_stream_response(response, data)
 
     def handle(self, message: str):
         try:
-            self.messages.append({"role": "user", "content": message})
-            data = {
-                "model": self.model,
-                "messages": self.messages,
-                "stream": ChatMode.stream_mode,
-                "temperature": self.temperature
-            }
-            response = self.send_request(data)
-            if response is None:
-                self.messages.pop()
-                if self.current_tokens >= self.tokens_limit:
-                    console.print(_('gpt_term.tokens_reached'))
-                return
-
-            reply_message = self.process_response(response)
+            self.add_message({"role": "user", "content": message})
+            if len(self.messages) == 2 and self.title is None and self.auto_gen_title_background_enable:
+                # 第一个问题发出的同时开始生成标题，和回答共用连接池并行请求
+                self.start_title_generation(message)
+            data = self.request_data(self.context_messages(notify=True), stream=ChatMode.stream_mode)
+            cached_message = self.response_cache.get(data)
+            if cached_message:
+                reply_message = self.replay_reply(cached_message)
+            else:
+                if not self.check_budget():
+                    self.pop_message()
+                    if len(self.messages) == 1:
+                        self.cancel_title()
+                    return
+                response = self.send_request(data)
+                if response is None:
+                    self.pop_message()
+                    if len(self.messages) == 1:
+                        self.cancel_title()
+                    if self.context_policy.mode == 'off' and self.current_tokens >= self.tokens_limit:
+                        console.print(_('gpt_term.tokens_reached'))
+                    return
+
+                reply_message = self.process_response(response, data)
             if reply_message is not None:
                 log.info(f"ChatGPT: {reply_message['content']}")
-                self.messages.append(reply_message)
-                self.current_tokens = count_token(self.messages)
-                self.add_total_tokens(self.current_tokens)
-
-                if len(self.messages) == 3 and self.auto_gen_title_background_enable:
-                    self.gen_title_messages.put(self.messages[1]['content'])
+                self.finish_turn(data, reply_message, None if cached_message else response)
 
-                if self.tokens_limit - self.current_tokens in range(1, 500):
+                if self.context_policy.mode == 'off' and self.tokens_limit - self.current_tokens in range(1, 500):
                     console.print(
                         _("gpt_term.tokens_approaching",token_left=self.tokens_limit - self.current_tokens))
                 # approaching tokens limit (less than 500 left), show info
@@ -294,6 +591,27 @@ class ChatGPT:
 
         return reply_message
 
+    def finish_turn(self, data: Dict, reply_message: Dict[str, str], response: requests.Response = None):
+        '''回答完整收到之后记录指标和用量，并把回答加入对话；response 为 None 表示回答来自缓存'''
+        if response is None:
+            self.add_usage(0, 0, data["model"], cached=True)
+            self.add_message(reply_message)
+            return
+        reply_tokens = None
+        turn = response.metrics
+        turn.finish()
+        tokenize_start = time.perf_counter()
+        usage = getattr(response, "usage", None)
+        prompt_tokens, completion_tokens = count_usage(usage, data["messages"], reply_message["content"], data["model"])
+        if usage:
+            # 回答的 token 数已经由 API 给出，加入对话时不需要再计算
+            reply_tokens = self.token_ledger.tokenizer.reply_message_tokens(completion_tokens)
+        turn.completion_tokens = completion_tokens
+        turn.tokenize = time.perf_counter() - tokenize_start
+        self.metrics.record(turn)
+        self.add_usage(prompt_tokens, completion_tokens, data["model"], turn.latency)
+        self.add_message(reply_message, reply_tokens)
+
     def gen_title(self, force: bool = False):
         # Empty the title if there is only system message left
         if len(self.messages) < 2:
@@ -301,80 +619,119 @@ class ChatGPT:
             return
 
         try:
-            with console.status(_("gpt_term.title_waiting_gen")):
-                self.gen_title_messages.join()
+            if self.title_task and not self.title_task.done():
+                with console.status(_("gpt_term.title_waiting_gen")):
+                    self.wait_title()
             if self.title and not force:
                 return self.title
 
             # title not generated, do
 
             content_this_time = self.messages[1]['content']
-            self.gen_title_messages.put(content_this_time)
+            self.start_title_generation(content_this_time)
             with console.status(_("gpt_term.title_gening")):
-                self.gen_title_messages.join()
+                self.wait_title()
         except KeyboardInterrupt:
             console.print(_("gpt_term.title_skip_gen"))
             raise
 
         return self.title
 
-    def gen_title_silent(self, content: str):
-        # this is a silent sub function, only for sub thread which auto-generates title when first conversation is made and debug functions
+    def start_title_generation(self, content: str):
+        '''在共享的事件循环中生成标题，不需要单独的线程'''
+        if self.title_task and not self.title_task.done():
+            self.title_task.cancel()
+        self.title_task = self.aio.submit(self.gen_title_silent(content))
+
+    def wait_title(self):
+        try:
+            self.title_task.wait()
+        except KeyboardInterrupt:
+            raise
+        except BaseException:
+            # 取消和失败都已经在任务中处理
+            pass
+
+    def cancel_title(self):
+        '''清空标题并取消正在进行的标题生成，标题请求的连接会被断开'''
+        if self.title_task and not self.title_task.done():
+            self.title_task.cancel()
+        self.title_task = None
+        self.title = None
+
+    async def gen_title_silent(self, content: str):
+        # this is a silent sub function, only for the background task which auto-generates title when first conversation is made and debug functions
         # it SHOULD NOT be triggered or used by any other functions or commands
         # because of the usage of this subfunction, no check for messages list length and title appearance is needed
+        import asyncio
+
+        from .aio import iter_in_thread, to_thread
         prompt = f'Generate title shorter than 10 words for the following content in content\'s language. The tilte contains ONLY words. DO NOT include line-break. \n\nContent: """\n{content}\n"""'
         messages = [{"role": "user", "content": prompt}]
-        data = {
-            "model": "gpt-3.5-turbo",
-            "messages": messages,
-            "temperature": 0.5
-        }
-        response = self.send_request_silent(data)
-        if response is None:
-            self.title = None
+        data = self.request_data(messages, stream=True, model="gpt-3.5-turbo", temperature=0.5)
+        start_time = time.perf_counter()
+        log.debug(f"Title generation task: Working with message \"{content}\"")
+        try:
+            reply_message = self.response_cache.get(data)
+            if reply_message is None:
+                if not self.check_budget(quiet=True):
+                    log.info("Title generation skipped: hard budget reached")
+                    return
+                response = await to_thread(self.send_request_silent, data, stream=True,
+                                           cleanup=lambda late_response: late_response.close())
+                if response is None:
+                    self.title = None
+                    log.error("Background Title auto-generation Failed")
+                    return
+                reply = ""
+                turn = response.metrics
+                try:
+                    # 流式接收，被取消时立即断开连接，不用等到标题生成完
+                    async for content_part in iter_in_thread(iter_stream_content(response), response.close):
+                        turn.content_received()
+                        reply += content_part
+                except asyncio.CancelledError:
+                    self.metrics.record(turn, "aborted")
+                    raise
+                except Exception:
+                    self.metrics.record(turn, "error")
+                    raise
+                finally:
+                    response.close()
+                turn.finish()
+                reply_message = {"role": "assistant", "content": reply}
+                self.response_cache.put(data, reply_message, response.finish_reason)
+                tokenize_start = time.perf_counter()
+                prompt_tokens, completion_tokens = count_usage(
+                    getattr(response, "usage", None), messages, reply, data["model"])
+                turn.completion_tokens = completion_tokens
+                turn.tokenize = time.perf_counter() - tokenize_start
+                self.metrics.record(turn)
+                self.add_usage(prompt_tokens, completion_tokens, data["model"], turn.latency, "title")
+                # count title generation tokens cost, also kept separately for /tokens
+                self.title_tokens_spent += prompt_tokens + completion_tokens
+        except asyncio.CancelledError:
+            log.debug("Title generation task: cancelled")
+            raise
+        except Exception as e:
+            console.print(_("gpt_term.title_auto_gen_fail",error_msg=str(e)))
+            log.exception(e)
             return
-        reply_message = response.json()["choices"][0]["message"]
+        self.title_latency = time.perf_counter() - start_time
         self.title: str = reply_message['content']
-        # here: we don't need a lock here for self.title because: the only three places changes or uses chat_gpt.title will never operate together
-        # they are: gen_title, gen_title_silent (here), '/save' command
+        # here: we don't need a lock here for self.title because: the title task is cancelled
+        # before anything else (/reset, /title, loading a history) changes chat_gpt.title
         log.debug(f"Title background silent generated: {self.title}")
-
-        messages.append(reply_message)
-        self.add_total_tokens(count_token(messages))
-        # count title generation tokens cost
+        change_CLI_title(self.title)
 
         return self.title
 
-    def auto_gen_title_background(self):
-        # this is the auto title generation daemon thread main function
-        # it SHOULD NOT be triggered or used by any other functions or commands
-        while True:
-            try:
-                content_this_time = self.gen_title_messages.get()
-                log.debug(f"Title Generation Daemon Thread: Working with message \"{content_this_time}\"")
-                new_title = self.gen_title_silent(content_this_time)
-                self.gen_title_messages.task_done()
-                time.sleep(0.2)
-                if not new_title:
-                    log.error("Background Title auto-generation Failed")
-                else:
-                    change_CLI_title(self.title)
-                log.debug("Title Generation Daemon Thread: Pause")
-
-            except Exception as e:
-                console.print(_("gpt_term.title_auto_gen_fail",error_msg=str(e))
-                    )
-                log.exception(e)
-                self.save_chat_history_urgent()
-                while self.gen_title_messages.unfinished_tasks:
-                    self.gen_title_messages.task_done()
-                continue
-                # something went wrong, continue the loop
-
     def save_chat_history(self, filename):
         try:
             with open(f"{filename}", 'w', encoding='utf-8') as f:
-                json.dump(self.messages, f, ensure_ascii=False, indent=4)
+                json.dump(self.messages[:], f, ensure_ascii=False, indent=4)
+            self.journal.compact(filename, len(self.messages))
+            self.token_store.save(self.messages, self.token_ledger.counts)
             console.print(
                 _("gpt_term.save_history_success",filename=filename), highlight=False)
         except Exception as e:
@@ -383,17 +740,29 @@ class ChatGPT:
             log.exception(e)
             self.save_chat_history_urgent()
             return
+        try:
+            self.search_index.index_file(filename)
+        except Exception as e:
+            # 索引失败不影响保存，下次搜索时会重新同步
+            log.warning(f"Failed to update search index: {e}")
 
     def save_chat_history_urgent(self):
+        if self.journal.enabled:
+            # 日志里已经有全部记录，落盘后保留即可，不再另存一份完整备份
+            self.journal.sync()
+            self.journal.keep = True
+            console.print(
+                _("gpt_term.save_history_journal",journal=self.journal.path), highlight=False)
+            return
         filename = f'{data_dir}/chat_history_backup_{datetime.now().strftime("%Y-%m-%d_%H,%M,%S")}.json'
         with open(f"{filename}", 'w', encoding='utf-8') as f:
-            json.dump(self.messages, f, ensure_ascii=False, indent=4)
+            json.dump(self.messages[:], f, ensure_ascii=False, indent=4)
         console.print(
             _("gpt_term.save_history_urgent_success",filename=filename), highlight=False)
 
     def send_get(self, url, params=None):
         try:
-            response = requests.get(
+            response = self.transport.get(
                 url, headers=self.headers, timeout=self.timeout, params=params)
         # 匹配4xx错误，显示服务器返回的具体原因
             if response.status_code // 100 == 4:
@@ -415,23 +784,19 @@ class ChatGPT:
             log.exception(e)
             return None
 
-    def get_credit_usage(self):
-        url_usage = "https://platform.openai.com/usage"
-        console.print(f"Please go to {url_usage} to check usage.")
-        return False
-    
     def set_host(self, host: str):
         self.host = host
         self.endpoint = self.host + "/v1/chat/completions"
 
     def modify_system_prompt(self, new_content: str):
-        if self.messages[0]['role'] == 'system':
+        if self.messages.roles[0] == 'system':
             old_content = self.messages[0]['content']
-            self.messages[0]['content'] = new_content
+            # 消息可能已经写入磁盘，读到的是副本，需要整条替换
+            self.messages[0] = dict(self.messages[0], content=new_content)
+            self.token_ledger.update(0, self.messages[0])
+            self.journal.update(0, self.messages[0])
             console.print(
                 _("gpt_term.system_prompt_modified",old_content=old_content,new_content=new_content))
-            self.current_tokens = count_token(self.messages)
-            # recount current tokens
             if len(self.messages) > 1:
                 console.print(
                     _("gpt_term.system_prompt_note"))
@@ -466,6 +831,10 @@ class ChatGPT:
                 _("gpt_term.model_set"),old_model=old_model)
             return
         self.model = str(new_model)
+        # 不同模型的编码和消息格式开销可能不同
+        tokenizer = get_tokenizer(self.model)
+        self.token_ledger.set_tokenizer(tokenizer)
+        self.token_store.tokenizer = tokenizer
         if "gpt-4-1106-preview" in self.model:
             self.tokens_limit = 128000
         elif "gpt-4-vision-preview" in self.model:
@@ -506,98 +875,6 @@ class ChatGPT:
         console.print(_("gpt_term.temperature_set",temperature=temperature))
 
 
-class CommandCompleter(Completer):
-    def __init__(self):
-        self.nested_completer = NestedCompleter.from_nested_dict({
-            '/raw': None,
-            '/multi': None,
-            '/stream': {"visible", "ellipsis"},
-            '/tokens': None,
-            '/usage': None,
-            '/last': None,
-            '/copy': {"code", "all"},
-            '/model': {
-                "gpt-4-1106-preview", 
-                "gpt-4-vision-preview", 
-                "gpt-4", 
-                "gpt-4-0613", 
-                "gpt-4-32k", 
-                "gpt-4-32k-0613", 
-                "gpt-3.5-turbo-1106", 
-                "gpt-3.5-turbo", 
-                "gpt-3.5-turbo-0613", 
-                "gpt-3.5-turbo-16k", 
-                "gpt-3.5-turbo-16k-0613"},
-            '/save': PathCompleter(file_filter=self.path_filter),
-            '/system': None,
-            '/rand': None,
-            '/temperature': None,
-            '/title': None,
-            '/timeout': None,
-            '/undo': None,
-            '/delete': {"first", "all"},
-            '/reset': None,
-            '/lang' : {"zh_CN", "en", "jp", "de"},
-            '/version': None,
-            '/help': None,
-            '/exit': None,
-        })
-
-    def path_filter(self, filename):
-        # 路径自动补全，只补全json文件和文件夹
-        return filename.endswith(".json") or os.path.isdir(filename)
-
-    def get_completions(self, document, complete_event):
-        text = document.text_before_cursor
-        if text.startswith('/'):
-            for cmd in self.nested_completer.options.keys():
-                # 如果匹配到第一层命令
-                if text in cmd:
-                    yield Completion(cmd, start_position=-len(text))
-            # 如果匹配到第n层命令
-            if ' ' in text:
-                for sub_cmd in self.nested_completer.get_completions(document, complete_event):
-                    yield sub_cmd
-
-
-# 自定义命令补全，保证输入‘/’后继续显示补全
-command_completer = CommandCompleter()
-
-def count_token(messages: List[Dict[str, str]]):
-    '''计算 messages 占用的 token
-    `cl100k_base` 编码适用于: gpt-4, gpt-3.5-turbo, text-embedding-ada-002'''
-    encoding = tiktoken.get_encoding("cl100k_base")
-    length = 0
-    for message in messages:
-        length += len(encoding.encode(str(message)))
-    return length
-
-
-class NumberValidator(Validator):
-    def validate(self, document):
-        text = document.text
-        if not text.isdigit():
-            raise ValidationError(message=_("gpt_term.Error_input_int"),
-                                  cursor_position=len(text))
-
-class FloatRangeValidator(Validator):
-    def __init__(self, min_value=None, max_value=None):
-        self.min_value = min_value
-        self.max_value = max_value
-
-    def validate(self, document):
-        try:
-            value = float(document.text)
-        except ValueError:
-            raise ValidationError(message=_('gpt_term.Error_input_number'))
-
-        if self.min_value is not None and value < self.min_value:
-            raise ValidationError(message=_("gpt_term.Error_input_least",min_value=self.min_value))
-        if self.max_value is not None and value > self.max_value:
-            raise ValidationError(message=_("gpt_term.Error_input_most",max_value=self.max_value))
-        
-temperature_validator = FloatRangeValidator(min_value=0.0, max_value=2.0)
-
 def print_message(message: Dict[str, str]):
     '''打印单条来自 ChatGPT 或用户的消息'''
     role = message["role"]
@@ -605,6 +882,7 @@ def print_message(message: Dict[str, str]):
     if role == "user":
         print(f"> {content}")
     elif role == "assistant":
+        from rich.markdown import Markdown
         console.print("ChatGPT: ", end='', style="bold cyan")
         if ChatMode.raw_mode:
             print(content)
@@ -612,12 +890,35 @@ def print_message(message: Dict[str, str]):
             console.print(Markdown(content), new_line_start=True)
 
 
-def copy_code(message: Dict[str, str], select_code_idx: int = None):
+def copy_code(chat_gpt: ChatGPT, select_code_idx: str = None):
     '''Copy the code in ChatGPT's last reply to Clipboard'''
-    code_list = re.findall(r'```[\s\S]*?```', message["content"])
+    import pyperclip
+    from prompt_toolkit import prompt
+    from rich.markdown import Markdown
+
+    from .interactive import NumberValidator, style
+
+    code_blocks = chat_gpt.code_blocks
+    code_blocks.sync(chat_gpt.messages)
+    if select_code_idx is not None and select_code_idx.startswith('#'):
+        # #N 是 /copy code list 中的编号，可以复制之前任意一条回答中的代码
+        try:
+            number = int(select_code_idx[1:])
+        except ValueError:
+            console.print(_("gpt_term.code_index_must_int"))
+            return
+        if not 1 <= number <= len(code_blocks):
+            console.print(_("gpt_term.code_index_out_range_all", len_code_list=len(code_blocks)))
+            return
+        pyperclip.copy(code_blocks.code(chat_gpt.messages, code_blocks.blocks[number - 1]))
+        console.print(_("gpt_term.code_copy"))
+        return
+
+    code_list = code_blocks.blocks_of(-1)
     if len(code_list) == 0:
         console.print(_("gpt_term.code_not_found"))
         return
+    content = chat_gpt.messages[-1]["content"]
 
     if len(code_list) == 1 and select_code_idx is None:
         selected_code = code_list[0]
@@ -627,10 +928,10 @@ def copy_code(message: Dict[str, str], select_code_idx: int = None):
             console.print(
                 _("gpt_term.code_too_many_found"))
             code_num = 0
-            for codes in code_list:
+            for code in code_list:
                 code_num += 1
                 console.print(_("gpt_term.code_num",code_num=code_num))
-                console.print(Markdown(codes))
+                console.print(Markdown(f"```{code.language}\n{content[code.start:code.end]}\n```"))
 
             select_code_idx = prompt(
                 _("gpt_term.code_select"), style=style, validator=NumberValidator())
@@ -646,19 +947,43 @@ def copy_code(message: Dict[str, str], select_code_idx: int = None):
                     _("gpt_term.code_index_out_range_one"))
             else:
                 console.print(
-                    _("gpt_term.code_index_out_range_many",len(code_list)))
+                    _("gpt_term.code_index_out_range_many",len_code_list=len(code_list)))
                 # show idx range
-                # use len(code_list) instead of code_num as the max of idx
-                # in order to avoid error 'UnboundLocalError: local variable 'code_num' referenced before assignment' when inputing select_code_idx directly
             return
 
-    bpos = selected_code.find('\n')    # code begin pos.
-    epos = selected_code.rfind('```')  # code end pos.
-    pyperclip.copy(''.join(selected_code[bpos+1:epos-1]))
-    # erase code begin and end sign
+    pyperclip.copy(content[selected_code.start:selected_code.end])
+    # the index keeps where the code is, without its fences
     console.print(_("gpt_term.code_copy"))
 
 
+def list_code(chat_gpt: ChatGPT):
+    '''列出对话中所有回答的代码块，编号用于 /copy code #N'''
+    from rich.table import Table
+
+    code_blocks = chat_gpt.code_blocks
+    code_blocks.sync(chat_gpt.messages)
+    if len(code_blocks) == 0:
+        console.print(_("gpt_term.code_not_found"))
+        return
+    table = Table(title=_("gpt_term.code_list_title"), title_justify="left")
+    table.add_column("#", justify="right", style="dim")
+    table.add_column(_("gpt_term.code_list_reply"), justify="right")
+    table.add_column(_("gpt_term.code_list_language"), style="bold cyan")
+    table.add_column(_("gpt_term.code_list_lines"), justify="right")
+    table.add_column(_("gpt_term.code_list_first_line"), no_wrap=True, overflow="ellipsis")
+    # 回答按在对话中的先后编号，和 /history 显示的顺序一致
+    replies = {index: number for number, index in enumerate(
+        (index for index, role in enumerate(chat_gpt.messages.roles) if role == 'assistant'), 1)}
+    content, content_index = None, None
+    for number, block in enumerate(code_blocks.blocks, 1):
+        if block.message != content_index:
+            content, content_index = chat_gpt.messages[block.message]["content"], block.message
+        code = content[block.start:block.end]
+        table.add_row(str(number), str(replies.get(block.message, "")), block.language or "-",
+                      str(code.count('\n') + 1 if code else 0), code.strip().split('\n', 1)[0])
+    console.print(table)
+
+
 def change_CLI_title(new_title: str):
     if platform.system() == "Windows":
         os.system(f"title {new_title}")
@@ -668,240 +993,510 @@ def change_CLI_title(new_title: str):
         # flush the stdout buffer in order to making the control sequences effective immediately
     log.debug(f"CLI Title changed to '{new_title}'")
 
-def get_levenshtein_distance(s1: str, s2: str):
-    s1_len = len(s1)
-    s2_len = len(s2)
-
-    v = [[0 for _ in range(s2_len+1)] for _ in range(s1_len+1)]
-    for i in range(0, s1_len+1):
-        for j in range(0, s2_len+1):
-            if i == 0:
-                v[i][j] = j
-            elif j == 0:
-                v[i][j] = i
-            elif s1[i-1] == s2[j-1]:
-                v[i][j] = v[i-1][j-1]
-            else:
-                v[i][j] = min(v[i-1][j-1], min(v[i][j-1], v[i-1][j])) + 1
 
-    return v[s1_len][s2_len]
+# 斜杠命令：每个处理函数用 @commands.register 注册自己，handle_command 按命令名分发，输入补全也来自注册表
 
+@commands.register('/raw')
+def command_raw(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''切换原始模式'''
+    ChatMode.toggle_raw_mode()
 
-def handle_command(command: str, chat_gpt: ChatGPT, key_bindings: KeyBindings, chat_save_perfix: str):
-    '''处理斜杠(/)命令'''
-    global _
-    if command == '/raw':
-        ChatMode.toggle_raw_mode()
-    elif command == '/multi':
-        ChatMode.toggle_multi_line_mode()
 
-    elif command.startswith('/stream'):
-        args = command.split()
-        if len(args) > 1:
-            chat_gpt.set_stream_overflow(args[1])
-        else:
-            ChatMode.toggle_stream_mode()
+@commands.register('/multi')
+def command_multi(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''切换多行模式'''
+    ChatMode.toggle_multi_line_mode()
 
-    elif command == '/tokens':
-        chat_gpt.threadlock_total_tokens_spent.acquire()
-        console.print(Panel(_("gpt_term.tokens_used",total_tokens_spent=chat_gpt.total_tokens_spent,current_tokens=chat_gpt.current_tokens,tokens_limit=chat_gpt.tokens_limit),
-                            title=_("gpt_term.tokens_title"), title_align='left', width=40))
-        chat_gpt.threadlock_total_tokens_spent.release()
-
-    elif command == '/usage':
-        with console.status(_("gpt_term.usage_getting")):
-            if not chat_gpt.get_credit_usage():
-                return
-        console.print(Panel(f'{_("gpt_term.usage_granted",credit_total_granted=format(chat_gpt.credit_total_granted, ".2f"))}\n'
-                            f'{_("gpt_term.usage_used_month",credit_used_this_month=format(chat_gpt.credit_used_this_month, ".2f"))}\n'
-                            f'{_("gpt_term.usage_total",credit_total_used=format(chat_gpt.credit_total_used, ".2f"))}',
-                            title=_("gpt_term.usage_title"), title_align='left', subtitle=_("gpt_term.usage_plan",credit_plan=chat_gpt.credit_plan), width=35))
-
-    elif command.startswith('/model'):
-        args = command.split()
-        if len(args) > 1:
-            new_model = args[1]
+
+@commands.register('/stream', options={"visible", "ellipsis"})
+def command_stream(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''切换流式模式，或设置流式输出超出屏幕时的显示方式'''
+    args = command.split()
+    if len(args) > 1:
+        chat_gpt.set_stream_overflow(args[1])
+    else:
+        ChatMode.toggle_stream_mode()
+
+
+@commands.register('/tokens')
+def command_tokens(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''显示 token 用量'''
+    from rich.panel import Panel
+
+    chat_gpt.threadlock_total_tokens_spent.acquire()
+    tokens_used = _("gpt_term.tokens_used",total_tokens_spent=chat_gpt.total_tokens_spent,current_tokens=chat_gpt.current_tokens,tokens_limit=chat_gpt.tokens_limit)
+    tokens_used += "\n" + _("gpt_term.tokens_split",prompt_tokens=chat_gpt.prompt_tokens_spent,completion_tokens=chat_gpt.completion_tokens_spent)
+    if chat_gpt.response_cache.enabled:
+        tokens_used += "\n" + _("gpt_term.tokens_cache",hits=chat_gpt.response_cache.hits,misses=chat_gpt.response_cache.misses)
+    if chat_gpt.title_latency is not None:
+        tokens_used += "\n" + _("gpt_term.tokens_title_gen",title_tokens=chat_gpt.title_tokens_spent,latency=format(chat_gpt.title_latency, ".1f"))
+    console.print(Panel(tokens_used,
+                        title=_("gpt_term.tokens_title"), title_align='left', width=50))
+    chat_gpt.threadlock_total_tokens_spent.release()
+
+
+@commands.register('/stats', options={"export", "clear"})
+def command_stats(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''显示、导出或清空请求指标'''
+    args = command.split()
+    if len(args) == 1:
+        if not len(chat_gpt.metrics):
+            console.print(_("gpt_term.stats_nothing"))
         else:
-            new_model = prompt(
-                "OpenAI API model: ", default=chat_gpt.model, style=style)
-        if new_model != chat_gpt.model:
-            chat_gpt.set_model(new_model)
+            from .metrics import stats_table
+            console.print(stats_table(chat_gpt.metrics))
+    elif args[1] == 'clear':
+        chat_gpt.metrics.clear()
+        console.print(_("gpt_term.stats_cleared"))
+    elif args[1] == 'export' and len(args) in (3, 4) and (len(args) == 3 or args[3] in ('jsonl', 'prometheus')):
+        try:
+            turns = chat_gpt.metrics.export(args[2], args[3] if len(args) == 4 else None)
+        except OSError as e:
+            console.print(_("gpt_term.Error_message", error_msg=str(e)))
         else:
-            console.print(_("gpt_term.No_change"))
+            console.print(_("gpt_term.stats_exported", turns=turns, path=args[2]), highlight=False)
+    else:
+        console.print(_("gpt_term.stats_usage"))
 
-    elif command == '/last':
-        reply = chat_gpt.messages[-1]
-        print_message(reply)
-
-    elif command.startswith('/copy'):
-        args = command.split()
-        reply = chat_gpt.messages[-1]
-        if len(args) > 1:
-            if args[1] == 'all':
-                pyperclip.copy(reply["content"])
-                console.print(_("gpt_term.code_last_copy"))
-            elif args[1] == 'code':
-                if len(args) > 2:
-                    copy_code(reply, args[2])
-                else:
-                    copy_code(reply)
-            else:
-                console.print(
-                    _("gpt_term.code_copy_fail"))
-        else:
-            pyperclip.copy(reply["content"])
-            console.print(_("gpt_term.code_last_copy"))
 
-    elif command.startswith('/save'):
-        args = command.split()
-        if len(args) > 1:
-            filename = args[1]
-        else:
-            gen_filename = chat_gpt.gen_title()
-            if gen_filename:
-                gen_filename = re.sub(r'[\/\\\*\?\"\<\>\|\:]', '', gen_filename)
-                gen_filename = f"{chat_save_perfix}{gen_filename}.json"
-            # here: if title is already generated or generating, just use it
-            # but title auto generation can also be disabled; therefore when title is not generated then try generating a new one
-            date_filename = f'{chat_save_perfix}{datetime.now().strftime("%Y-%m-%d_%H,%M,%S")}.json'
-            filename = prompt(
-                "Save to: ", default=gen_filename or date_filename, style=style)
-        chat_gpt.save_chat_history(filename)
-
-    elif command.startswith('/system'):
-        args = command.split()
-        if len(args) > 1:
-            new_content = ' '.join(args[1:])
-        else:
-            new_content = prompt(
-                _("gpt_term.system_prompt"), default=chat_gpt.messages[0]['content'], style=style, key_bindings=key_bindings)
-        if new_content != chat_gpt.messages[0]['content']:
-            chat_gpt.modify_system_prompt(new_content)
-        else:
-            console.print(_("gpt_term.No_change"))
+@commands.register('/usage', options={"day", "model", "session"})
+def command_usage(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''显示 usage.db 中的用量和费用'''
+    import sqlite3
 
-    elif command.startswith('/rand') or command.startswith('/temperature'):
-        args = command.split()
-        if len(args) > 1:
-            new_temperature = args[1]
-        else:
-            new_temperature = prompt(
-                _("gpt_term.new_temperature"), default=str(chat_gpt.temperature), style=style, validator=temperature_validator)
-        if new_temperature != str(chat_gpt.temperature):
-            chat_gpt.set_temperature(new_temperature)
-        else:
-            console.print(_("gpt_term.No_change"))            
+    from rich.panel import Panel
 
-    elif command.startswith('/title'):
-        args = command.split()
-        if len(args) > 1:
-            chat_gpt.title = ' '.join(args[1:])
-            change_CLI_title(chat_gpt.title)
-        else:
-            # generate a new title
-            new_title = chat_gpt.gen_title(force=True)
-            if not new_title:
-                console.print(_("gpt_term.title_gen_fail"))
-                return
-        console.print(_('gpt_term.title_changed',title=chat_gpt.title))
-
-    elif command.startswith('/timeout'):
-        args = command.split()
-        if len(args) > 1:
-            new_timeout = args[1]
-        else:
-            new_timeout = prompt(
-                _("gpt_term.timeout_prompt"), default=str(chat_gpt.timeout), style=style)
-        if new_timeout != str(chat_gpt.timeout):
-            chat_gpt.set_timeout(new_timeout)
+    from .usage import usage_table
+
+    args = command.split()
+    if len(args) > 3 or (len(args) > 1 and args[1] not in ('day', 'model', 'session')) or \
+            (len(args) == 3 and not (args[2].isdigit() and int(args[2]) > 0)):
+        console.print(_("gpt_term.usage_usage"), highlight=False)
+        return
+    count = int(args[2]) if len(args) == 3 else None
+    try:
+        if len(args) == 1:
+            lines = []
+            for label, row in ((_("gpt_term.usage_today"), chat_gpt.usage.total(period_start('day'))),
+                               (_("gpt_term.usage_month"), chat_gpt.usage.total(period_start('month'))),
+                               (_("gpt_term.usage_session"), chat_gpt.usage.total(session=chat_gpt.usage.session))):
+                lines.append(_("gpt_term.usage_line", label=label, requests=row.requests,
+                               tokens=f"{row.prompt_tokens + row.completion_tokens:,}", cost=format_cost(row.cost)))
+            budget = chat_gpt.budget
+            if budget.enabled:
+                spent = chat_gpt.usage.total(period_start(budget.period)).cost or 0.0
+                lines.append(_("gpt_term.usage_budget", period=_(f"gpt_term.budget_period_{budget.period}"),
+                               spent=format_cost(spent), soft=format_cost(budget.soft or None),
+                               hard=format_cost(budget.hard or None)))
+            console.print(Panel("\n".join(lines), title=_("gpt_term.usage_title"), title_align='left', width=60),
+                          highlight=False)
+        elif args[1] == 'day':
+            console.print(usage_table(_("gpt_term.usage_by_day", days=count or 14), _("gpt_term.usage_day"),
+                                      chat_gpt.usage.by_day(count or 14)))
+        elif args[1] == 'model':
+            since = (date.today() - timedelta(days=count - 1)).isoformat() if count else ""
+            title = _("gpt_term.usage_by_model", days=count) if count else _("gpt_term.usage_by_model_all")
+            console.print(usage_table(title, _("gpt_term.usage_model"), chat_gpt.usage.by_model(since)))
         else:
-            console.print(_("gpt_term.No_change"))
+            console.print(usage_table(_("gpt_term.usage_by_session", sessions=count or 10), _("gpt_term.usage_session"),
+                                      chat_gpt.usage.by_session(count or 10)))
+    except sqlite3.Error as e:
+        console.print(_("gpt_term.Error_message", error_msg=str(e)))
+        log.exception(e)
 
-    elif command == '/undo':
-        if len(chat_gpt.messages) > 2:
-            question = chat_gpt.messages.pop()
-            if question['role'] == "assistant":
-                question = chat_gpt.messages.pop()
-            truncated_question = question['content'].split('\n')[0]
-            if len(question['content']) > len(truncated_question):
-                truncated_question += "..."
-            console.print(
-                _("gpt_term.undo_removed",truncated_question=truncated_question))
-            chat_gpt.current_tokens = count_token(chat_gpt.messages)
+
+@commands.register('/model', options={
+    "gpt-4-1106-preview", "gpt-4-vision-preview", "gpt-4", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613",
+    "gpt-3.5-turbo-1106", "gpt-3.5-turbo", "gpt-3.5-turbo-0613", "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613"})
+def command_model(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''切换模型'''
+    from prompt_toolkit import prompt
+
+    from .interactive import style
+
+    args = command.split()
+    if len(args) > 1:
+        new_model = args[1]
+    else:
+        new_model = prompt(
+            "OpenAI API model: ", default=chat_gpt.model, style=style)
+    if new_model != chat_gpt.model:
+        chat_gpt.set_model(new_model)
+    else:
+        console.print(_("gpt_term.No_change"))
+
+
+@commands.register('/history')
+def command_history(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''向前翻页显示较早的消息'''
+    args = command.split()
+    if len(args) > 1 and not args[1].isdigit():
+        console.print(_("gpt_term.Error_input_number"))
+    else:
+        chat_gpt.show_earlier_messages(int(args[1]) if len(args) > 1 else 10)
+
+
+@commands.register('/search')
+def command_search(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''搜索保存过的聊天记录并打开选中的一个'''
+    from prompt_toolkit import prompt
+
+    from .interactive import style
+
+    args = command.split(maxsplit=1)
+    if len(args) > 1:
+        query = args[1]
+    else:
+        query = prompt(_("gpt_term.search_prompt"), style=style)
+    selected = search_chat_history(chat_gpt, query, chat_save_perfix)
+    if selected and open_chat_history(chat_gpt, selected):
+        chat_gpt.journal.start_from(selected, len(chat_gpt.messages))
+
+
+@commands.register('/compare')
+def command_compare(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''用多个模型回答同一个问题'''
+    from prompt_toolkit import prompt
+
+    from .interactive import style
+
+    args = command.split(maxsplit=2)
+    if len(args) > 1 and ("," in args[1] or not chat_gpt.compare_models):
+        models = parse_models(args[1])
+        question = args[2] if len(args) > 2 else ""
+    else:
+        models = chat_gpt.compare_models
+        question = command.split(maxsplit=1)[1] if len(args) > 1 else ""
+    if len(models) < 2:
+        console.print(_("gpt_term.compare_usage"), highlight=False)
+        return
+    if not question.strip():
+        question = prompt(_("gpt_term.compare_question"), style=style)
+        if not question.strip():
+            return
+    log.info(f"> /compare {','.join(models)}: {question}")
+    runs = compare_models(chat_gpt, models, question)
+    replies = [run for run in runs if run.reply and not run.error and not run.aborted]
+    if not replies:
+        return
+    selected = prompt(_("gpt_term.compare_keep"), style=style).strip()
+    if selected.isdigit() and 1 <= int(selected) <= len(runs) and runs[int(selected) - 1].reply:
+        # 选中的回答和问题一起加入当前对话
+        chat_gpt.add_message({"role": "user", "content": question})
+        chat_gpt.add_message({"role": "assistant", "content": runs[int(selected) - 1].reply})
+        console.print(_("gpt_term.compare_kept", model=runs[int(selected) - 1].model), highlight=False)
+    elif selected:
+        console.print(_("gpt_term.Error_input_number"))
+
+
+@commands.register('/session', options={"new", "switch", "list"})
+def command_session(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''列出、新建或切换会话'''
+    sessions = chat_gpt.sessions
+    args = command.split()
+    if len(args) == 1 or (args[1] == 'list' and len(args) == 2):
+        console.print(sessions.table())
+    elif args[1] == 'new' and len(args) <= 3:
+        session = sessions.new(args[2] if len(args) == 3 else None)
+        if session is None:
+            console.print(_("gpt_term.session_exists", name=args[2]), highlight=False)
         else:
-            console.print(_("gpt_term.undo_nothing"))
-
-    elif command.startswith('/reset'):
-        chat_gpt.delete_all_conversation()
-
-    elif command.startswith('/delete'):
-        args = command.split()
-        if len(args) > 1:
-            if args[1] == 'first':
-                chat_gpt.delete_first_conversation()
-            elif args[1] == 'all':
-                chat_gpt.delete_all_conversation()
+            console.print(_("gpt_term.session_created", name=session.name), highlight=False)
+    elif args[1] == 'switch' and len(args) == 3:
+        session = sessions.switch(args[2])
+        if session is None:
+            console.print(_("gpt_term.session_not_found", name=args[2]), highlight=False)
+            return
+        console.print(_("gpt_term.session_switched", name=session.name), highlight=False)
+        if session.chat_gpt.title:
+            change_CLI_title(session.chat_gpt.title)
+        # 后台收到的回答在切换过来时显示
+        sessions.show(session)
+    else:
+        console.print(_("gpt_term.session_usage"), highlight=False)
+
+
+@commands.register('/bg')
+def command_bg(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''在当前会话中后台提问'''
+    args = command.split(maxsplit=1)
+    if len(args) == 1:
+        console.print(_("gpt_term.bg_usage"), highlight=False)
+        return
+    log.info(f"> /bg {args[1]}")
+    if chat_gpt.sessions.send(args[1]):
+        console.print(_("gpt_term.session_sent", name=chat_gpt.sessions.current.name), highlight=False)
+
+
+@commands.register('/last')
+def command_last(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''显示最后一条回答'''
+    reply = chat_gpt.messages[-1]
+    print_message(reply)
+
+
+@commands.register('/copy', options={"code": {"list"}, "all": None})
+def command_copy(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''复制最后一条回答或其中的代码'''
+    import pyperclip
+
+    args = command.split()
+    reply = chat_gpt.messages[-1]
+    if len(args) > 1:
+        if args[1] == 'all':
+            pyperclip.copy(reply["content"])
+            console.print(_("gpt_term.code_last_copy"))
+        elif args[1] == 'code':
+            if len(args) > 2 and args[2] == 'list':
+                list_code(chat_gpt)
+            elif len(args) > 2:
+                copy_code(chat_gpt, args[2])
             else:
-                console.print(
-                    _("gpt_term.delete_nothing"))
+                copy_code(chat_gpt)
         else:
-            chat_gpt.delete_first_conversation()
+            console.print(
+                _("gpt_term.code_copy_fail"))
+    else:
+        pyperclip.copy(reply["content"])
+        console.print(_("gpt_term.code_last_copy"))
 
-    elif command == '/version':
-        threadlock_remote_version.acquire()
-        string=_("gpt_term.version_all",local_version=str(local_version),remote_version=str(remote_version))
-        console.print(Panel(string,
-                            title=_("gpt_term.version_name"), title_align='left', width=28))
-        threadlock_remote_version.release()
-    
-    elif command.startswith('/lang'):
-        args = command.split()
-        if len(args) > 1:
-            new_lang = args[1]
-        else:
-            new_lang = prompt(
-                _("gpt_term.new_lang_prompt"), default=get_lang(), style=style)
-        if new_lang != get_lang():
-            if new_lang in supported_langs:
-                _=set_lang(new_lang)
-                console.print(_("gpt_term.lang_switch"))
-            else:
-                console.print(_("gpt_term.lang_unsupport", new_lang=new_lang))
+
+@commands.register('/extract', options=PATH_OPTIONS)
+def command_extract(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''把对话中所有回答的代码块写入文件夹，每个代码块一个文件'''
+    args = command.split(maxsplit=1)
+    if len(args) != 2:
+        console.print(_("gpt_term.extract_usage"))
+        return
+    code_blocks = chat_gpt.code_blocks
+    code_blocks.sync(chat_gpt.messages)
+    if len(code_blocks) == 0:
+        console.print(_("gpt_term.code_not_found"))
+        return
+    directory = Path(args[1].strip()).expanduser()
+    # 文件名为 /copy code list 中的编号加上语言对应的扩展名，例如 code_03.py
+    width = len(str(len(code_blocks)))
+    content, content_index = None, None
+    try:
+        directory.mkdir(parents=True, exist_ok=True)
+        for number, block in enumerate(code_blocks.blocks, 1):
+            if block.message != content_index:
+                content, content_index = chat_gpt.messages[block.message]["content"], block.message
+            code = content[block.start:block.end]
+            with open(directory / f"code_{number:0{width}d}.{extension(block.language)}", "w", encoding="utf-8") as f:
+                f.write(code if code.endswith('\n') else code + '\n')
+    except OSError as e:
+        console.print(_("gpt_term.Error_message", error_msg=str(e)))
+        return
+    console.print(_("gpt_term.extract_done", count=len(code_blocks), directory=str(directory)), highlight=False)
+
+
+@commands.register('/save', options=PATH_OPTIONS)
+def command_save(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''保存聊天记录'''
+    from prompt_toolkit import prompt
+
+    from .interactive import style
+
+    args = command.split()
+    if len(args) > 1:
+        filename = args[1]
+    else:
+        gen_filename = chat_gpt.gen_title()
+        if gen_filename:
+            gen_filename = re.sub(r'[\/\\\*\?\"\<\>\|\:]', '', gen_filename)
+            gen_filename = f"{chat_save_perfix}{gen_filename}.json"
+        # here: if title is already generated or generating, just use it
+        # but title auto generation can also be disabled; therefore when title is not generated then try generating a new one
+        date_filename = f'{chat_save_perfix}{datetime.now().strftime("%Y-%m-%d_%H,%M,%S")}.json'
+        filename = prompt(
+            "Save to: ", default=gen_filename or date_filename, style=style)
+    chat_gpt.save_chat_history(filename)
+
+
+@commands.register('/system')
+def command_system(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''修改系统提示'''
+    from prompt_toolkit import prompt
+
+    from .interactive import style
+
+    args = command.split()
+    if len(args) > 1:
+        new_content = ' '.join(args[1:])
+    else:
+        new_content = prompt(
+            _("gpt_term.system_prompt"), default=chat_gpt.messages[0]['content'], style=style, key_bindings=key_bindings)
+    if new_content != chat_gpt.messages[0]['content']:
+        chat_gpt.modify_system_prompt(new_content)
+    else:
+        console.print(_("gpt_term.No_change"))
+
+
+@commands.register('/rand', '/temperature')
+def command_temperature(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''设置 temperature'''
+    from prompt_toolkit import prompt
+
+    from .interactive import style, temperature_validator
+
+    args = command.split()
+    if len(args) > 1:
+        new_temperature = args[1]
+    else:
+        new_temperature = prompt(
+            _("gpt_term.new_temperature"), default=str(chat_gpt.temperature), style=style, validator=temperature_validator)
+    if new_temperature != str(chat_gpt.temperature):
+        chat_gpt.set_temperature(new_temperature)
+    else:
+        console.print(_("gpt_term.No_change"))
+
+
+@commands.register('/title')
+def command_title(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''设置或重新生成标题'''
+    args = command.split()
+    if len(args) > 1:
+        chat_gpt.cancel_title()
+        chat_gpt.title = ' '.join(args[1:])
+        change_CLI_title(chat_gpt.title)
+    else:
+        # generate a new title
+        new_title = chat_gpt.gen_title(force=True)
+        if not new_title:
+            console.print(_("gpt_term.title_gen_fail"))
+            return
+    console.print(_('gpt_term.title_changed',title=chat_gpt.title))
+
+
+@commands.register('/timeout')
+def command_timeout(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''设置请求超时时间'''
+    from prompt_toolkit import prompt
+
+    from .interactive import style
+
+    args = command.split()
+    if len(args) > 1:
+        new_timeout = args[1]
+    else:
+        new_timeout = prompt(
+            _("gpt_term.timeout_prompt"), default=str(chat_gpt.timeout), style=style)
+    if new_timeout != str(chat_gpt.timeout):
+        chat_gpt.set_timeout(new_timeout)
+    else:
+        console.print(_("gpt_term.No_change"))
+
+
+@commands.register('/undo')
+def command_undo(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''撤回最后一个问题和它的回答'''
+    if len(chat_gpt.messages) > 2:
+        question = chat_gpt.pop_message()
+        if question['role'] == "assistant":
+            question = chat_gpt.pop_message()
+        truncated_question = question['content'].split('\n')[0]
+        if len(question['content']) > len(truncated_question):
+            truncated_question += "..."
+        console.print(
+            _("gpt_term.undo_removed",truncated_question=truncated_question))
+    else:
+        console.print(_("gpt_term.undo_nothing"))
+
+
+@commands.register('/reset')
+def command_reset(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''清空对话'''
+    chat_gpt.delete_all_conversation()
+
+
+@commands.register('/delete', options={"first", "all"})
+def command_delete(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''删除第一轮或全部对话'''
+    args = command.split()
+    if len(args) > 1:
+        if args[1] == 'first':
+            chat_gpt.delete_first_conversation()
+        elif args[1] == 'all':
+            chat_gpt.delete_all_conversation()
         else:
-            console.print(_("gpt_term.No_change"))
+            console.print(
+                _("gpt_term.delete_nothing"))
+    else:
+        chat_gpt.delete_first_conversation()
 
-    elif command == '/exit':
-        raise EOFError
 
-    elif command == '/help':
-        console.print(_("gpt_term.help_text"))
-        
+@commands.register('/version')
+def command_version(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''显示版本'''
+    from rich.panel import Panel
+
+    threadlock_remote_version.acquire()
+    string=_("gpt_term.version_all",local_version=str(local_version),remote_version=str(remote_version))
+    console.print(Panel(string,
+                        title=_("gpt_term.version_name"), title_align='left', width=28))
+    threadlock_remote_version.release()
+
+
+@commands.register('/lang', options={"zh_CN", "en", "jp", "de"})
+def command_lang(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''切换语言'''
+    global _
+    from prompt_toolkit import prompt
+
+    from .interactive import style
+
+    args = command.split()
+    if len(args) > 1:
+        new_lang = args[1]
     else:
-        set_command = set(command)
-        min_levenshtein_distance = len(command)
-        most_similar_command = ""
-        for slash_command in command_completer.nested_completer.options.keys():
-            this_levenshtein_distance = get_levenshtein_distance(command, slash_command)
-            if this_levenshtein_distance < min_levenshtein_distance:
-                set_slash_command = set(slash_command)
-                if len(set_command & set_slash_command) / len(set_command | set_slash_command) >= 0.75:
-                    most_similar_command = slash_command
-                    min_levenshtein_distance = this_levenshtein_distance
-        
-        console.print(_("gpt_term.help_uncommand",command=command), end=" ")
-        if most_similar_command:
-            console.print(_("gpt_term.help_mean_command",most_similar_command=most_similar_command))
+        new_lang = prompt(
+            _("gpt_term.new_lang_prompt"), default=get_lang(), style=style)
+    if new_lang != get_lang():
+        if new_lang in supported_langs:
+            _=set_lang(new_lang)
+            console.print(_("gpt_term.lang_switch"))
         else:
-            console.print("")
-        console.print(_("gpt_term.help_use_help"))
+            console.print(_("gpt_term.lang_unsupport", new_lang=new_lang))
+    else:
+        console.print(_("gpt_term.No_change"))
+
+
+@commands.register('/exit')
+def command_exit(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''退出'''
+    raise EOFError
+
+
+@commands.register('/help')
+def command_help(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''显示帮助'''
+    console.print(_("gpt_term.help_text"))
+
+
+def handle_command(command: str, chat_gpt: ChatGPT, key_bindings, chat_save_perfix: str):
+    '''处理斜杠(/)命令：按第一个词在注册表中找到处理函数'''
+    entry = commands.get(command)
+    if entry is not None:
+        entry.handler(command, chat_gpt, key_bindings, chat_save_perfix)
+        return
+    console.print(_("gpt_term.help_uncommand",command=command), end=" ")
+    most_similar_command = commands.suggest(command)
+    if most_similar_command:
+        console.print(_("gpt_term.help_mean_command",most_similar_command=most_similar_command))
+    else:
+        console.print("")
+    console.print(_("gpt_term.help_use_help"))
 
 
 def load_chat_history(file_path):
-    '''从 file_path 加载聊天记录'''
+    '''从 file_path 加载聊天记录，.jsonl 文件按会话日志重放'''
     try:
+        if is_journal(file_path):
+            return replay_journal(file_path, lambda base, error: console.print(
+                _("gpt_term.journal_base_missing", base=base, error=str(error)), highlight=False))
         with open(file_path, 'r', encoding='utf-8') as f:
-            chat_history = json.load(f)
-        return chat_history
+            return list(iter_json_array(f))
     except FileNotFoundError:
         console.print(_("gpt_term.load_file_not",file_path=file_path))
     except json.JSONDecodeError:
@@ -909,8 +1504,102 @@ def load_chat_history(file_path):
     return None
 
 
+def open_chat_history(chat_gpt: ChatGPT, file_path: str, show: bool = True) -> bool:
+    '''载入聊天记录作为当前对话，show 时显示最近的几条，较早的消息用 /history 翻页查看'''
+    chat_history = load_chat_history(file_path)
+    if chat_history:
+        change_CLI_title(file_path.rstrip(".json"))
+        chat_gpt.load_messages(chat_history)
+        if show:
+            chat_gpt.show_earlier_messages(chat_gpt.load_show_last)
+        log.info(f"Chat history successfully loaded from: {file_path}")
+        console.print(
+            _("gpt_term.load_chat_history",load=file_path), highlight=False)
+    # 不返回载入的列表，否则已经写入磁盘的消息会一直留在内存中
+    return bool(chat_history)
+
+
+def search_chat_history(chat_gpt: ChatGPT, query: str, chat_save_perfix: str, limit: int = 10):
+    '''在保存过的聊天记录中搜索，在终端中可以选择一个结果打开，返回选中的文件路径'''
+    from rich.markup import escape
+    try:
+        chat_gpt.search_index.sync(iter_history_files(chat_save_perfix, data_dir))
+        results = chat_gpt.search_index.search(query, limit)
+    except Exception as e:
+        # 例如 sqlite3 没有编译 FTS5 模块
+        log.exception(e)
+        console.print(_("gpt_term.search_unavailable", error=e), highlight=False)
+        return None
+    if not results:
+        console.print(_("gpt_term.search_nothing", query=query), highlight=False)
+        return None
+
+    for index, result in enumerate(results, 1):
+        role = "ChatGPT" if result.role == "assistant" else "User"
+        saved_time = datetime.fromtimestamp(result.mtime).strftime("%Y-%m-%d %H:%M")
+        snippet = escape(" ".join(result.snippet.split())).replace(MATCH_START, "[bold yellow]").replace(MATCH_END, "[/]")
+        console.print(f"[bold]{index}.[/] [deep_sky_blue3]{escape(result.path)}[/] [dim]{saved_time} #{result.position} {role}[/]",
+                      highlight=False)
+        console.print(f"   {snippet}", highlight=False)
+
+    if not (os.isatty(sys.stdin.fileno()) and os.isatty(sys.stdout.fileno())):
+        return None
+    from prompt_toolkit import prompt
+
+    from .interactive import style
+    selected = prompt(_("gpt_term.search_open"), style=style).strip()
+    if selected.isdigit() and 1 <= int(selected) <= len(results):
+        return results[int(selected) - 1].path
+    if selected:
+        console.print(_("gpt_term.Error_input_number"))
+    return None
+
+
+def compare_models(chat_gpt: ChatGPT, models: List[str], question: str):
+    '''把同一个问题（连同当前上下文）同时发给多个模型，并排或依次显示回答和每个模型的耗时统计'''
+    from rich.live import Live
+
+    from .compare import (MIN_COLUMN_WIDTH, ModelComparison, columns_view, progress_view, reply_panel,
+                          stats_table)
+    if not chat_gpt.check_budget():
+        return []
+    messages = chat_gpt.context_messages(notify=True) + [{"role": "user", "content": question}]
+    comparison = ModelComparison(chat_gpt, models, messages)
+    layout = chat_gpt.compare_layout
+    if layout == 'columns' and console.width < MIN_COLUMN_WIDTH * len(models):
+        # 终端太窄放不下所有列
+        layout = 'sequential'
+    interval = 1 / chat_gpt.stream_refresh_rate
+
+    if layout == 'columns':
+        with Live(columns_view(comparison.runs, ChatMode.raw_mode), console=console.get(), auto_refresh=False,
+                  vertical_overflow=chat_gpt.stream_overflow) as live:
+            def on_update(runs):
+                live.update(columns_view(runs, ChatMode.raw_mode), refresh=True)
+            chat_gpt.aio.run(comparison.run(on_update, interval))
+    else:
+        printed = set()
+        with Live(progress_view(comparison.runs), console=console.get(), transient=True) as live:
+            def on_update(runs):
+                # 按完成的先后顺序显示在进度上方
+                for run in runs:
+                    if run.done and run.model not in printed:
+                        printed.add(run.model)
+                        live.console.print(reply_panel(run, markdown=not ChatMode.raw_mode))
+                live.update(progress_view(runs))
+            chat_gpt.aio.run(comparison.run(on_update, interval))
+
+    if comparison.aborted:
+        console.print(_("gpt_term.Aborted"))
+    console.print(stats_table(comparison.runs))
+    return comparison.runs
+
+
 def create_key_bindings():
     '''自定义回车事件绑定，实现斜杠命令的提交忽略多行模式，以及单行模式下 `esc+Enter` 换行'''
+    from prompt_toolkit.key_binding import KeyBindings
+    from prompt_toolkit.keys import Keys
+
     key_bindings = KeyBindings()
 
     @key_bindings.add(Keys.Enter)
@@ -933,10 +1622,11 @@ def create_key_bindings():
     return key_bindings
 
 
-def get_remote_version():
+def get_remote_version(transport: Transport):
     global remote_version
+    from packaging.version import parse as parse_version
     try:
-        response = requests.get(
+        response = transport.get(
             "https://pypi.org/pypi/gpt-term/json", timeout=10)
         response.raise_for_status()
         threadlock_remote_version.acquire()
@@ -1027,6 +1717,12 @@ def main():
     parser.add_argument('--set-loglevel', metavar='LEVEL', type=str, help=_("gpt_term.help_set_loglevel")+'DEBUG, INFO, WARNING, ERROR, CRITICAL')
     # Query without parameter
     parser.add_argument("query", nargs="*", help=_("gpt_term.help_direct_query"))
+    # Batch mode
+    parser.add_argument('--batch', metavar='FILE', type=str, help=_("gpt_term.help_batch"))
+    parser.add_argument('--workers', metavar='N', type=int, help=_("gpt_term.help_workers"))
+    parser.add_argument('--batch-order', type=str, choices=['input', 'completion'], default='input', help=_("gpt_term.help_batch_order"))
+    parser.add_argument('--search', metavar='QUERY', type=str, help=_("gpt_term.help_search"))
+    parser.add_argument('--models', metavar='MODELS', type=str, help=_("gpt_term.help_models"))
     # setting args
     args = parser.parse_args()
 
@@ -1049,11 +1745,6 @@ def main():
     log.debug(f"Local version: {str(local_version)}")
     # get local version from pkg resource
 
-    check_remote_update_thread = threading.Thread(target=get_remote_version, daemon=True)
-    check_remote_update_thread.start()
-    log.debug("Remote version get thread started")
-    # try to get remote version and check update
-
     # if 'key' arg triggered, load the api key from config.ini with the given key-name;
     # otherwise load the api key with the key-name "OPENAI_API_KEY"
     if args.key:
@@ -1063,6 +1754,8 @@ def main():
         api_key = config.get("OPENAI_API_KEY")
 
     if not api_key:
+        from prompt_toolkit import prompt
+        from prompt_toolkit.shortcuts import confirm
         log.debug("API Key not found, waiting for input")
         api_key = prompt(_("gpt_term.input_api_key"))
         if confirm(_("gpt_term.save_api_key"), suffix=" (y/N) "):
@@ -1077,8 +1770,20 @@ def main():
 
     chat_save_perfix = config.get("CHAT_SAVE_PERFIX", "./chat_history_")
 
-    chat_gpt = ChatGPT(api_key, api_timeout)
-    
+    pool_size = config.getint("HTTP_POOL_SIZE", 10)
+    batch_workers = args.workers or config.getint("BATCH_WORKERS", 4)
+    if args.batch:
+        # 每个并发请求都需要一个可复用的连接
+        pool_size = max(pool_size, batch_workers)
+    try:
+        chat_gpt = ChatGPT(api_key, api_timeout, pool_size, config.getboolean("HTTP2", False))
+    except ImportError:
+        console.print(_("gpt_term.http2_unavailable"))
+        chat_gpt = ChatGPT(api_key, api_timeout, pool_size)
+    log.debug(f"HTTP pool size: {pool_size}, HTTP/2: {chat_gpt.transport.http2}")
+    chat_gpt.transport.limiter.set_limits(config.getfloat("RATE_LIMIT_RPM", 0), config.getfloat("RATE_LIMIT_TPM", 0))
+    chat_gpt.transport.max_retries = config.getint("MAX_RETRIES", 3)
+
     if config.get("OPENAI_HOST"):
         chat_gpt.set_host(config.get("OPENAI_HOST"))
     
@@ -1089,14 +1794,29 @@ def main():
         chat_gpt.auto_gen_title_background_enable = False
         log.debug("Auto title generation [bright_red]disabled[/]")
 
-    gen_title_daemon_thread = threading.Thread(
-        target=chat_gpt.auto_gen_title_background, daemon=True)
-    gen_title_daemon_thread.start()
-    log.debug("Title generation daemon thread started")
-
+    chat_gpt.stream_refresh_rate = config.getfloat("STREAM_REFRESH_RATE", 15)
+    chat_gpt.pipe_flush = config.get("PIPE_FLUSH", "delta")
+    chat_gpt.load_show_last = config.getint("LOAD_SHOW_LAST", 10)
+    chat_gpt.stream_usage = config.getboolean("STREAM_USAGE", True)
+    chat_gpt.metrics = Metrics(config.getint("METRICS_BUFFER", 500), config.get("METRICS_FILE") or None)
+    chat_gpt.usage.prices = PriceTable(config.get("PRICES", ""))
+    chat_gpt.budget = Budget(config.get("BUDGET_PERIOD", "month"), config.getfloat("BUDGET_SOFT", 0),
+                             config.getfloat("BUDGET_HARD", 0))
+    chat_gpt.compare_layout = config.get("COMPARE_LAYOUT", "columns")
+    if chat_gpt.compare_layout not in COMPARE_LAYOUTS:
+        chat_gpt.compare_layout = 'columns'
+    chat_gpt.response_cache = ResponseCache(data_dir / 'cache', config.getboolean("RESPONSE_CACHE", False), int(
+        config.getfloat("RESPONSE_CACHE_SIZE", 50) * 1024 * 1024), config.getfloat("RESPONSE_CACHE_TTL", 7) * 86400)
+    chat_gpt.messages.resident_bytes = int(config.getfloat("MESSAGE_MEMORY_SIZE", 64) * 1024 * 1024)
+    chat_gpt.context_policy = ContextPolicy(config.get("CONTEXT_POLICY", "sliding"), config.getfloat(
+        "CONTEXT_BUDGET", 0.8), config.getint("CONTEXT_KEEP_TURNS", 10), config.getint("CONTEXT_RELEVANT_TURNS", 4))
+
+    is_stdout_tty = os.isatty(sys.stdout.fileno())
     if args.host:
         chat_gpt.set_host(args.host)
-        console.print(_("gpt_term.host_set", new_host=args.host))
+        if is_stdout_tty:
+            console.print(_("gpt_term.host_set", new_host=args.host))
+        # 管道模式下 stdout 只输出回答内容
 
     if args.model:
         chat_gpt.set_model(args.model)
@@ -1107,22 +1827,40 @@ def main():
     if args.raw:
         ChatMode.toggle_raw_mode()
 
+    if args.search:
+        # 选中的搜索结果和 --load 一样打开，没有选择时直接退出
+        args.load = search_chat_history(chat_gpt, args.search, chat_save_perfix)
+        if not args.load:
+            return
+
     if args.load:
-        chat_history = load_chat_history(args.load)
-        if chat_history:
-            change_CLI_title(args.load.rstrip(".json"))
-            chat_gpt.messages = chat_history
-            for message in chat_gpt.messages:
-                print_message(message)
-            chat_gpt.current_tokens = count_token(chat_gpt.messages)
-            log.info(f"Chat history successfully loaded from: {args.load}")
-            console.print(
-                _("gpt_term.load_chat_history",load=args.load), highlight=False)
+        history_loaded = open_chat_history(chat_gpt, args.load, show=is_stdout_tty)
             
+    if args.batch:
+        from .batch import run_batch
+        sys.exit(run_batch(chat_gpt, args.batch, batch_workers, args.batch_order == 'input'))
+
+    if args.models:
+        chat_gpt.compare_models = parse_models(args.models)
+        if len(chat_gpt.compare_models) < 2:
+            console.print(_("gpt_term.compare_usage"), highlight=False)
+            sys.exit(2)
+
     if args.query:
         query_text = " ".join(args.query)
         log.info(f"> {query_text}")
-        is_stdout_tty = os.isatty(sys.stdout.fileno())
+        if args.models:
+            if is_stdout_tty:
+                compare_models(chat_gpt, chat_gpt.compare_models, query_text)
+            else:
+                # 管道模式下 stdout 只输出各模型的回答，统计写到 stderr
+                if not chat_gpt.check_budget():
+                    sys.exit(1)
+                from .compare import ModelComparison, write_comparison
+                comparison = ModelComparison(chat_gpt, chat_gpt.compare_models,
+                                             chat_gpt.context_messages() + [{"role": "user", "content": query_text}])
+                write_comparison(chat_gpt.aio.run(comparison.run()), sys.stdout, sys.stderr)
+            return
         if is_stdout_tty:
             chat_gpt.handle(query_text)
         else:  # Running in pipe/stream mode
@@ -1131,15 +1869,55 @@ def main():
     else:
         console.print(_("gpt_term.welcome"))
 
+    journal_dir = data_dir / 'journal'
+    leftover_journal = find_leftover_journal(journal_dir)
+    journal_fsync = config.get("JOURNAL_FSYNC", "interval")
+    if args.load and is_journal(args.load) and history_loaded:
+        # 恢复的会话继续写入原来的日志
+        chat_gpt.journal = SessionJournal(args.load, journal_fsync)
+    elif config.getboolean("JOURNAL", True):
+        chat_gpt.journal = SessionJournal.new(journal_dir, journal_fsync)
+        if args.load and history_loaded:
+            chat_gpt.journal.start_from(args.load, len(chat_gpt.messages))
+        else:
+            chat_gpt.journal.reset(chat_gpt.messages)
+    if leftover_journal and (not args.load or leftover_journal.resolve() != Path(args.load).resolve()):
+        console.print(_("gpt_term.journal_found", journal=leftover_journal), highlight=False)
+
+    from .aio import to_thread
+    chat_gpt.aio.submit(to_thread(get_remote_version, chat_gpt.transport))
+    log.debug("Remote version check task started")
+    # try to get remote version and check update, only needed by interactive mode
+
+    from packaging.version import parse as parse_version
+    from prompt_toolkit import PromptSession
+    from rich.console import Group
+    from rich.markdown import Markdown
+    from rich.panel import Panel
+
+    from .interactive import command_completer
+    from .sessions import SessionManager
+
     session = PromptSession()
+    sessions = SessionManager(chat_gpt, journal_dir=journal_dir if config.getboolean("JOURNAL", True) else None,
+                              journal_fsync=journal_fsync)
 
     # 绑定回车事件，达到自定义多行模式的效果
     key_bindings = create_key_bindings()
 
     while True:
         try:
-            message = session.prompt(
-                '> ', completer=command_completer, complete_while_typing=True, key_bindings=key_bindings)
+            chat_gpt = sessions.current.chat_gpt
+            if sessions.current.unseen:
+                sessions.show(sessions.current)
+            # 输入提示和请求、后台任务在同一个事件循环中运行
+            message = chat_gpt.aio.run(session.prompt_async(
+                sessions.prompt(), completer=command_completer, complete_while_typing=True, key_bindings=key_bindings))
+
+            if sessions.current.busy and message.strip() and not message.startswith('/session'):
+                # 当前会话还在后台回答时先跟随显示，回答完成后再处理输入
+                if not sessions.show(sessions.current):
+                    continue
 
             if message.startswith('/'):
                 command = message.strip()
@@ -1161,12 +1939,13 @@ def main():
             console.print(_("gpt_term.exit"))
             break
 
-    log.info(f"Total tokens spent: {chat_gpt.total_tokens_spent}")
+    sessions.close()
+    log.info(f"Total tokens spent: {sessions.total_tokens_spent}")
     console.print(
-        _("gpt_term.spent_token",total_tokens_spent=chat_gpt.total_tokens_spent))
+        _("gpt_term.spent_token",total_tokens_spent=sessions.total_tokens_spent))
     
     threadlock_remote_version.acquire()
-    if remote_version and remote_version > local_version:
+    if remote_version and remote_version > parse_version(local_version):
         console.print(Panel(Group(
             Markdown(_("gpt_term.upgrade_use_command")),
             Markdown(_("gpt_term.upgrade_see_git"))),
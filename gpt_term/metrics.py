@@ -0,0 +1,233 @@
+import json
+import logging
+import os
+import threading
+import time
+from array import array
+from collections import Counter, deque
+from typing import Dict, Iterable, List, Optional, Tuple
+
+log = logging.getLogger("chat")
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# (名称, 单位, 说明)，/stats 和 Prometheus 导出使用同样的顺序
+SUMMARY_FIELDS: List[Tuple[str, str, str]] = [
+    ("connect", "seconds", "DNS lookup and TCP connect of new connections"),
+    ("tls", "seconds", "TLS handshake of new connections"),
+    ("ttfb", "seconds", "Time from request sent to response headers"),
+    ("ttft", "seconds", "Time from request start to the first content token"),
+    ("gap", "seconds", "Gap between consecutive content chunks of a stream"),
+    ("tokens_per_second", "tokens_per_second", "Completion tokens per second after the first token"),
+    ("render", "seconds", "Time spent rendering the reply (Live.update)"),
+    ("tokenize", "seconds", "Time spent counting tokens for the turn"),
+    ("latency", "seconds", "Time from request start to the end of the reply"),
+]
+
+
+def percentile(values: List[float], q: float) -> float:
+    '''values 需已排序，取最近秩的分位数'''
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+class TurnMetrics:
+    '''一次请求从发出到回答显示完的各项耗时'''
+
+    def __init__(self, kind: str, model: str, stream: bool):
+        self.kind = kind        # chat / title / pipe / compare
+        self.model = model
+        self.stream = stream
+        self.timestamp = time.time()
+        self.start = time.perf_counter()
+        self.connect: Optional[float] = None    # 复用连接时为 None
+        self.tls: Optional[float] = None
+        self.ttfb: Optional[float] = None
+        self.ttft: Optional[float] = None
+        self.first_content_at: Optional[float] = None
+        self.last_content_at: Optional[float] = None
+        self.gaps = array('d')
+        self.end: Optional[float] = None
+        self.render: Optional[float] = None     # 没有渲染（管道模式、标题）时为 None
+        self.tokenize: Optional[float] = None
+        self.completion_tokens: Optional[int] = None
+        self.status = "ok"      # ok / error / aborted
+
+    def response_received(self, response):
+        '''从 Transport 附加的 response.timing 中取出连接阶段的耗时'''
+        timing = getattr(response, "timing", None)
+        if timing is None:
+            return
+        self.connect = timing.connect or None
+        self.tls = timing.tls or None
+        self.ttfb = timing.ttfb
+
+    def content_received(self):
+        now = time.perf_counter()
+        if self.first_content_at is None:
+            self.first_content_at = now
+            self.ttft = now - self.start
+        else:
+            self.gaps.append(now - self.last_content_at)
+        self.last_content_at = now
+
+    def finish(self, status: str = None):
+        '''回答接收完（或失败、被中断）时调用，重复调用只保留第一次的结束时间'''
+        if self.end is None:
+            self.end = time.perf_counter()
+        if status:
+            self.status = status
+
+    @property
+    def latency(self) -> Optional[float]:
+        return self.end - self.start if self.end is not None else None
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        if not self.completion_tokens or self.first_content_at is None or self.end is None:
+            return None
+        generating = self.end - self.first_content_at
+        return self.completion_tokens / generating if generating > 0 else None
+
+    def to_dict(self) -> Dict:
+        gaps = sorted(self.gaps)
+        return {
+            "timestamp": round(self.timestamp, 3),
+            "kind": self.kind,
+            "model": self.model,
+            "stream": self.stream,
+            "status": self.status,
+            "connect": self.connect,
+            "tls": self.tls,
+            "ttfb": self.ttfb,
+            "ttft": self.ttft,
+            "gap_p50": percentile(gaps, 0.5) if gaps else None,
+            "gap_max": gaps[-1] if gaps else None,
+            "chunks": len(gaps) + 1 if self.first_content_at is not None else 0,
+            "completion_tokens": self.completion_tokens,
+            "tokens_per_second": self.tokens_per_second,
+            "render": self.render,
+            "tokenize": self.tokenize,
+            "latency": self.latency,
+        }
+
+
+class Metrics:
+    '''Latency and throughput of the latest requests, kept in memory.
+
+    Every request made by the chat, title generation, pipe mode and /compare
+    is recorded as a `TurnMetrics`; only the last `size` turns are kept, so
+    memory stays bounded however long the session runs. `/stats` shows
+    p50/p95/p99 of each measurement over those turns, the request counters
+    count the whole session. With `path` set every finished turn is also
+    appended to that file as one JSON line.'''
+
+    def __init__(self, size: int = 500, path: str = None):
+        self.turns = deque(maxlen=max(size, 1))
+        self.requests = Counter()   # (kind, model, status) -> 本次运行的请求数
+        self.path = os.path.expanduser(path) if path else None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.turns)
+
+    def start(self, kind: str, model: str, stream: bool) -> TurnMetrics:
+        return TurnMetrics(kind, model, stream)
+
+    def record(self, turn: TurnMetrics, status: str = None):
+        turn.finish(status)
+        with self.lock:
+            self.turns.append(turn)
+            self.requests[(turn.kind, turn.model, turn.status)] += 1
+            if self.path:
+                # 在锁内追加，多个线程同时完成时行不会交错
+                try:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(turn.to_dict()) + "\n")
+                except OSError as e:
+                    log.warning(f"Failed to append metrics to {self.path}: {e}")
+
+    def clear(self):
+        with self.lock:
+            self.turns.clear()
+
+    def values(self, field: str) -> List[float]:
+        '''某一项在所有记录中的取值（已排序），gap 为所有流式回答的片段间隔'''
+        with self.lock:
+            turns = list(self.turns)
+        if field == "gap":
+            values = [gap for turn in turns for gap in turn.gaps]
+        else:
+            values = [getattr(turn, field) for turn in turns]
+            values = [value for value in values if value is not None]
+        values.sort()
+        return values
+
+    def summary(self) -> List[Tuple[str, str, int, Optional[Tuple[float, ...]], float]]:
+        '''[(名称, 单位, 个数, (p50, p95, p99), 总和)]'''
+        rows = []
+        for field, unit, _description in SUMMARY_FIELDS:
+            values = self.values(field)
+            quantiles = tuple(percentile(values, q) for q in QUANTILES) if values else None
+            rows.append((field, unit, len(values), quantiles, sum(values)))
+        return rows
+
+    def iter_jsonl(self) -> Iterable[str]:
+        with self.lock:
+            turns = list(self.turns)
+        for turn in turns:
+            yield json.dumps(turn.to_dict())
+
+    def format_prometheus(self) -> str:
+        '''Prometheus text exposition format: 每一项一个 summary，外加请求计数'''
+        lines = []
+        for (field, unit, description), (_field, _unit, count, quantiles, total) in zip(SUMMARY_FIELDS, self.summary()):
+            name = f"gpt_term_{field}" if field == "tokens_per_second" else f"gpt_term_{field}_{unit}"
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} summary")
+            if quantiles:
+                for q, value in zip(QUANTILES, quantiles):
+                    lines.append(f'{name}{{quantile="{q}"}} {value:.6g}')
+            lines.append(f"{name}_sum {total:.6g}")
+            lines.append(f"{name}_count {count}")
+        lines.append("# HELP gpt_term_requests_total Requests made in this session")
+        lines.append("# TYPE gpt_term_requests_total counter")
+        with self.lock:
+            requests = sorted(self.requests.items())
+        for (kind, model, status), count in requests:
+            model = model.replace("\\", "\\\\").replace('"', '\\"')
+            lines.append(f'gpt_term_requests_total{{kind="{kind}",model="{model}",status="{status}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, path: str, output_format: str = None) -> int:
+        '''写到 path，output_format 为 jsonl 或 prometheus，省略时按扩展名（.prom 为 prometheus）判断；返回记录数'''
+        path = os.path.expanduser(path)
+        if output_format is None:
+            output_format = "prometheus" if path.endswith(".prom") else "jsonl"
+        with open(path, "w", encoding="utf-8") as f:
+            if output_format == "prometheus":
+                f.write(self.format_prometheus())
+            else:
+                for line in self.iter_jsonl():
+                    f.write(line + "\n")
+        return len(self.turns)
+
+
+def stats_table(metrics: Metrics):
+    '''/stats 显示的表格：每一项的 p50/p95/p99，时间以毫秒显示'''
+    import i18n
+    from rich.table import Table
+
+    _ = i18n.t
+    table = Table(title=_("gpt_term.stats_title", turns=len(metrics)), title_justify="left")
+    table.add_column(_("gpt_term.stats_metric"))
+    table.add_column(_("gpt_term.stats_count"), justify="right")
+    for q in QUANTILES:
+        table.add_column(f"p{int(q * 100)}", justify="right")
+    for field, unit, count, quantiles, _total in metrics.summary():
+        if quantiles is None:
+            table.add_row(_(f"gpt_term.stats_{field}"), "0", "-", "-", "-", style="dim")
+        elif unit == "seconds":
+            table.add_row(_(f"gpt_term.stats_{field}"), str(count), *[f"{value * 1000:.1f} ms" for value in quantiles])
+        else:
+            table.add_row(_(f"gpt_term.stats_{field}"), str(count), *[f"{value:.1f}" for value in quantiles])
+    return table
@@ -0,0 +1,263 @@
+'''Local stand-in for the OpenAI `/v1/chat/completions` endpoint.
+
+Answers both streaming (SSE) and non-streaming requests with a generated
+Markdown reply, at a configurable token rate, with configurable latency, a
+prompt processing (prefill) rate and a share of 500 errors and 429 rate limits, so gpt-term can be run and
+benchmarked without network access:
+
+    python -m gpt_term.mock_server --port 8000 --rate 50 --latency 0.3
+    OPENAI_HOST=http://127.0.0.1:8000 gpt-term   # or: gpt-term --host http://127.0.0.1:8000
+'''
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional
+
+WORDS = ("the request response stream token latency cache index buffer socket thread loop render "
+         "terminal markdown python rust docker compose query model reply message history context "
+         "budget usage prompt completion session title chunk event server client").split()
+
+# 生成标题的请求（见 ChatGPT.gen_title_silent）只返回一个短标题
+TITLE_PROMPT = "Generate title shorter than 10 words"
+
+
+def sentence(rng: random.Random, length: int) -> List[str]:
+    words = rng.choices(WORDS, k=length)
+    return [words[0].capitalize()] + [f" {word}" for word in words[1:]]
+
+
+def generate_reply(tokens: int, seed: int = 0) -> List[str]:
+    '''约 tokens 个 token 的 Markdown 回答（标题、段落、列表和代码块），按 token 切好，每个元素算一个 token'''
+    rng = random.Random(seed)
+    parts: List[str] = ["## ", "Mock", " reply", "\n\n"]
+    while len(parts) < tokens:
+        kind = rng.random()
+        if kind < 0.6:
+            parts += sentence(rng, rng.randint(15, 40)) + [".\n\n"]
+        elif kind < 0.8:
+            for _ in range(rng.randint(2, 4)):
+                parts += ["- "] + sentence(rng, rng.randint(3, 8)) + ["\n"]
+            parts.append("\n")
+        else:
+            parts.append("```python\n")
+            for number in range(rng.randint(3, 8)):
+                parts += [f"{rng.choice(WORDS)}_{number}", " =", f" {rng.randint(0, 999)}", "\n"]
+            parts.append("```\n\n")
+    return parts[:tokens]
+
+
+def count_prompt_tokens(messages: List[Dict[str, str]]) -> int:
+    '''粗略估计：每 4 个字符一个 token，加上每条消息的格式开销'''
+    return sum(len(str(message.get("content", ""))) // 4 + 4 for message in messages) + 3
+
+
+class MockServer:
+    '''OpenAI compatible chat completions server running in a background thread.
+
+    `rate` is the streaming speed in tokens per second (0: as fast as
+    possible), `latency` the delay before the response headers,
+    `prefill_rate` the prompt tokens per second read before the first
+    token, so that the time to first token grows with the prompt (0: no
+    delay), `reply_tokens` the length of every reply. `error_rate` and `rate_limit`
+    are the shares of requests answered with a 500 or a 429 (with
+    `retry_after` in the `Retry-After` header). Counters of what was served
+    are kept in `stats`.'''
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, rate: float = 0, latency: float = 0,
+                 reply_tokens: int = 200, error_rate: float = 0, rate_limit: float = 0, retry_after: float = 1,
+                 seed: int = 0, prefill_rate: float = 0):
+        self.rate = rate
+        self.latency = latency
+        self.prefill_rate = prefill_rate
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.stats = {"requests": 0, "streamed": 0, "errors": 0, "rate_limited": 0, "aborted": 0, "prompt_tokens": 0}
+        self.lock = threading.Lock()
+        self.replies: Dict[int, List[str]] = {}
+        self.httpd = ThreadingHTTPServer((host, port), self.handler_class())
+        self.httpd.daemon_threads = True
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockServer":
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def count(self, name: str, value: int = 1):
+        with self.lock:
+            self.stats[name] += value
+
+    def reply_for(self, messages: List[Dict[str, str]]) -> List[str]:
+        last = str(messages[-1].get("content", "")) if messages else ""
+        if last.startswith(TITLE_PROMPT):
+            return ["Mock", " conversation", " title"]
+        with self.lock:
+            # 回答按长度缓存，同样长度的回答只生成一次
+            if self.reply_tokens not in self.replies:
+                self.replies[self.reply_tokens] = generate_reply(self.reply_tokens)
+            return self.replies[self.reply_tokens]
+
+    def pick_failure(self) -> Optional[int]:
+        with self.lock:
+            draw = self.random.random()
+        if draw < self.rate_limit:
+            return 429
+        if draw < self.rate_limit + self.error_rate:
+            return 500
+        return None
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"   # keep-alive，和真实 API 一样复用连接
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status: int, body: Dict, headers: Dict[str, str] = None):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def send_chunk(self, data: bytes):
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if self.path.rstrip("/") != "/v1/chat/completions":
+                    self.send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+                    return
+                server.count("requests")
+                if server.latency:
+                    time.sleep(server.latency)
+                failure = server.pick_failure()
+                if failure == 429:
+                    server.count("rate_limited")
+                    self.send_json(429, {"error": {"message": "Rate limit reached (mock)", "type": "requests",
+                                                   "code": "rate_limit_exceeded"}},
+                                   {"Retry-After": f"{server.retry_after:g}"})
+                    return
+                if failure == 500:
+                    server.count("errors")
+                    self.send_json(500, {"error": {"message": "The server had an error (mock)", "type": "server_error"}})
+                    return
+                messages = body.get("messages", [])
+                reply = server.reply_for(messages)
+                usage = {"prompt_tokens": count_prompt_tokens(messages), "completion_tokens": len(reply)}
+                usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+                server.count("prompt_tokens", usage["prompt_tokens"])
+                if body.get("stream"):
+                    server.count("streamed")
+                    try:
+                        self.stream(body, reply, usage)
+                    except (BrokenPipeError, ConnectionResetError):
+                        # 客户端中断了回答（Ctrl+C、取消标题生成）
+                        server.count("aborted")
+                        self.close_connection = True
+                    return
+                if server.prefill_rate:
+                    time.sleep(usage["prompt_tokens"] / server.prefill_rate)
+                if server.rate:
+                    time.sleep(len(reply) / server.rate)
+                self.send_json(200, {
+                    "id": "chatcmpl-mock", "object": "chat.completion", "created": int(time.time()),
+                    "model": body.get("model", "mock"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(reply)},
+                                 "finish_reason": "stop"}],
+                    "usage": usage})
+
+            def stream(self, body: Dict, reply: List[str], usage: Dict):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                base = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()),
+                        "model": body.get("model", "mock")}
+                if server.prefill_rate:
+                    # 先读完提示再生成第一个 token，提示越长首个 token 越晚
+                    time.sleep(usage["prompt_tokens"] / server.prefill_rate)
+                start = time.perf_counter()
+                for index, event in enumerate(iter_events(base, reply)):
+                    if server.rate:
+                        # 按绝对时间排期，sleep 的误差不会累积
+                        delay = start + index / server.rate - time.perf_counter()
+                        if delay > 0:
+                            time.sleep(delay)
+                    self.send_chunk(event)
+                if body.get("stream_options", {}).get("include_usage"):
+                    self.send_chunk(b"data: " + json.dumps(dict(base, choices=[], usage=usage)).encode() + b"\n\n")
+                self.send_chunk(b"data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+
+def iter_events(base: Dict, reply: List[str]) -> Iterator[bytes]:
+    '''每个 token 一个 SSE 事件，和 API 的格式一致：先是 role，最后是 finish_reason'''
+    def event(delta: Dict, finish_reason: str = None) -> bytes:
+        choice = {"index": 0, "delta": delta, "finish_reason": finish_reason}
+        return b"data: " + json.dumps(dict(base, choices=[choice])).encode() + b"\n\n"
+
+    yield event({"role": "assistant", "content": ""})
+    for token in reply:
+        yield event({"content": token})
+    yield event({}, "stop")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock of the OpenAI chat completions API")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--rate', type=float, default=50, help="streamed tokens per second (0: unlimited)")
+    parser.add_argument('--latency', type=float, default=0.3, help="seconds before the response headers")
+    parser.add_argument('--prefill-rate', type=float, default=0, help="prompt tokens read per second before the first token (0: instant)")
+    parser.add_argument('--reply-tokens', type=int, default=200, help="tokens in every reply")
+    parser.add_argument('--error-rate', type=float, default=0, help="share of requests answered with 500")
+    parser.add_argument('--rate-limit', type=float, default=0, help="share of requests answered with 429")
+    parser.add_argument('--retry-after', type=float, default=1, help="Retry-After seconds sent with 429")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    server = MockServer(args.host, args.port, args.rate, args.latency, args.reply_tokens, args.error_rate,
+                        args.rate_limit, args.retry_after, args.seed, args.prefill_rate)
+    print(f"Mock OpenAI server listening on {server.url}, use it with: gpt-term --host {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        print(f"Served: {server.stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import logging
+import random
+import re
+import threading
+import time
+from typing import Mapping, Optional
+
+log = logging.getLogger("chat")
+
+# 例如 "1s", "6m0s", "20ms", "1h2m3.5s"
+DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+# 值得重试的状态码: 限流和服务端临时错误
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    '''解析 x-ratelimit-reset-* 中的时长，返回秒数'''
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_RE.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+
+def parse_retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    '''retry-after-ms / retry-after（秒），不支持 HTTP 日期格式'''
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 20.0) -> float:
+    '''Exponential backoff with full jitter'''
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def estimate_tokens(body) -> int:
+    '''不加载分词器，按每 4 个字节约 1 个 token 粗略估计请求占用的 token'''
+    if not body:
+        return 0
+    return len(body) // 4 + 1
+
+
+class TokenBucket:
+    '''容量为 `limit`、每分钟补满一次的令牌桶，limit 为 0 表示不限制'''
+
+    def __init__(self, limit: float = 0):
+        self.limit = limit
+        self.level = limit
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def set_limit(self, limit: float):
+        if limit != self.limit:
+            self.level = limit if not self.limit else min(self.level, limit)
+            self.limit = limit
+
+    def refill(self, now: float):
+        if self.limit:
+            self.level = min(self.limit, self.level + (now - self.updated) * self.limit / 60)
+        self.updated = now
+
+    def wait_time(self, cost: float, now: float) -> float:
+        '''距离可以取出 cost 个令牌还要等多久'''
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        if not self.limit:
+            return 0.0
+        # 超过容量的请求只要等到桶满即可
+        missing = min(cost, self.limit) - self.level
+        return max(missing, 0.0) * 60 / self.limit
+
+    def consume(self, cost: float):
+        if self.limit:
+            self.level -= min(cost, self.limit)
+
+    def sync(self, remaining: Optional[float], reset: Optional[float], now: float):
+        '''用服务端返回的剩余额度校正本地估计'''
+        if remaining is None or not self.limit:
+            return
+        self.level = min(self.level, remaining)
+        if remaining <= 0 and reset:
+            self.blocked_until = max(self.blocked_until, now + reset)
+
+
+class RateLimiter:
+    '''Client-side limits shared by every request of one `Transport`.
+
+    Requests per minute and tokens per minute are throttled by two separate
+    token buckets. Their limits come from the config, or are learnt from the
+    `x-ratelimit-limit-*` headers, and their levels are corrected by
+    `x-ratelimit-remaining-*` / `x-ratelimit-reset-*` after every response. A
+    `retry-after` pauses all requests. The number of requests waiting for
+    response headers is limited by an additive-increase / multiplicative-
+    decrease window that halves on every 429.'''
+
+    def __init__(self, max_concurrency: int = 10, rpm: float = 0, tpm: float = 0):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.configured = (rpm, tpm)
+        self.max_concurrency = max(max_concurrency, 1)
+        self.concurrency = float(self.max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+
+    def set_limits(self, rpm: float = 0, tpm: float = 0):
+        '''0 表示根据响应头自动获取'''
+        with self.condition:
+            self.configured = (rpm, tpm)
+            self.requests.set_limit(rpm)
+            self.tokens.set_limit(tpm)
+
+    def acquire(self, cost: int):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.requests.refill(now)
+                self.tokens.refill(now)
+                wait = max(self.paused_until - now, self.requests.wait_time(1, now), self.tokens.wait_time(cost, now))
+                if wait <= 0 and self.in_flight < int(self.concurrency):
+                    self.requests.consume(1)
+                    self.tokens.consume(cost)
+                    self.in_flight += 1
+                    return
+                if wait > 0:
+                    log.debug(f"Rate limiter: waiting {wait:.2f}s")
+                self.condition.wait(wait if wait > 0 else None)
+
+    def release(self, status_code: Optional[int] = None, headers: Optional[Mapping[str, str]] = None) -> Optional[float]:
+        '''收到响应头（或请求失败）后调用，返回服务端要求的等待秒数'''
+        retry_after = None
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if headers is not None:
+                retry_after = self.update(headers, now)
+            if status_code == 429:
+                self.concurrency = max(1.0, self.concurrency / 2)
+                pause = retry_after if retry_after is not None else backoff_delay(0)
+                self.paused_until = max(self.paused_until, now + pause)
+                log.warning(f"Rate limited (429), concurrency reduced to {int(self.concurrency)}, pausing {pause:.2f}s")
+            elif status_code is not None and status_code < 400:
+                self.concurrency = min(float(self.max_concurrency), self.concurrency + 1 / self.concurrency)
+            self.condition.notify_all()
+        return retry_after
+
+    def update(self, headers: Mapping[str, str], now: float) -> Optional[float]:
+        for bucket, kind, configured in ((self.requests, "requests", self.configured[0]),
+                                         (self.tokens, "tokens", self.configured[1])):
+            try:
+                limit = float(headers.get(f"x-ratelimit-limit-{kind}") or 0)
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                remaining = float(remaining) if remaining is not None else None
+            except ValueError:
+                continue
+            if limit and not configured:
+                bucket.set_limit(limit)
+            bucket.sync(remaining, parse_duration(headers.get(f"x-ratelimit-reset-{kind}")), now)
+        return parse_retry_after(headers)
@@ -0,0 +1,88 @@
+import math
+import re
+from collections import Counter
+from typing import Dict, List
+
+from .search import CJK
+from .store import MessageStore
+
+# 中日韩文字逐字作为一个词，其他文字按单词切分
+TOKEN_RE = re.compile(f'[{CJK}]|[^\\W{CJK}]+')
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall(text.lower())
+
+
+class RelevanceIndex:
+    '''Incremental BM25 index over the messages of one conversation.
+
+    Used by the `relevant` context policy to find the earlier turns that
+    matter for the new question. Messages are indexed once, when they are
+    first seen; `sync` compares the indexed messages with the history by
+    their `MessageStore` ids, so only appended messages are tokenized and an
+    undo, delete or newly loaded history only re-indexes from the first
+    message that changed. Only the term counts are kept, not the messages,
+    and nothing is written to disk.'''
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.ids: List[int] = []
+        self.terms: List[Counter] = []
+        self.lengths: List[int] = []
+        self.postings: Dict[str, Dict[int, int]] = {}   # 词 -> {消息序号: 词频}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def sync(self, messages: MessageStore):
+        '''让索引和 messages 一致'''
+        common = 0
+        limit = min(len(self.ids), len(messages))
+        while common < limit and self.ids[common] == messages.ids[common]:
+            common += 1
+        if common < len(self.ids):
+            self.truncate(common)
+        for index in range(common, len(messages)):
+            self.add(messages.ids[index], messages[index])
+
+    def add(self, message_id: int, message: Dict[str, str]):
+        index = len(self.ids)
+        terms = Counter(tokenize(str(message.get("content") or "")))
+        for term, frequency in terms.items():
+            self.postings.setdefault(term, {})[index] = frequency
+        length = sum(terms.values())
+        self.ids.append(message_id)
+        self.terms.append(terms)
+        self.lengths.append(length)
+        self.total_length += length
+
+    def truncate(self, length: int):
+        for index in range(len(self.ids) - 1, length - 1, -1):
+            for term in self.terms[index]:
+                posting = self.postings[term]
+                del posting[index]
+                if not posting:
+                    del self.postings[term]
+            self.total_length -= self.lengths[index]
+        del self.ids[length:], self.terms[length:], self.lengths[length:]
+
+    def scores(self, query: str, end: int) -> Dict[int, float]:
+        '''messages[:end] 中和 query 有共同词的消息的 BM25 分数，越大越相关'''
+        count = len(self.ids)
+        if not count or not self.total_length:
+            return {}
+        average = self.total_length / count
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (count - len(posting) + 0.5) / (len(posting) + 0.5))
+            for index, frequency in posting.items():
+                if index < end:
+                    norm = self.k1 * (1 - self.b + self.b * self.lengths[index] / average)
+                    scores[index] = scores.get(index, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+        return scores
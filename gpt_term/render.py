@@ -0,0 +1,138 @@
+import re
+import time
+from typing import List
+
+from rich.console import Console, ConsoleOptions, RenderResult
+from rich.live import Live
+from rich.markdown import Markdown
+from rich.segment import Segment
+
+# 代码块围栏，例如 ``` 或 ~~~python
+FENCE_RE = re.compile(r'^( {0,3})(`{3,}|~{3,})')
+LIST_ITEM_RE = re.compile(r'^([-*+]|\d{1,9}[.)])(\s|$)')
+
+
+class MarkdownBlock:
+    '''Render one top-level Markdown block without surrounding blank lines.
+
+    Blocks rendered one by one are joined with a single blank line, which is
+    the spacing rich puts between top-level elements of a whole document.'''
+
+    def __init__(self, markup: str, gap: bool = False):
+        self.markdown = Markdown(markup)
+        self.gap = gap
+
+    def __rich_console__(self, console: Console, options: ConsoleOptions) -> RenderResult:
+        lines = console.render_lines(self.markdown, options, pad=False)
+        while lines and self.is_blank(lines[-1]):
+            lines.pop()
+        while lines and self.is_blank(lines[0]):
+            lines.pop(0)
+        if self.gap:
+            yield Segment.line()
+        for line in lines:
+            yield from line
+            yield Segment.line()
+
+    @staticmethod
+    def is_blank(line: List[Segment]) -> bool:
+        # 代码块的上下留白带有背景色，不算空行
+        return all(not segment.text.strip() and not (segment.style and segment.style.bgcolor) for segment in line)
+
+
+class StreamRenderer:
+    '''Incremental Markdown rendering for a streamed reply.
+
+    Finished blocks (paragraphs followed by a blank line, closed code fences)
+    are printed once above the live area and never rendered again; only the
+    open tail block is re-rendered, at most `refresh_rate` times per second.'''
+
+    def __init__(self, live: Live, refresh_rate: float = 15):
+        self.live = live
+        self.min_interval = 1 / refresh_rate if refresh_rate > 0 else 0
+        self.text = ""
+        self.frozen = 0         # text[:frozen] has been printed
+        self.scanned = 0        # text[:scanned] consists of complete lines already classified
+        self.blocks = 0         # number of blocks printed so far
+        self.fence = None       # opening fence marker while inside a code block
+        self.fence_top_level = False
+        self.blank_at = None    # offset right after a blank line that may end the current block
+        self.in_list = False
+        self.last_refresh = 0.0
+        self.dirty = False
+        self.render_time = 0.0  # 花在渲染上的时间，记入 /stats
+
+    def feed(self, content: str):
+        self.text += content
+        self.scan_lines()
+        self.dirty = True
+        now = time.monotonic()
+        if now - self.last_refresh >= self.min_interval:
+            self.refresh(now)
+
+    def finish(self):
+        '''流结束（或被中断）时渲染剩余部分'''
+        if self.dirty:
+            self.refresh(time.monotonic())
+
+    def refresh(self, now: float):
+        start = time.perf_counter()
+        tail = self.text[self.frozen:]
+        if tail.strip():
+            self.live.update(MarkdownBlock(tail, gap=self.blocks > 0), refresh=True)
+        else:
+            self.live.update("", refresh=True)
+        self.last_refresh = now
+        self.dirty = False
+        self.render_time += time.perf_counter() - start
+
+    def freeze(self, end: int):
+        '''把 text[frozen:end] 作为完成的块打印出来'''
+        block = self.text[self.frozen:end]
+        self.frozen = end
+        self.blank_at = None
+        self.in_list = False
+        if block.strip():
+            start = time.perf_counter()
+            self.live.console.print(MarkdownBlock(block, gap=self.blocks > 0))
+            self.render_time += time.perf_counter() - start
+            self.blocks += 1
+
+    def scan_lines(self):
+        while True:
+            newline = self.text.find('\n', self.scanned)
+            if newline == -1:
+                return
+            start, self.scanned = self.scanned, newline + 1
+            self.scan_line(self.text[start:newline], start, self.scanned)
+
+    def scan_line(self, line: str, start: int, end: int):
+        if self.fence:
+            marker = line.strip()
+            if marker.startswith(self.fence) and not marker.strip(self.fence[0]):
+                self.fence = None
+                if self.fence_top_level:
+                    self.freeze(end)
+            return
+
+        if not line.strip():
+            if self.text[self.frozen:start].strip() and self.blank_at is None:
+                self.blank_at = end
+            return
+
+        is_list_item = bool(LIST_ITEM_RE.match(line))
+        if self.blank_at is not None:
+            # 空行后出现顶格的新块才结束上一个块，缩进行和同一列表的后续项仍属于上一个块
+            if not line[0].isspace() and not (self.in_list and is_list_item):
+                self.freeze(self.blank_at)
+            else:
+                self.blank_at = None
+
+        fence = FENCE_RE.match(line)
+        if fence:
+            self.fence = fence.group(2)
+            self.fence_top_level = not fence.group(1) and not self.in_list
+            if self.fence_top_level:
+                self.freeze(start)
+        elif is_list_item:
+            self.in_list = True
@@ -0,0 +1,182 @@
+import json
+import logging
+import os
+import re
+from pathlib import Path
+from typing import Iterable, Iterator, List, NamedTuple
+
+log = logging.getLogger("chat")
+
+# 每个会话最多索引这么多条消息，rowid = 会话 id * MAX_MESSAGES + 消息序号
+MAX_MESSAGES = 1 << 20
+
+# unicode61 分词器会把连续的中日韩文字当成一个词，在每个字之间插入零宽空格，按字索引
+CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+CJK_RE = re.compile(f'([{CJK}])(?=[{CJK}])')
+SEPARATOR = '\u200b'
+# snippet() 中命中部分的标记，显示时再换成 rich 的样式
+MATCH_START, MATCH_END = '\x02', '\x03'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    messages INTEGER NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(
+    content, role UNINDEXED, tokenize = 'unicode61 remove_diacritics 2'
+);
+'''
+
+
+class SearchResult(NamedTuple):
+    path: str
+    position: int       # 命中的消息在聊天记录中的序号
+    role: str
+    snippet: str
+    score: float        # bm25，越小越相关
+    mtime: float
+
+
+def segment(text: str) -> str:
+    return CJK_RE.sub(r'\1' + SEPARATOR, text)
+
+
+def to_match_query(query: str) -> str:
+    '''把用户输入的关键词转成 FTS5 查询：每个词作为一个短语，全部命中才算匹配'''
+    terms = [term.replace('"', '""') for term in query.split()]
+    return " ".join(f'"{segment(term)}"' for term in terms if term)
+
+
+def iter_history_files(chat_save_perfix: str, data_dir: Path) -> Iterator[Path]:
+    '''`/save` 保存的聊天记录（当前目录下以 CHAT_SAVE_PERFIX 开头的文件）和紧急备份'''
+    prefix = Path(chat_save_perfix).expanduser()
+    for directory, pattern in ((prefix.parent, f"{glob_escape(prefix.name)}*.json"),
+                               (data_dir, "chat_history_backup_*.json")):
+        if directory.is_dir():
+            yield from directory.glob(pattern)
+
+
+def glob_escape(name: str) -> str:
+    return re.sub(r'([*?\[])', r'[\1]', name)
+
+
+class SearchIndex:
+    '''Full-text index of saved chat histories, kept in an SQLite FTS5 database.
+
+    Every user and assistant message of a history file is one row of the
+    `messages` table; its rowid encodes the session and the position of the
+    message, so a file can be re-indexed with a cheap rowid range delete.
+    `index_file` is called whenever a history is saved, and `sync` picks up
+    files that changed, appeared or were removed since (compared by mtime and
+    size), so only those files are parsed again. Results are ranked by bm25
+    and grouped by file.'''
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.db = None
+
+    def connect(self):
+        if self.db is None:
+            import sqlite3
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.db = sqlite3.connect(str(self.path))
+            self.db.executescript(SCHEMA)
+        return self.db
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def index_file(self, file_path, commit: bool = True) -> int:
+        '''(重新)索引一个聊天记录文件，返回索引的消息数'''
+        db = self.connect()
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                messages = json.load(f)
+            if not isinstance(messages, list):
+                raise ValueError("not a list of messages")
+        except (OSError, ValueError) as e:
+            # 记下无法解析的文件，文件不变就不再重试
+            log.warning(f"Search index: skipped {file_path}: {e}")
+            messages = []
+        row = db.execute("SELECT id FROM sessions WHERE path = ?", (file_path,)).fetchone()
+        if row:
+            session_id = row[0]
+            self.delete_messages(session_id)
+            db.execute("UPDATE sessions SET mtime = ?, size = ?, messages = ? WHERE id = ?",
+                       (stat.st_mtime, stat.st_size, len(messages), session_id))
+        else:
+            session_id = db.execute("INSERT INTO sessions (path, mtime, size, messages) VALUES (?, ?, ?, ?)",
+                                    (file_path, stat.st_mtime, stat.st_size, len(messages))).lastrowid
+        db.executemany("INSERT INTO messages (rowid, content, role) VALUES (?, ?, ?)", (
+            (session_id * MAX_MESSAGES + position, segment(message["content"]), message["role"])
+            for position, message in enumerate(messages[:MAX_MESSAGES])
+            if isinstance(message, dict) and message.get("role") in ("user", "assistant")
+            and isinstance(message.get("content"), str)))
+        if commit:
+            db.commit()
+        return len(messages)
+
+    def delete_messages(self, session_id: int):
+        self.db.execute("DELETE FROM messages WHERE rowid >= ? AND rowid < ?",
+                        (session_id * MAX_MESSAGES, (session_id + 1) * MAX_MESSAGES))
+
+    def remove_file(self, session_id: int):
+        self.delete_messages(session_id)
+        self.db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def sync(self, files: Iterable[Path] = ()) -> int:
+        '''检查已索引的文件和 files 中的新文件，只重新索引有变化的，返回更新的文件数'''
+        db = self.connect()
+        known = {path: (session_id, mtime, size)
+                 for session_id, path, mtime, size in db.execute("SELECT id, path, mtime, size FROM sessions")}
+        candidates = set(known)
+        candidates.update(os.path.abspath(path) for path in files)
+        updated = 0
+        for path in candidates:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                if path in known:
+                    self.remove_file(known[path][0])
+                    updated += 1
+                continue
+            if path in known and known[path][1:] == (stat.st_mtime, stat.st_size):
+                continue
+            self.index_file(path, commit=False)
+            updated += 1
+        db.commit()
+        if updated:
+            log.debug(f"Search index: {updated} files updated")
+        return updated
+
+    def search(self, query: str, limit: int = 10) -> List[SearchResult]:
+        '''按相关度返回最多 limit 个文件中最匹配的消息'''
+        match = to_match_query(query)
+        if not match:
+            return []
+        db = self.connect()
+        # 先只按 bm25 排序找出每个文件最相关的消息，snippet 只为最终结果生成
+        best = {}
+        for rowid, role, score in db.execute(
+                "SELECT rowid, role, bm25(messages) AS score FROM messages WHERE messages MATCH ? ORDER BY score", (match,)):
+            session_id, position = divmod(rowid, MAX_MESSAGES)
+            if session_id not in best:
+                best[session_id] = (rowid, position, role, score)
+                if len(best) == limit:
+                    break
+        results = []
+        for session_id, (rowid, position, role, score) in best.items():
+            row = db.execute("SELECT path, mtime FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            snippet = db.execute(
+                f"SELECT snippet(messages, 0, '{MATCH_START}', '{MATCH_END}', '…', 16) FROM messages"
+                " WHERE messages MATCH ? AND rowid = ?", (match, rowid)).fetchone()
+            if row and snippet:
+                results.append(SearchResult(row[0], position, role, snippet[0].replace(SEPARATOR, ''), score, row[1]))
+        return results
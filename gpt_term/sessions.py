@@ -0,0 +1,296 @@
+import json
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import i18n
+import requests
+
+from .journal import SessionJournal
+from .sse import StreamError, iter_stream_content
+
+log = logging.getLogger("chat")
+
+_ = i18n.t
+
+
+class ReplyBuffer:
+    '''Reply of a question asked in the background, filled while it streams.
+
+    Only the event loop thread writes to and follows the buffer, so no lock
+    is needed. `follow` yields what has arrived so far and then every new
+    piece until the reply is complete, rendering a reply that is still
+    streaming when its session is switched to.'''
+
+    def __init__(self, question: str):
+        self.question = question
+        self.parts: List[str] = []
+        self.done = False
+        self.error: Optional[str] = None
+        self._changed = None
+
+    @property
+    def changed(self):
+        import asyncio
+
+        # 在事件循环中创建，Python 3.9 之前 Event 会绑定创建时的事件循环
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        return self._changed
+
+    @property
+    def content(self) -> str:
+        return "".join(self.parts)
+
+    def append(self, part: str):
+        self.parts.append(part)
+        self.changed.set()
+
+    def finish(self, error: str = None):
+        self.error = error
+        self.done = True
+        self.changed.set()
+
+    async def follow(self):
+        index = 0
+        while True:
+            while index < len(self.parts):
+                yield self.parts[index]
+                index += 1
+            if self.done:
+                return
+            self.changed.clear()
+            await self.changed.wait()
+
+
+class Session:
+    '''一个命名的对话和它在后台进行中的回答'''
+
+    def __init__(self, name: str, chat_gpt):
+        self.name = name
+        self.chat_gpt = chat_gpt
+        self.buffer: Optional[ReplyBuffer] = None
+        self.task = None
+        self.unseen = False     # 后台完成的回答还没有显示过
+        self.following = False
+
+    @property
+    def busy(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def state(self) -> str:
+        if self.busy:
+            return _("gpt_term.session_state_streaming", chars=len(self.buffer.content))
+        if self.unseen and self.buffer.error:
+            return _("gpt_term.session_state_failed")
+        if self.unseen:
+            return _("gpt_term.session_state_ready")
+        return _("gpt_term.session_state_idle")
+
+
+class SessionManager:
+    '''Named conversations in one process, switched with `/session`.
+
+    Every session is a `ChatGPT` of its own (messages, model, token counts,
+    title and journal) created by `ChatGPT.new_session`; the connection
+    pool, event loop, response cache, usage ledger and metrics are shared.
+    A question sent with `/bg` streams into the session's `ReplyBuffer` as
+    a task on the shared event loop while the prompt returns at once, so
+    any number of sessions can be answering concurrently, each on its own
+    pooled connection. The reply is added to its conversation when it is
+    complete and rendered when the session is switched to.'''
+
+    def __init__(self, chat_gpt, name: str = "main", journal_dir: Path = None, journal_fsync: str = 'interval'):
+        self.journal_dir = journal_dir
+        self.journal_fsync = journal_fsync
+        self.sessions: Dict[str, Session] = {}
+        self.current = self.add(name, chat_gpt)
+
+    def add(self, name: str, chat_gpt) -> Session:
+        chat_gpt.sessions = self
+        session = Session(name, chat_gpt)
+        self.sessions[name] = session
+        return session
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __iter__(self):
+        return iter(self.sessions.values())
+
+    def prompt(self) -> str:
+        '''只有一个会话时保持原来的提示符'''
+        return '> ' if len(self.sessions) == 1 else f'{self.current.name}> '
+
+    def new(self, name: str = None) -> Optional[Session]:
+        '''新建会话并切换过去，name 已经存在时返回 None'''
+        if name is None:
+            number = len(self.sessions) + 1
+            while str(number) in self.sessions:
+                number += 1
+            name = str(number)
+        if name in self.sessions:
+            return None
+        chat_gpt = self.current.chat_gpt.new_session()
+        if self.journal_dir is not None:
+            chat_gpt.journal = SessionJournal.new(self.journal_dir, self.journal_fsync, name)
+            chat_gpt.journal.reset(chat_gpt.messages)
+        self.current = self.add(name, chat_gpt)
+        return self.current
+
+    def switch(self, name: str) -> Optional[Session]:
+        session = self.sessions.get(name)
+        if session is not None:
+            self.current = session
+        return session
+
+    def send(self, message: str) -> bool:
+        '''在当前会话中后台提问，立即返回；没有发出请求时返回 False'''
+        session = self.current
+        chat_gpt = session.chat_gpt
+        chat_gpt.add_message({"role": "user", "content": message})
+        if len(chat_gpt.messages) == 2 and chat_gpt.title is None and chat_gpt.auto_gen_title_background_enable:
+            chat_gpt.start_title_generation(message)
+        data = chat_gpt.request_data(chat_gpt.context_messages(notify=True), stream=True)
+        cached_message = chat_gpt.response_cache.get(data)
+        if not cached_message and not chat_gpt.check_budget():
+            chat_gpt.pop_message()
+            if len(chat_gpt.messages) == 1:
+                chat_gpt.cancel_title()
+            return False
+        session.buffer = ReplyBuffer(message)
+        session.unseen = False
+        session.task = chat_gpt.aio.submit(self.answer(session, data, cached_message))
+        return True
+
+    async def answer(self, session: Session, data: Dict, cached_message: Optional[Dict[str, str]]):
+        '''在共享事件循环中接收回答，写入会话的 ReplyBuffer，完成后加入对话'''
+        import asyncio
+
+        from .aio import iter_in_thread, to_thread
+
+        chat_gpt = session.chat_gpt
+        buffer = session.buffer
+        if cached_message:
+            buffer.append(cached_message['content'])
+            chat_gpt.finish_turn(data, cached_message)
+            buffer.finish()
+            self.finished(session)
+            return
+        turn = chat_gpt.metrics.start("chat", data["model"], True)
+        response = None
+        error = None
+        finished = False
+        try:
+            response = await to_thread(
+                chat_gpt.transport.post, chat_gpt.endpoint, headers=chat_gpt.headers, data=json.dumps(data),
+                timeout=chat_gpt.timeout, stream=True, cleanup=lambda late_response: late_response.close())
+            turn.response_received(response)
+            response.metrics = turn
+            if response.status_code // 100 == 4:
+                error = response.json()['error']['message']
+            else:
+                response.raise_for_status()
+                async for content in iter_in_thread(iter_stream_content(response), response.close):
+                    turn.content_received()
+                    buffer.append(content)
+                finished = True
+        except asyncio.CancelledError:
+            error = _("gpt_term.Aborted")
+            raise
+        except requests.exceptions.ReadTimeout:
+            error = _("gpt_term.Error_timeout", timeout=chat_gpt.timeout)
+        except (requests.exceptions.RequestException, StreamError, ValueError, KeyError, IndexError) as e:
+            error = str(e) or type(e).__name__
+        finally:
+            if response is not None:
+                if finished:
+                    await to_thread(chat_gpt.transport.release, response)
+                else:
+                    chat_gpt.transport.release(response, drain=False)
+            if not finished:
+                log.error(f"Session {session.name}: {error}")
+                chat_gpt.metrics.record(turn, "error")
+                # 和前台请求失败时一样，撤回没有得到回答的问题
+                chat_gpt.pop_message()
+                if len(chat_gpt.messages) == 1:
+                    chat_gpt.cancel_title()
+                buffer.finish(error)
+                self.finished(session)
+        if not finished:
+            return
+        reply_message = {'role': 'assistant', 'content': buffer.content}
+        log.info(f"ChatGPT ({session.name}): {reply_message['content']}")
+        chat_gpt.response_cache.put(data, reply_message, response.finish_reason)
+        # 没有 usage 时需要计算 token 数，放到线程池中，不耽误其他会话的回答
+        await to_thread(chat_gpt.finish_turn, data, reply_message, response)
+        buffer.finish()
+        self.finished(session)
+
+    def finished(self, session: Session):
+        if session.following:
+            return
+        session.unseen = True
+        if session is self.current:
+            return
+        from prompt_toolkit.application import run_in_terminal
+
+        from .main import console
+        message = _("gpt_term.session_failed", name=session.name, error=session.buffer.error) if session.buffer.error \
+            else _("gpt_term.session_ready", name=session.name)
+        # 正在输入时显示在提示符上方
+        run_in_terminal(lambda: console.print(message, highlight=False))
+
+    def show(self, session: Session) -> bool:
+        '''显示会话在后台收到的回答，还在接收时跟随显示直到完成。
+        跟随时按 Ctrl+C 只是不再显示，回答继续在后台接收，此时返回 False'''
+        from .main import console, print_message
+
+        chat_gpt = session.chat_gpt
+        if session.buffer is None or not (session.busy or session.unseen):
+            return True
+        print_message({"role": "user", "content": session.buffer.question})
+        if session.busy:
+            session.following = True
+            try:
+                _reply, detached = chat_gpt.aio.run(chat_gpt.render_stream(
+                    session.buffer.follow(), cancel_message=_("gpt_term.session_detached", name=session.name)))
+                if detached:
+                    return False
+                session.task.wait()
+            finally:
+                session.following = False
+        elif not session.buffer.error:
+            chat_gpt.replay_reply({'role': 'assistant', 'content': session.buffer.content})
+        if session.buffer.error:
+            console.print(_("gpt_term.session_failed", name=session.name, error=session.buffer.error), highlight=False)
+        session.unseen = False
+        return True
+
+    def table(self):
+        from rich.markup import escape
+        from rich.table import Table
+
+        table = Table(title=_("gpt_term.session_list_title"), title_justify="left")
+        table.add_column("", style="bold green")
+        table.add_column(_("gpt_term.session_name"), style="bold cyan")
+        table.add_column(_("gpt_term.session_messages"), justify="right")
+        table.add_column(_("gpt_term.session_model"))
+        table.add_column(_("gpt_term.session_tokens"), justify="right")
+        table.add_column(_("gpt_term.session_state"))
+        table.add_column(_("gpt_term.session_title"))
+        for session in self:
+            chat_gpt = session.chat_gpt
+            table.add_row("*" if session is self.current else "", escape(session.name), str(len(chat_gpt.messages) - 1),
+                          chat_gpt.model, str(chat_gpt.total_tokens_spent), session.state(), escape(chat_gpt.title or ""))
+        return table
+
+    @property
+    def total_tokens_spent(self) -> int:
+        return sum(session.chat_gpt.total_tokens_spent for session in self)
+
+    def close(self):
+        '''正常退出时删除所有会话的日志和溢出文件'''
+        for session in self:
+            session.chat_gpt.journal.close(remove=True)
+            session.chat_gpt.messages.close()
@@ -0,0 +1,164 @@
+import json
+import logging
+from typing import Dict, Iterable, Iterator, Optional
+
+log = logging.getLogger("chat")
+
+# 流式回答中绝大多数事件只带一段文本，形如
+# {"id":...,"choices":[{"index":0,"delta":{"content":"Hello"},"logprobs":null,"finish_reason":null}]}
+# 不经过 json.loads，直接从原始字节中取出 content；也接受 json.dumps 默认带空格的写法。
+# 只有第一个 choice 是 index 0、且以只有 content 的 delta 开头时才走快速路径，
+# 这样 finish_reason 一定在 content 之后，其他写法（字段顺序不同、多个 choice）都交给 json.loads
+CONTENT_MARKERS = (b'"choices":[{"index":0,"delta":{"content":"', b'"choices": [{"index": 0, "delta": {"content": "')
+FINISH_MARKERS = (b'"finish_reason":"', b'"finish_reason": "')
+INDEX_MARKERS = (b'"index":', b'"index": ')
+USAGE_NULL = (b'"usage":null', b'"usage": null')
+
+
+def iter_events(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    '''把 HTTP 响应的数据块切分成 Server-Sent Events，逐个返回事件的 data（多行 data 以换行连接）。
+
+    数据块整块追加到缓冲区，一次 split 切出所有完整的事件；只有一行 data 的事件（聊天接口的所有事件）
+    直接切片，不逐行处理。注释、event、id、retry 字段对聊天接口没有意义，被忽略'''
+    buffer = b""
+    pending_cr = False
+    for chunk in chunks:
+        if pending_cr:
+            chunk = b"\r" + chunk
+            pending_cr = False
+        if b"\r" in chunk:
+            # \r\n 可能被拆在两个数据块之间，末尾的 \r 留到下一块再处理
+            if chunk.endswith(b"\r"):
+                chunk = chunk[:-1]
+                pending_cr = True
+            chunk = chunk.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        buffer += chunk
+        if b"\n\n" not in buffer:
+            continue
+        *events, buffer = buffer.split(b"\n\n")
+        for event in events:
+            if event.startswith(b"data: ") and b"\n" not in event:
+                yield event[6:]
+            elif event:
+                data = parse_event(event)
+                if data is not None:
+                    yield data
+    # 没有以空行结束的事件按规范丢弃
+
+
+def parse_event(event: bytes) -> Optional[bytes]:
+    '''逐行解析一个事件，没有 data 字段时返回 None'''
+    data = []
+    for line in event.split(b"\n"):
+        if line.startswith(b"data:"):
+            value = line[5:]
+            data.append(value[1:] if value.startswith(b" ") else value)
+    return b"\n".join(data) if data else None
+
+
+def read_json_string(payload: bytes, start: int) -> Optional[tuple]:
+    '''payload[start:] 是 JSON 字符串引号之后的内容，返回 (字符串, 结束引号之后的位置)'''
+    end = start
+    while True:
+        end = payload.find(b'"', end)
+        if end == -1:
+            return None
+        # 前面有奇数个反斜杠时这个引号是被转义的
+        backslashes = 0
+        while payload[end - 1 - backslashes] == 0x5c:
+            backslashes += 1
+        if backslashes % 2 == 0:
+            break
+        end += 1
+    raw = payload[start:end]
+    if b"\\" in raw:
+        return json.loads(payload[start - 1:end + 1]), end + 1
+    return raw.decode("utf-8"), end + 1
+
+
+class StreamError(Exception):
+    '''流式回答中途收到的 error 事件，回答到此为止'''
+
+
+class DeltaDecoder:
+    '''Turn the data of chat completion chunks into reply text.
+
+    Events whose delta is only a piece of content, with no finish reason and
+    no usage, take a fast path that slices the string out of the raw bytes.
+    Anything else (role, tool calls, finish reasons, the usage chunk of
+    `stream_options.include_usage`, errors) is parsed with `json.loads`, which
+    also records `usage` and `finish_reason`. An `{"error": ...}` event is
+    logged and raised as `StreamError`.'''
+
+    def __init__(self):
+        self.usage: Optional[Dict] = None
+        self.finish_reason: Optional[str] = None
+        self.fast = 0   # 走快速路径的事件数
+        self.parsed = 0
+
+    def decode(self, data: bytes) -> Optional[str]:
+        '''返回事件中新增的文本，没有文本时返回 None'''
+        content = self.decode_fast(data)
+        if content is not None:
+            self.fast += 1
+            return content
+        self.parsed += 1
+        part = json.loads(data)
+        error = part.get("error")
+        if error:
+            # 例如服务端过载时中途发来的 {"error": {"message": ..., "type": ...}}
+            log.error(f"Error event in the response stream: {error}")
+            raise StreamError((error.get("message") if isinstance(error, dict) else None) or str(error))
+        if part.get("usage"):
+            # stream_options.include_usage: 最后一个数据块只有 usage，choices 为空
+            self.usage = part["usage"]
+        if not part.get("choices"):
+            return None
+        choice = part["choices"][0]
+        if choice.get("finish_reason"):
+            self.finish_reason = choice["finish_reason"]
+        return (choice.get("delta") or {}).get("content") or None
+
+    @staticmethod
+    def decode_fast(data: bytes) -> Optional[str]:
+        for marker in CONTENT_MARKERS:
+            start = data.find(marker)
+            if start != -1:
+                break
+        else:
+            return None
+        result = read_json_string(data, start + len(marker))
+        if result is None:
+            return None
+        content, end = result
+        # delta 中除了 content 还有别的字段（例如 tool_calls），带有结束原因、其他 choice 或 usage 时交给 json.loads
+        if data[end:end + 1] != b"}":
+            return None
+        tail = data[end:]
+        if FINISH_MARKERS[0] in tail or FINISH_MARKERS[1] in tail:
+            return None
+        if INDEX_MARKERS[0] in tail or INDEX_MARKERS[1] in tail:
+            return None
+        if b'"usage"' in data and not (USAGE_NULL[0] in data or USAGE_NULL[1] in data):
+            return None
+        return content
+
+
+def iter_stream_content(response) -> Iterator[str]:
+    '''逐个返回流式回复中新增的文本片段，API 返回的 usage 记录在 response.usage。
+    收到 [DONE] 时 response.finish_reason 为 API 给出的结束原因，收到 error 事件或连接出错时为 "error"'''
+    decoder = DeltaDecoder()
+    response.finish_reason = None
+    try:
+        for data in iter_events(response.chunks):
+            if data == b"[DONE]":
+                response.finish_reason = decoder.finish_reason
+                break
+            content = decoder.decode(data)
+            if decoder.usage is not None:
+                response.usage = decoder.usage
+            if content:
+                yield content
+    except Exception:
+        response.finish_reason = "error"
+        raise
@@ -0,0 +1,198 @@
+import json
+import logging
+import mmap
+import sys
+import tempfile
+import threading
+from array import array
+from collections.abc import MutableSequence
+from itertools import count
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+
+log = logging.getLogger("chat")
+
+
+def encode_message(message: Dict[str, str]) -> bytes:
+    return json.dumps(message, ensure_ascii=False).encode()
+
+
+class MessageStore(MutableSequence):
+    '''Conversation history as compact per-message records, with old bodies spilled to disk.
+
+    Every message is a record of its role, a serial id, the size of its JSON
+    body and either the message itself or the place of that body in a spill
+    file under `~/.gpt-term/spill`. When the bodies kept in memory grow
+    beyond `resident_bytes`, the oldest ones are appended to the spill file
+    and dropped from memory; reading one of them (to build a request, for
+    `/last`, `/history` or `/save`) decodes it from a read-only mmap of the
+    file without keeping it. The latest turn always stays in memory, and a
+    chat that never reaches the limit never creates the file.
+
+    The spill file is anonymous and disappears when the store is closed or
+    the process exits; the session journal stays the crash-safe copy of the
+    history. Removed or replaced messages leave their old bodies in the file
+    until the next `reset`.
+
+    A spilled message is decoded into a new dict every time it is read, so a
+    message is changed with `store[index] = message`, not by editing the
+    dict in place, and `ids` (not object identity) tells whether two reads
+    are the same message.'''
+
+    def __init__(self, messages: Iterable[Dict[str, str]] = (), directory: Path = None,
+                 resident_bytes: int = 64 * 1024 * 1024):
+        self.directory = directory          # 为 None 时不写入磁盘
+        self.resident_bytes = resident_bytes
+        self.roles: List[str] = []
+        self.ids = array('q')
+        self.sizes = array('q')             # 正文 JSON 编码后的字节数
+        self.offsets = array('q')           # 正文在溢出文件中的位置，-1 表示还在内存中
+        self.bodies: List[Optional[Dict[str, str]]] = []
+        self.size = 0                       # 所有正文的字节数
+        self.resident_size = 0              # 内存中正文的字节数
+        self.spilled = 0                    # 正文在溢出文件中的消息数
+        self.first_resident = 0             # 在这之前的消息都已经写入溢出文件
+        self.serial = count()
+        self.file = None
+        self.map: Optional[mmap.mmap] = None
+        self.lock = threading.RLock()       # 后台会话在线程池中加入回答
+        self.reset(messages)
+
+    def __len__(self):
+        return len(self.roles)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.read(position) for position in range(*index.indices(len(self.roles)))]
+        return self.read(self.position(index))
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        for index in range(len(self.roles)):
+            yield self.read(index)
+
+    def __setitem__(self, index: int, message: Dict[str, str]):
+        index = self.position(index)
+        with self.lock:
+            self.forget(index)
+            size = len(encode_message(message))
+            self.roles[index] = sys.intern(message['role'])
+            self.ids[index] = next(self.serial)
+            self.sizes[index] = size
+            self.offsets[index] = -1
+            self.bodies[index] = message
+            self.size += size
+            self.resident_size += size
+            self.first_resident = min(self.first_resident, index)
+            self.spill()
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self.roles))
+            if step != 1:
+                for position in sorted(range(start, stop, step), reverse=True):
+                    del self[position]
+                return
+        else:
+            start = self.position(index)
+            stop = start + 1
+        with self.lock:
+            for position in range(start, stop):
+                self.forget(position)
+            for column in (self.roles, self.ids, self.sizes, self.offsets, self.bodies):
+                del column[start:stop]
+            self.first_resident = min(self.first_resident, start)
+
+    def insert(self, index: int, message: Dict[str, str]):
+        index = min(max(index + len(self.roles) if index < 0 else index, 0), len(self.roles))
+        size = len(encode_message(message))
+        with self.lock:
+            self.roles.insert(index, sys.intern(message['role']))
+            self.ids.insert(index, next(self.serial))
+            self.sizes.insert(index, size)
+            self.offsets.insert(index, -1)
+            self.bodies.insert(index, message)
+            self.size += size
+            self.resident_size += size
+            self.first_resident = min(self.first_resident, index)
+            self.spill()
+
+    def append(self, message: Dict[str, str]):
+        self.insert(len(self.roles), message)
+
+    def position(self, index: int) -> int:
+        if index < 0:
+            index += len(self.roles)
+        if not 0 <= index < len(self.roles):
+            raise IndexError("message index out of range")
+        return index
+
+    def read(self, index: int) -> Dict[str, str]:
+        body = self.bodies[index]
+        if body is not None:
+            return body
+        with self.lock:
+            offset, size = self.offsets[index], self.sizes[index]
+            if self.map is None or offset + size > len(self.map):
+                # 文件变长后重新映射
+                if self.map is not None:
+                    self.map.close()
+                self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            return json.loads(self.map[offset:offset + size])
+
+    def forget(self, index: int):
+        '''减去 index 处消息的大小，它的正文即将被删除或替换'''
+        self.size -= self.sizes[index]
+        if self.offsets[index] < 0:
+            self.resident_size -= self.sizes[index]
+        else:
+            self.spilled -= 1
+
+    def spill(self):
+        '''内存中的正文超出 resident_bytes 时，从最早的消息开始写入溢出文件'''
+        if self.resident_size <= self.resident_bytes or self.directory is None:
+            return
+        index = self.first_resident
+        # 最后一轮对话（问题和回答）总是留在内存中
+        end = len(self.roles) - 2
+        try:
+            while self.resident_size > self.resident_bytes and index < end:
+                body = self.bodies[index]
+                if body is not None:
+                    self.write(index, body)
+                index += 1
+            self.file.flush()
+        except OSError as e:
+            log.error(f"Failed to spill messages to disk, keeping them in memory: {e}")
+            self.directory = None
+        self.first_resident = index
+
+    def write(self, index: int, body: Dict[str, str]):
+        if self.file is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self.file = tempfile.TemporaryFile(prefix="messages-", suffix=".spill", dir=self.directory)
+        data = encode_message(body)
+        offset = self.file.seek(0, 2)
+        self.file.write(data)
+        self.offsets[index] = offset
+        self.sizes[index] = len(data)
+        self.bodies[index] = None
+        self.resident_size -= len(data)
+        self.spilled += 1
+
+    def reset(self, messages: Iterable[Dict[str, str]] = ()):
+        '''换成另一段历史记录，同时丢弃溢出文件里已经没用的内容'''
+        with self.lock:
+            del self[:]
+            self.close()
+            self.size = self.resident_size = self.spilled = self.first_resident = 0
+            for message in messages:
+                self.append(message)
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,212 @@
+import hashlib
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+log = logging.getLogger("chat")
+
+_encodings = {}
+_tokenizers = {}
+
+# (模型名前缀, 编码, 每条消息的额外 token, name 字段的额外 token)，按顺序匹配第一个
+# 每条消息在聊天格式中还有 <|start|>role ... <|end|> 等包装，数值来自 OpenAI cookbook
+MODEL_TOKENIZERS = [
+    ("gpt-4o", "o200k_base", 3, 1),
+    ("gpt-3.5-turbo-0301", "cl100k_base", 4, -1),
+    ("gpt-3.5-turbo", "cl100k_base", 3, 1),
+    ("gpt-4", "cl100k_base", 3, 1),
+]
+DEFAULT_TOKENIZER = ("", "cl100k_base", 3, 1)
+# 每次请求回答前面的 <|start|>assistant<|message|>
+REPLY_PRIMING_TOKENS = 3
+
+
+def get_encoding(name: str = "cl100k_base"):
+    '''获取 tiktoken 编码器，同一编码只加载一次'''
+    encoding = _encodings.get(name)
+    if encoding is None:
+        # tiktoken 导入和加载编码表都很慢，只在第一次需要计算 token 时进行
+        import tiktoken
+        encoding = _encodings[name] = tiktoken.get_encoding(name)
+    return encoding
+
+
+class Tokenizer:
+    '''Counts tokens the way a chat model sees the messages.
+
+    Each message costs the tokens of its values plus a fixed per-message
+    overhead for the chat-format wrapping, and every request adds the reply
+    priming. The encoder is loaded on the first count, shared by all
+    tokenizers using the same encoding.'''
+
+    def __init__(self, encoding: str, tokens_per_message: int, tokens_per_name: int):
+        self.encoding = encoding
+        self.tokens_per_message = tokens_per_message
+        self.tokens_per_name = tokens_per_name
+        # 区分不同的计数方式，用作 TokenCountStore 的键
+        self.name = f"{encoding}+{tokens_per_message}/{tokens_per_name}"
+
+    def count_text(self, text: str) -> int:
+        return len(get_encoding(self.encoding).encode(text)) if text else 0
+
+    def count_message(self, message: Dict[str, str]) -> int:
+        tokens = self.tokens_per_message
+        for key, value in message.items():
+            tokens += self.count_text(value)
+            if key == "name":
+                tokens += self.tokens_per_name
+        return tokens
+
+    def count_messages(self, messages: List[Dict[str, str]]) -> int:
+        '''一次请求中 messages 占用的 prompt token'''
+        return sum(self.count_message(message) for message in messages) + REPLY_PRIMING_TOKENS
+
+    def reply_message_tokens(self, completion_tokens: int) -> int:
+        '''已知回答内容的 token 数（例如 API 返回的 usage）时，回答作为下一次请求的消息占用的 token'''
+        return completion_tokens + self.tokens_per_message + self.count_text("assistant")
+
+
+def get_tokenizer(model: str = None) -> Tokenizer:
+    '''按模型名取得 Tokenizer，同样的计数方式共用一个实例'''
+    model = model or ""
+    tokenizer = _tokenizers.get(model)
+    if tokenizer is None:
+        _prefix, encoding, per_message, per_name = next(
+            (entry for entry in MODEL_TOKENIZERS if model.startswith(entry[0])), DEFAULT_TOKENIZER)
+        tokenizer = next((known for known in _tokenizers.values() if known.name == f"{encoding}+{per_message}/{per_name}"),
+                         None) or Tokenizer(encoding, per_message, per_name)
+        _tokenizers[model] = tokenizer
+    return tokenizer
+
+
+def count_message_tokens(message: Dict[str, str], model: str = None) -> int:
+    '''计算单条 message 在聊天格式中占用的 token'''
+    return get_tokenizer(model).count_message(message)
+
+
+def count_token(messages: List[Dict[str, str]], model: str = None) -> int:
+    '''计算一次请求中 messages 占用的 token，包括每条消息的格式开销和回答前缀'''
+    return get_tokenizer(model).count_messages(messages)
+
+
+def count_usage(usage: Optional[Dict], messages: List[Dict[str, str]], reply: str, model: str = None) -> Tuple[int, int]:
+    '''一次请求实际花费的 (prompt, completion) token。API 返回了 usage 时直接使用；
+    没有时（被中断的流式回答、不支持 stream_options 的服务）按模型的计数方式计算'''
+    if usage:
+        return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+    tokenizer = get_tokenizer(model)
+    return tokenizer.count_messages(messages), tokenizer.count_text(reply)
+
+
+class TokenLedger:
+    '''Per-message token counts kept alongside `ChatGPT.messages`.
+
+    Every message is tokenized at most once; appends, pops, deletes and edits
+    only adjust the running total instead of re-encoding the whole history.
+    Counting is deferred until `total` is read, so code paths that never look
+    at the token count (e.g. pipe mode) never load the tokenizer.
+
+    The ledger does not keep messages of its own: it reads the sequence it
+    was given (the `MessageStore` of the chat), and every change is made to
+    that sequence by the caller and then reported with `append`, `pop`,
+    `update` or `truncate`.'''
+
+    def __init__(self, messages: Sequence[Dict[str, str]] = (), tokenizer: Tokenizer = None):
+        self.tokenizer = tokenizer or get_tokenizer()
+        self.reset(messages)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def reset(self, messages: Sequence[Dict[str, str]] = (), counts: Optional[List[Optional[int]]] = None):
+        '''counts 为已知的每条消息 token 数（例如从 TokenCountStore 读取），未知的为 None'''
+        self.messages = messages
+        self.counts: List[Optional[int]] = list(counts) if counts else [None] * len(self.messages)
+        self.counted = next((index for index, tokens in enumerate(self.counts) if tokens is None), len(self.counts))
+        self.known_total = sum(tokens for tokens in self.counts if tokens is not None)
+
+    @property
+    def total(self) -> int:
+        self.count_pending()
+        return self.known_total
+
+    def message_counts(self) -> List[int]:
+        '''每条消息的 token 数，与 messages 一一对应'''
+        self.count_pending()
+        return self.counts
+
+    def count_pending(self):
+        '''计算还没有计数的消息（加入时没有给出 token 数的消息）'''
+        for index in range(self.counted, len(self.counts)):
+            if self.counts[index] is None:
+                self.counts[index] = self.tokenizer.count_message(self.messages[index])
+                self.known_total += self.counts[index]
+        self.counted = len(self.counts)
+
+    def append(self, message: Dict[str, str], tokens: Optional[int] = None):
+        '''message 已经加入 messages；tokens 为已知的 token 数（例如由 API 返回的 usage 得出），不需要再计算'''
+        self.counts.append(tokens)
+        if tokens is not None:
+            self.known_total += tokens
+
+    def pop(self, index: int = -1):
+        if index < 0:
+            index += len(self.counts)
+        tokens = self.counts.pop(index)
+        if tokens is not None:
+            self.known_total -= tokens
+        self.counted = min(self.counted, index)
+
+    def update(self, index: int, message: Dict[str, str]):
+        if self.counts[index] is not None:
+            self.known_total -= self.counts[index]
+        self.counts[index] = None
+        self.counted = min(self.counted, index)
+
+    def set_tokenizer(self, tokenizer: Tokenizer):
+        '''换用另一种计数方式（例如切换了模型）时，所有消息在下次读取 total 时重新计算'''
+        if tokenizer.name != self.tokenizer.name:
+            self.tokenizer = tokenizer
+            self.reset(self.messages)
+
+    def truncate(self, length: int):
+        '''只保留前 length 条消息'''
+        self.known_total -= sum(tokens for tokens in self.counts[length:] if tokens is not None)
+        del self.counts[length:]
+        self.counted = min(self.counted, length)
+
+
+class TokenCountStore:
+    '''Per-message token counts persisted in `~/.gpt-term`, keyed by a hash of the message.
+
+    Counts are written when a chat is saved and read back when it is loaded,
+    so a large history does not have to be re-tokenized before the first
+    prompt. The store is only opened for the duration of one call.'''
+
+    def __init__(self, path: Path, tokenizer: Tokenizer = None):
+        self.path = path
+        # 计数方式不同（编码或格式开销）的计数互不通用
+        self.tokenizer = tokenizer or get_tokenizer()
+
+    def key(self, message: Dict[str, str]) -> str:
+        return f"{self.tokenizer.name}:{hashlib.sha1(str(message).encode()).hexdigest()}"
+
+    def get_counts(self, messages: List[Dict[str, str]]) -> List[Optional[int]]:
+        import dbm
+        try:
+            with dbm.open(str(self.path), 'c') as db:
+                counts = [db.get(self.key(message)) for message in messages]
+        except dbm.error as e:
+            log.error(f"Failed to read token counts: {e}")
+            return [None] * len(messages)
+        return [int(tokens) if tokens is not None else None for tokens in counts]
+
+    def save(self, messages: List[Dict[str, str]], counts: List[Optional[int]]):
+        import dbm
+        try:
+            with dbm.open(str(self.path), 'c') as db:
+                for message, tokens in zip(messages, counts):
+                    if tokens is not None:
+                        db[self.key(message)] = str(tokens)
+        except dbm.error as e:
+            log.error(f"Failed to save token counts: {e}")
@@ -0,0 +1,271 @@
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from .ratelimit import RETRY_STATUS, RateLimiter, backoff_delay, estimate_tokens
+
+log = logging.getLogger("chat")
+
+# 当前线程最近一次请求建立连接的耗时，由连接类写入
+_connect_timings = threading.local()
+
+
+def _reset_connect_timings():
+    _connect_timings.connect = 0.0
+    _connect_timings.tls = 0.0
+
+
+class TimedHTTPConnection(HTTPConnection):
+    def _new_conn(self):
+        start = time.perf_counter()
+        sock = super()._new_conn()
+        _connect_timings.connect = time.perf_counter() - start
+        return sock
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def _new_conn(self):
+        start = time.perf_counter()
+        sock = super()._new_conn()
+        _connect_timings.connect = time.perf_counter() - start
+        return sock
+
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        _connect_timings.tls = max(time.perf_counter() - start - _connect_timings.connect, 0.0)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    '''HTTP/1.1 keep-alive 连接池，记录新建连接的 TCP 与 TLS 耗时'''
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool,
+        }
+
+
+class Http2Body:
+    '''Minimal urllib3-like body of an httpx response, used as `requests.Response.raw`'''
+
+    def __init__(self, response):
+        self.response = response
+        self.chunks = response.iter_bytes()
+        self.iterator = None
+        self.buffer = b""
+
+    def stream(self, amt=None, decode_content=True):
+        import httpx
+        try:
+            # 数据到达多少就交出多少，流式回复不会被攒成大块
+            for chunk in self.chunks:
+                yield chunk
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.ReadTimeout(e)
+        except httpx.HTTPError as e:
+            raise requests.exceptions.ConnectionError(e)
+
+    def read(self, amt=None, decode_content=True):
+        if self.iterator is None:
+            self.iterator = self.stream()
+        while amt is None or len(self.buffer) < amt:
+            chunk = next(self.iterator, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if amt is None:
+            data, self.buffer = self.buffer, b""
+        else:
+            data, self.buffer = self.buffer[:amt], self.buffer[amt:]
+        return data
+
+    def close(self):
+        self.response.close()
+
+    def release_conn(self):
+        self.response.close()
+
+
+class Http2Adapter(BaseAdapter):
+    '''Send requests through an HTTP/2 capable httpx client (`pip install httpx[http2]`)'''
+
+    def __init__(self, pool_size: int):
+        super().__init__()
+        import httpx
+        self.client = httpx.Client(http2=True, limits=httpx.Limits(
+            max_connections=pool_size, max_keepalive_connections=pool_size))
+
+    @staticmethod
+    def trace(event_name: str, info):
+        now = time.perf_counter()
+        if event_name in ("connection.connect_tcp.started", "connection.start_tls.started"):
+            _connect_timings.started = now
+        elif event_name == "connection.connect_tcp.complete":
+            _connect_timings.connect = now - _connect_timings.started
+        elif event_name == "connection.start_tls.complete":
+            _connect_timings.tls = now - _connect_timings.started
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        import httpx
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        try:
+            http2_request = self.client.build_request(
+                request.method, request.url, headers=dict(request.headers), content=request.body,
+                timeout=timeout, extensions={"trace": self.trace})
+            http2_response = self.client.send(http2_request, stream=True)
+        except httpx.ConnectTimeout as e:
+            raise requests.exceptions.ConnectTimeout(e, request=request)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.ReadTimeout(e, request=request)
+        except httpx.HTTPError as e:
+            raise requests.exceptions.ConnectionError(e, request=request)
+
+        response = requests.Response()
+        response.status_code = http2_response.status_code
+        response.reason = http2_response.reason_phrase
+        response.headers = CaseInsensitiveDict(http2_response.headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = Http2Body(http2_response)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        self.client.close()
+
+
+class RequestTiming:
+    '''一次请求的耗时拆分: connect / TLS / time-to-first-byte / transfer'''
+
+    def __init__(self, method: str, url: str):
+        self.method = method
+        self.url = url
+        self.start = time.perf_counter()
+        self.connect = 0.0
+        self.tls = 0.0
+        self.ttfb = 0.0
+        self.transfer = 0.0
+        self.headers_at = self.start
+        self.finished = False
+
+    def headers_received(self, elapsed: float):
+        self.connect = getattr(_connect_timings, "connect", 0.0)
+        self.tls = getattr(_connect_timings, "tls", 0.0)
+        self.headers_at = self.start + elapsed
+        self.ttfb = max(elapsed - self.connect - self.tls, 0.0)
+
+    def finish(self):
+        '''响应体读取完毕时调用，流式请求需要在读完流之后调用'''
+        if self.finished:
+            return
+        self.finished = True
+        self.transfer = max(time.perf_counter() - self.headers_at, 0.0)
+        log.debug(f"HTTP {self.method} {self.url}: connect={self.connect * 1000:.1f}ms tls={self.tls * 1000:.1f}ms "
+                  f"ttfb={self.ttfb * 1000:.1f}ms transfer={self.transfer * 1000:.1f}ms"
+                  f"{' (reused connection)' if not self.connect else ''}")
+
+
+class Transport:
+    '''All HTTP requests of a ChatGPT instance go through one pooled, keep-alive session.
+
+    The session is shared by the main thread and background threads (title
+    generation, version check); every request is timed into a `RequestTiming`
+    attached to the response as `response.timing`. Streamed bodies are read
+    through `response.chunks`, chunks are yielded as soon as they arrive.
+
+    Requests wait for the shared `RateLimiter` before they are sent; 429 and
+    5xx responses are retried up to `max_retries` times, after `retry-after`
+    or a jittered exponential backoff.'''
+
+    def __init__(self, pool_size: int = 10, http2: bool = False):
+        self.pool_size = pool_size
+        self.http2 = False
+        self.limiter = RateLimiter(pool_size)
+        self.max_retries = 3
+        self.session = requests.Session()
+        if http2:
+            # 缺少 httpx[http2] 时抛出 ImportError，由调用方决定是否回退到 HTTP/1.1
+            adapter = Http2Adapter(pool_size)
+            self.http2 = True
+        else:
+            adapter = TimedHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method: str, url: str, stream: bool = False, **kwargs) -> requests.Response:
+        cost = estimate_tokens(kwargs.get("data"))
+        attempt = 0
+        while True:
+            self.limiter.acquire(cost)
+            _reset_connect_timings()
+            timing = RequestTiming(method, url)
+            try:
+                response = self.session.request(method, url, stream=stream, **kwargs)
+            except BaseException:
+                self.limiter.release()
+                raise
+            retry_after = self.limiter.release(response.status_code, response.headers)
+            timing.headers_received(response.elapsed.total_seconds())
+            if not self.should_retry(response, attempt):
+                break
+            delay = retry_after if retry_after is not None else backoff_delay(attempt)
+            log.warning(f"HTTP {method} {url}: {response.status_code}, retry {attempt + 1}/{self.max_retries} in {delay:.2f}s")
+            response.close()
+            time.sleep(delay)
+            attempt += 1
+        response.timing = timing
+        if stream:
+            # 流式响应只能有一个读取者，读完剩余部分连接才会回到连接池
+            response.chunks = response.iter_content(chunk_size=None)
+        else:
+            timing.finish()
+        return response
+
+    def should_retry(self, response: requests.Response, attempt: int) -> bool:
+        if response.status_code not in RETRY_STATUS or attempt >= self.max_retries:
+            return False
+        # 额度用完的 429 重试也没有用
+        return not (response.status_code == 429 and b"insufficient_quota" in response.content)
+
+    def release(self, response: requests.Response, drain: bool = True):
+        '''Finish a streamed response.
+
+        Reading the rest of the body (usually just the chunked-encoding
+        terminator after `[DONE]`) hands the connection back to the pool;
+        `drain=False` closes it instead, for replies aborted halfway.'''
+        if drain:
+            try:
+                for _ in response.chunks:
+                    pass
+            except requests.exceptions.RequestException:
+                pass
+        response.close()
+        response.timing.finish()
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,276 @@
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+log = logging.getLogger("chat")
+
+# 每百万 token 的美元价格 (输入, 输出)，按模型名前缀匹配最长的一项；价格变化时可以用 PRICES 覆盖
+DEFAULT_PRICES: Dict[str, Tuple[float, float]] = {
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-4-1106-preview": (10.0, 30.0),
+    "gpt-4-vision-preview": (10.0, 30.0),
+    "gpt-4-32k": (60.0, 120.0),
+    "gpt-4": (30.0, 60.0),
+    "gpt-3.5-turbo-16k": (3.0, 4.0),
+    "gpt-3.5-turbo-1106": (1.0, 2.0),
+    "gpt-3.5-turbo": (0.5, 1.5),
+}
+
+BUDGET_PERIODS = ['day', 'month']
+
+SCHEMA = '''
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS requests (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    session TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    model TEXT NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    latency REAL,
+    cached INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS daily (
+    day TEXT NOT NULL,
+    model TEXT NOT NULL,
+    requests INTEGER NOT NULL,
+    cached INTEGER NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    PRIMARY KEY (day, model)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS session_totals (
+    session TEXT NOT NULL,
+    model TEXT NOT NULL,
+    started REAL NOT NULL,
+    requests INTEGER NOT NULL,
+    cached INTEGER NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    PRIMARY KEY (session, model)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS session_totals_started ON session_totals (started);
+'''
+
+# 汇总表的累加：同一天/同一会话同一模型只有一行
+ROLLUP = '''
+INSERT INTO {table} ({key}, model, {extra}requests, cached, prompt_tokens, completion_tokens)
+VALUES (?, ?, {extra_value}1, ?, ?, ?)
+ON CONFLICT ({key}, model) DO UPDATE SET
+    requests = requests + 1,
+    cached = cached + excluded.cached,
+    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+    completion_tokens = completion_tokens + excluded.completion_tokens
+'''
+DAILY_ROLLUP = ROLLUP.format(table="daily", key="day", extra="", extra_value="")
+SESSION_ROLLUP = ROLLUP.format(table="session_totals", key="session", extra="started, ", extra_value="?, ")
+
+
+class UsageRow(NamedTuple):
+    key: str            # 日期、模型名或会话
+    requests: int
+    cached: int
+    prompt_tokens: int
+    completion_tokens: int
+    cost: Optional[float]   # 有未知价格的模型时只统计已知部分，全部未知时为 None
+
+
+class PriceTable:
+    '''模型价格表，PRICES 配置的格式为 "gpt-4=30/60; my-model=1/2"（每百万 token 的美元价格，输入/输出）'''
+
+    def __init__(self, overrides: str = ""):
+        self.prices = dict(DEFAULT_PRICES)
+        for entry in overrides.replace("\n", ";").split(";"):
+            if not entry.strip():
+                continue
+            try:
+                model, price = entry.split("=")
+                prompt_price, completion_price = price.split("/")
+                self.prices[model.strip()] = (float(prompt_price), float(completion_price))
+            except ValueError:
+                log.warning(f"Ignored invalid PRICES entry: {entry.strip()}")
+        # 最长的前缀优先
+        self.prefixes = sorted(self.prices, key=len, reverse=True)
+
+    def price(self, model: str) -> Optional[Tuple[float, float]]:
+        prefix = next((prefix for prefix in self.prefixes if model.startswith(prefix)), None)
+        return self.prices[prefix] if prefix is not None else None
+
+    def cost(self, model: str, prompt_tokens: int, completion_tokens: int) -> Optional[float]:
+        price = self.price(model)
+        if price is None:
+            return None
+        return (prompt_tokens * price[0] + completion_tokens * price[1]) / 1_000_000
+
+
+def period_start(period: str, now: float = None) -> str:
+    '''预算周期（day / month）开始的日期'''
+    today = time.strftime("%Y-%m-%d", time.localtime(now))
+    return today if period == 'day' else today[:8] + "01"
+
+
+class UsageLedger:
+    '''Token usage of every request, kept across sessions in an SQLite database.
+
+    Each request (model, prompt/completion tokens, latency, whether it was a
+    response cache hit) is appended to `requests` and never changed. In the
+    same transaction it is added to two rollup tables, per day and model and
+    per session and model, which is all `/usage` and the budget check read:
+    their size grows with the number of days and sessions, not requests, so
+    queries stay fast after years of use. Costs are computed from the rollups
+    with the current `PriceTable` when queried.'''
+
+    def __init__(self, path: Path, session: str, prices: PriceTable = None):
+        self.path = Path(path)
+        self.session = session
+        self.prices = prices or PriceTable()
+        self.db = None
+        # 标题生成和 /compare 在事件循环线程中记录
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.db is None:
+            import sqlite3
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # 多个 gpt-term 同时运行时等待对方的写入完成
+            self.db = sqlite3.connect(str(self.path), timeout=5, check_same_thread=False)
+            self.db.executescript(SCHEMA)
+        return self.db
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def record(self, model: str, prompt_tokens: int, completion_tokens: int, latency: float = None,
+               cached: bool = False, kind: str = "chat"):
+        import sqlite3
+        now = time.time()
+        day = time.strftime("%Y-%m-%d", time.localtime(now))
+        try:
+            with self.lock:
+                db = self.connect()
+                with db:
+                    db.execute("INSERT INTO requests (time, session, kind, model, prompt_tokens, completion_tokens, latency, cached) "
+                               "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               (now, self.session, kind, model, prompt_tokens, completion_tokens, latency, int(cached)))
+                    db.execute(DAILY_ROLLUP, (day, model, int(cached), prompt_tokens, completion_tokens))
+                    db.execute(SESSION_ROLLUP, (self.session, model, now, int(cached), prompt_tokens, completion_tokens))
+        except sqlite3.Error as e:
+            # 记录失败不影响对话
+            log.warning(f"Failed to record usage: {e}")
+
+    def query(self, sql: str, parameters: tuple = ()) -> List[tuple]:
+        with self.lock:
+            return self.connect().execute(sql, parameters).fetchall()
+
+    def rows(self, rows: List[tuple]) -> List[UsageRow]:
+        '''把 (key, model, requests, cached, prompt, completion) 按 key 合并并计算费用，保持原来的顺序'''
+        merged: Dict[str, list] = {}
+        for key, model, requests, cached, prompt_tokens, completion_tokens in rows:
+            totals = merged.setdefault(key, [0, 0, 0, 0, None])
+            totals[0] += requests
+            totals[1] += cached
+            totals[2] += prompt_tokens
+            totals[3] += completion_tokens
+            cost = self.prices.cost(model, prompt_tokens, completion_tokens)
+            if cost is not None:
+                totals[4] = (totals[4] or 0.0) + cost
+        return [UsageRow(key, *totals) for key, totals in merged.items()]
+
+    def by_day(self, days: int = 14) -> List[UsageRow]:
+        since = time.strftime("%Y-%m-%d", time.localtime(time.time() - (days - 1) * 86400))
+        return self.rows(self.query(
+            "SELECT day, model, requests, cached, prompt_tokens, completion_tokens FROM daily "
+            "WHERE day >= ? ORDER BY day DESC", (since,)))
+
+    def by_model(self, since: str = "") -> List[UsageRow]:
+        '''since 为开始日期（YYYY-MM-DD），省略时统计全部'''
+        rows = self.rows(self.query(
+            "SELECT model, model, SUM(requests), SUM(cached), SUM(prompt_tokens), SUM(completion_tokens) FROM daily "
+            "WHERE day >= ? GROUP BY model", (since,)))
+        return sorted(rows, key=lambda row: (row.cost or 0.0, row.prompt_tokens + row.completion_tokens), reverse=True)
+
+    def by_session(self, limit: int = 10) -> List[UsageRow]:
+        with self.lock:
+            db = self.connect()
+            # 沿 started 索引倒序读取，够 limit 个会话就停止，不扫描全部会话
+            sessions: List[str] = []
+            for (session,) in db.execute("SELECT session FROM session_totals ORDER BY started DESC"):
+                if session not in sessions:
+                    sessions.append(session)
+                    if len(sessions) == limit:
+                        break
+            rows = db.execute(
+                "SELECT session, model, requests, cached, prompt_tokens, completion_tokens FROM session_totals "
+                f"WHERE session IN ({', '.join('?' * len(sessions))})", sessions).fetchall()
+        rows.sort(key=lambda row: sessions.index(row[0]))
+        return self.rows(rows)
+
+    def total(self, since: str = "", session: str = None) -> UsageRow:
+        '''since 之后（或某个会话）的合计'''
+        if session is not None:
+            rows = self.query("SELECT '', model, requests, cached, prompt_tokens, completion_tokens FROM session_totals "
+                              "WHERE session = ?", (session,))
+        else:
+            rows = self.query("SELECT '', model, SUM(requests), SUM(cached), SUM(prompt_tokens), SUM(completion_tokens) "
+                              "FROM daily WHERE day >= ? GROUP BY model", (since,))
+        return (self.rows(rows) or [UsageRow("", 0, 0, 0, 0, 0.0)])[0]
+
+
+class Budget:
+    '''每天或每月的费用上限：超过 soft 时提醒一次，超过 hard 时不再发出请求（单位美元，0 为不限制）'''
+
+    def __init__(self, period: str = 'month', soft: float = 0, hard: float = 0):
+        self.period = period if period in BUDGET_PERIODS else 'month'
+        self.soft = soft
+        self.hard = hard
+        self.warned = False
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.soft or self.hard)
+
+    def check(self, ledger: UsageLedger) -> Tuple[Optional[str], float, float]:
+        '''返回 (超出的限制 soft / hard / None, 本周期已花费, 对应的上限)'''
+        if not self.enabled:
+            return None, 0.0, 0.0
+        import sqlite3
+        try:
+            spent = ledger.total(period_start(self.period)).cost or 0.0
+        except sqlite3.Error as e:
+            log.warning(f"Failed to read usage for the budget check: {e}")
+            return None, 0.0, 0.0
+        if self.hard and spent >= self.hard:
+            return 'hard', spent, self.hard
+        if self.soft and spent >= self.soft:
+            return 'soft', spent, self.soft
+        return None, spent, 0.0
+
+
+def format_cost(cost: Optional[float]) -> str:
+    return f"${cost:.4f}" if cost is not None else "-"
+
+
+def usage_table(title: str, key_header: str, rows: List[UsageRow]):
+    '''/usage 显示的表格'''
+    import i18n
+    from rich.table import Table
+
+    _ = i18n.t
+    table = Table(title=title, title_justify="left")
+    table.add_column(key_header, style="bold cyan")
+    table.add_column(_("gpt_term.usage_requests"), justify="right")
+    table.add_column(_("gpt_term.usage_cached"), justify="right")
+    table.add_column(_("gpt_term.usage_prompt"), justify="right")
+    table.add_column(_("gpt_term.usage_completion"), justify="right")
+    table.add_column(_("gpt_term.usage_cost"), justify="right")
+    for row in rows:
+        table.add_row(row.key, str(row.requests), str(row.cached), f"{row.prompt_tokens:,}",
+                      f"{row.completion_tokens:,}", format_cost(row.cost))
+    return table